@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+import threading
+from battery import Battery, Protection
+from utils import *
+
+
+class AggregateBattery(Battery):
+    # One virtual battery made of packs connected in parallel. It does no I/O of its own:
+    # refresh_data() combines the last snapshots of the packs and manage_charge_current()
+    # their charge limits, so it can be published after every single pack poll. A pack that
+    # is being polled on its own thread meanwhile does not change its last snapshot.
+
+    def __init__(self, packs, ids=None, port='aggregate'):
+        super(AggregateBattery, self).__init__(port, None)
+        self.type = 'Aggregate'
+        self.packs = packs
+        # How cells are told apart, e.g. 'ttyUSB1 C3', the tty name of each pack by default
+        self.ids = dict(zip(packs, ids or [pack.port[pack.port.rfind('/') + 1:] for pack in packs]))
+        # Result of the last refresh_data() of each pack
+        self.online = dict((pack, False) for pack in packs)
+        # Hold it while calling refresh_data() and publishing, the packs poll on threads of their own
+        self.lock = threading.Lock()
+
+    def test_connection(self):
+        return True
+
+    def get_settings(self):
+        packs = self.packs
+        self.version = packs[0].version
+        self.hardware_version = '%d packs' % len(packs)
+        self.cell_count = packs[0].cell_count
+        self.capacity = sum(pack.capacity or 0 for pack in packs)
+        self.max_battery_current = sum(pack.max_battery_current or 0 for pack in packs)
+        self.max_battery_discharge_current = sum(pack.max_battery_discharge_current or 0 for pack in packs)
+        self.max_battery_voltage = min(pack.max_battery_voltage for pack in packs)
+        self.min_battery_voltage = max(pack.min_battery_voltage for pack in packs)
+        self.max_battery_voltage_warning = min(pack.max_battery_voltage_warning for pack in packs)
+        self.min_battery_voltage_warning = max(pack.min_battery_voltage_warning for pack in packs)
+        return True
+
+    def update_pack(self, pack, online):
+        self.online[pack] = bool(online)
+
+    def online_packs(self):
+        return [pack for pack in self.packs if self.online[pack]]
+
+    def online_snapshots(self):
+        return [pack.snapshot for pack in self.online_packs()]
+
+    def pack_id(self, pack):
+        return self.ids[pack]
+
+    def refresh_data(self):
+        packs = self.online_snapshots()
+        if not packs:
+            self.voltage = self.current = self.soc = self.capacity_remain = None
+            return self.finish_refresh(False)
+
+        voltages = [pack.voltage for pack in packs if pack.voltage is not None]
+        self.voltage = sum(voltages) / len(voltages) if voltages else None
+        self.current = sum(pack.current for pack in packs if pack.current is not None)
+        self.capacity_remain = sum(pack.capacity_remain for pack in packs if pack.capacity_remain is not None)
+        capacity = sum(pack.capacity for pack in packs if pack.capacity)
+        if capacity:
+            self.soc = 100.0 * self.capacity_remain / capacity
+        else:
+            socs = [pack.soc for pack in packs if pack.soc is not None]
+            self.soc = sum(socs) / len(socs) if socs else None
+        self.cycles = max(pack.cycles for pack in packs) if all(pack.cycles is not None for pack in packs) else None
+        self.total_ah_drawn = sum(pack.total_ah_drawn for pack in packs) \
+            if all(pack.total_ah_drawn is not None for pack in packs) else None
+        self.charge_fet = all(pack.charge_fet is not False for pack in packs)
+        self.discharge_fet = all(pack.discharge_fet is not False for pack in packs)
+
+        temps = [(pack.min_temp, pack.max_temp) for pack in packs if pack.min_temp is not None]
+        self.temp1 = min(t[0] for t in temps) if temps else None
+        self.temp2 = max(t[1] for t in temps) if temps else None
+
+        # The worst state of any pack, 2 = Alarm, 1 = Warning, 0 = Normal
+        self.protection = Protection()
+        for name in vars(self.protection):
+            states = [getattr(pack.protection, name) for pack in packs if getattr(pack.protection, name) is not None]
+            setattr(self.protection, name, max(states) if states else None)
+        return self.finish_refresh(True)
+
+    def manage_charge_current(self):
+        # Parallel packs share the current about evenly, so the most limited pack bounds
+        # every pack's share. A pack that does not allow charging stops the whole bank.
+        packs = self.online_snapshots()
+        if not packs:
+            self.control_charge_current = 0
+            self.control_discharge_current = 0
+            self.control_allow_charge = False
+            self.control_allow_discharge = False
+            return
+        self.control_charge_current = min(pack.control_charge_current or 0 for pack in packs) * len(packs)
+        self.control_discharge_current = min(pack.control_discharge_current or 0 for pack in packs) * len(packs)
+        self.control_allow_charge = all(pack.control_allow_charge for pack in packs)
+        self.control_allow_discharge = all(pack.control_allow_discharge for pack in packs)
+        voltages = [pack.control_voltage for pack in packs if pack.control_voltage is not None]
+        self.control_voltage = min(voltages) if voltages else None
+
+    def pack_cells(self, voltage, desc):
+        # (voltage, description) from the named snapshot fields of every online pack, e.g. (3.301, 'ttyUSB1 C3')
+        cells = []
+        for pack in self.online_packs():
+            value = getattr(pack.snapshot, voltage)
+            if value is not None:
+                cells.append((value, '%s %s' % (self.pack_id(pack), getattr(pack.snapshot, desc))))
+        return cells
+
+    def get_min_cell_voltage(self):
+        cells = self.pack_cells('min_cell_voltage', 'min_cell_desc')
+        return min(cells)[0] if cells else None
+
+    def get_max_cell_voltage(self):
+        cells = self.pack_cells('max_cell_voltage', 'max_cell_desc')
+        return max(cells)[0] if cells else None
+
+    def get_min_cell_desc(self):
+        cells = self.pack_cells('min_cell_voltage', 'min_cell_desc')
+        return min(cells)[1] if cells else None
+
+    def get_max_cell_desc(self):
+        cells = self.pack_cells('max_cell_voltage', 'max_cell_desc')
+        return max(cells)[1] if cells else None
+
+    def get_balancing(self):
+        return 1 if any(pack.balancing for pack in self.online_snapshots()) else 0
+
+    def get_modules_online(self):
+        return len(self.online_packs())
+
+    def get_modules_offline(self):
+        return len(self.packs) - len(self.online_packs())
+
+    def get_modules_blocking_charge(self):
+        return sum(pack.modules_blocking_charge for pack in self.online_snapshots())
+
+    def get_modules_blocking_discharge(self):
+        return sum(pack.modules_blocking_discharge for pack in self.online_snapshots())
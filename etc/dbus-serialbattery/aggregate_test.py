@@ -0,0 +1,79 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import unittest
+from battery import Battery, Cell
+from aggregate import AggregateBattery
+
+
+def pack(port, voltages, current, capacity_remain, charge_current, allow_charge=True):
+    battery = Battery(port, 9600)
+    battery.cell_count = len(voltages)
+    for voltage in voltages:
+        battery.cells.append(Cell(False))
+        battery.cells[-1].voltage = voltage
+    battery.voltage = sum(voltages)
+    battery.current = current
+    battery.capacity = 100.0
+    battery.capacity_remain = capacity_remain
+    battery.charge_fet = battery.discharge_fet = True
+    battery.control_charge_current = charge_current
+    battery.control_discharge_current = 50.0
+    battery.control_allow_charge = allow_charge
+    battery.control_allow_discharge = True
+    battery.control_voltage = 13.8
+    battery.max_battery_voltage = battery.max_battery_voltage_warning = 14.2
+    battery.min_battery_voltage = battery.min_battery_voltage_warning = 12.2
+    battery.update_cell_summary()
+    battery.take_snapshot()
+    return battery
+
+
+class TestAggregateBattery(unittest.TestCase):
+
+    def setUp(self):
+        self.packs = [pack('/dev/ttyUSB0', [3.30, 3.31, 3.29, 3.30], -10.0, 60.0, 40.0),
+                      pack('/dev/ttyUSB1', [3.28, 3.35, 3.30, 3.30], -6.0, 40.0, 30.0)]
+        self.aggregate = AggregateBattery(self.packs)
+        self.aggregate.get_settings()
+
+    def test_combined_values(self):
+        for p in self.packs:
+            self.aggregate.update_pack(p, True)
+        self.assertTrue(self.aggregate.refresh_data())
+        self.aggregate.manage_charge_current()
+        self.assertAlmostEqual(self.aggregate.current, -16.0)
+        self.assertAlmostEqual(self.aggregate.capacity, 200.0)
+        self.assertAlmostEqual(self.aggregate.soc, 50.0)
+        self.assertEqual(self.aggregate.get_min_cell_desc(), 'ttyUSB1 C1')
+        self.assertEqual(self.aggregate.get_max_cell_desc(), 'ttyUSB1 C2')
+        self.assertAlmostEqual(self.aggregate.get_min_cell_voltage(), 3.28)
+        # The most limited pack bounds the share of every pack
+        self.assertAlmostEqual(self.aggregate.control_charge_current, 60.0)
+        self.assertEqual(self.aggregate.get_modules_online(), 2)
+        self.assertEqual(self.aggregate.get_modules_blocking_charge(), 0)
+
+    def test_packs_polled_meanwhile(self):
+        for p in self.packs:
+            self.aggregate.update_pack(p, True)
+        # A pack in the middle of its next poll
+        self.packs[0].current = None
+        self.packs[0].cells[0].voltage = 2.9
+        self.assertTrue(self.aggregate.refresh_data())
+        self.assertAlmostEqual(self.aggregate.current, -16.0)
+        self.assertAlmostEqual(self.aggregate.get_min_cell_voltage(), 3.28)
+
+    def test_offline_and_blocking_packs(self):
+        self.packs[0].control_allow_charge = False
+        self.packs[0].snapshot_control()
+        self.aggregate.update_pack(self.packs[0], True)
+        self.aggregate.update_pack(self.packs[1], False)
+        self.aggregate.refresh_data()
+        self.aggregate.manage_charge_current()
+        self.assertAlmostEqual(self.aggregate.current, -10.0)
+        self.assertEqual(self.aggregate.get_modules_online(), 1)
+        self.assertEqual(self.aggregate.get_modules_offline(), 1)
+        self.assertEqual(self.aggregate.get_modules_blocking_charge(), 1)
+        self.assertFalse(self.aggregate.control_allow_charge)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -41,7 +41,7 @@ class Ant(Battery):
         # This will be called for every iteration (1 second)
         # Return True if success, False for failure
         result = self.read_status_data()
-        return result
+        return self.finish_refresh(result)
 
     def read_status_data(self):
         status_data = False
@@ -58,6 +58,8 @@ class Ant(Battery):
         self.cell_count = unpack_from('>b', status_data, 123)[0]
         self.max_battery_voltage = MAX_CELL_VOLTAGE * self.cell_count
         self.min_battery_voltage = MIN_CELL_VOLTAGE * self.cell_count
+        self.max_battery_voltage_warning = MAX_CELL_VOLTAGE_WARNING * self.cell_count
+        self.min_battery_voltage_warning = MIN_CELL_VOLTAGE_WARNING * self.cell_count
 
         cell_max_no, cell_max_voltage, cell_min_no, cell_min_voltage = unpack_from('>bhbh', status_data, 115)
         self.cell_max_no = cell_max_no - 1
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 import logging
+from array import array
+from collections import namedtuple
 import utils
 
 # Logging
@@ -9,6 +11,15 @@ logger.setLevel(logging.INFO)
 
 
 
+# Poll tiers: fast values (current, voltage, cells) are read every poll, medium ones
+# (temperatures, SoC) every TIER_MEDIUM_INTERVAL and slow ones (settings, versions,
+# cycle counts) every TIER_SLOW_INTERVAL seconds
+TIER_FAST = 'fast'
+TIER_MEDIUM = 'medium'
+TIER_SLOW = 'slow'
+TIERS = (TIER_FAST, TIER_MEDIUM, TIER_SLOW)
+
+
 class Protection(object):
     # 2 = Alarm, 1 = Warning, 0 = Normal
     def __init__(self):
@@ -26,6 +37,13 @@ class Protection(object):
         self.temp_low_discharge = None
 
 
+# The states of a Protection as published, see BatterySnapshot
+Alarms = namedtuple('Alarms', (
+    'voltage_high', 'voltage_low', 'voltage_cell_low', 'soc_low', 'current_over', 'current_under',
+    'cell_imbalance', 'internal_failure', 'temp_high_charge', 'temp_low_charge',
+    'temp_high_discharge', 'temp_low_discharge'))
+
+
 class Cell:
     voltage = None
     balance = None
@@ -34,6 +52,110 @@ class Cell:
         self.balance = balance
 
 
+class CellView(object):
+    # Cell i of a CellStore, reads and writes go to the store
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def voltage(self):
+        millivolts = self.store.voltages[self.index]
+        return millivolts / 1000 if millivolts else None
+
+    @voltage.setter
+    def voltage(self, value):
+        self.store.voltages[self.index] = min(max(int(round(value * 1000)), 0), 0xFFFF) if value else 0
+
+    @property
+    def balance(self):
+        return bool(self.store.balance >> self.index & 1)
+
+    @balance.setter
+    def balance(self, value):
+        if value:
+            self.store.balance |= 1 << self.index
+        else:
+            self.store.balance &= ~(1 << self.index)
+
+
+class CellStore(object):
+    # The cells of a battery: voltages in mV in one array, 0 for not read, and the balancing
+    # flags in one bitmask, bit i for cell i. cells[i] is a CellView of cell i, so
+    # cells[i].voltage works as with a list of Cell. Views are made once per cell and reused,
+    # polling allocates nothing here.
+
+    def __init__(self, count=0):
+        self.voltages = array('H')
+        self.balance = 0
+        self._views = []
+        self.resize(count)
+
+    def resize(self, count):
+        # Keep the first count cells, new ones are not read and not balancing
+        if count < len(self.voltages):
+            del self.voltages[count:]
+            self.balance &= (1 << count) - 1
+        else:
+            self.voltages.extend([0] * (count - len(self.voltages)))
+        while len(self._views) < count:
+            self._views.append(CellView(self, len(self._views)))
+
+    def append(self, cell):
+        # For drivers that build their cells one by one
+        self.resize(len(self) + 1)
+        self[len(self) - 1].voltage = cell.voltage
+        self[len(self) - 1].balance = cell.balance
+
+    def __len__(self):
+        return len(self.voltages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._views[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('cell index out of range')
+        return self._views[index]
+
+    def __iter__(self):
+        return iter(self._views[:len(self)])
+
+
+class CellSummary(object):
+    # Min and max cell with their numbers (0 based), the spread, sum and mean of the cell
+    # voltages and whether any cell is balancing, see Battery.update_cell_summary()
+    __slots__ = ('min_no', 'max_no', 'min_voltage', 'max_voltage', 'delta', 'total', 'mean', 'balancing')
+
+    def __init__(self):
+        self.min_no = self.max_no = None
+        self.min_voltage = self.max_voltage = None
+        self.delta = self.total = self.mean = None
+        self.balancing = 0
+
+
+class BatterySnapshot(namedtuple('BatterySnapshot', (
+        'time', 'refreshed_tiers', 'cell_count', 'max_battery_voltage', 'min_battery_voltage',
+        'max_battery_voltage_warning', 'min_battery_voltage_warning', 'max_battery_current',
+        'max_battery_discharge_current', 'voltage', 'current', 'soc', 'capacity', 'capacity_remain',
+        'cycles', 'total_ah_drawn', 'charge_fet', 'discharge_fet', 'temp', 'min_temp', 'max_temp',
+        'temp_internal', 'cell_voltages', 'min_cell_desc', 'max_cell_desc', 'min_cell_voltage',
+        'max_cell_voltage', 'balancing', 'connected', 'modules_online', 'modules_offline', 'modules_blocking_charge',
+        'modules_blocking_discharge', 'protection', 'internal', 'control_voltage', 'control_charge_current',
+        'control_discharge_current', 'control_allow_charge', 'control_allow_discharge'))):
+    # The values of one poll as DbusHelper publishes them and manage_charge_current() works
+    # on them, with the limits they were made under. A snapshot is never changed: every
+    # refresh_data() ends with Battery.finish_refresh(), which makes a new one and replaces
+    # Battery.snapshot with it in one assignment, so a reader always gets the values of a
+    # single poll while the driver already writes the next one.
+    # cell_voltages are in V, None for cells not read. internal holds the settings as
+    # (name, value) pairs when they were read in this poll, else None.
+    __slots__ = ()
+
+
 class Battery(object):
 
     def __init__(self, port, baud):
@@ -61,7 +183,12 @@ class Battery(object):
         self.temp_internal = None
         self.temp1 = None
         self.temp2 = None
-        self.cells = []
+        self.cells = CellStore()
+        self.cell_summary = CellSummary()
+        # The last BatterySnapshot, None before the first poll
+        self.snapshot = None
+        # False for a unit on a shared bus that stopped answering, until it answers again
+        self.connected = True
         self.control_charging = None
         self.control_voltage = None
         self.control_current = None
@@ -74,13 +201,28 @@ class Battery(object):
         # max battery charge/discharge current
         self.max_battery_current = None
         self.max_battery_discharge_current = None
+        # battery voltage limits, set by get_settings()
+        self.max_battery_voltage = None
+        self.min_battery_voltage = None
+        self.max_battery_voltage_warning = None
+        self.min_battery_voltage_warning = None
         self.balancing = None
+        # When each tier is due next, and the tiers the last refresh_data() read
+        self.tier_due = dict((tier, 0) for tier in TIERS)
+        self.refreshed_tiers = TIERS
 
     def test_connection(self):
         # Each driver must override this function to test if a connection can be made
         # return false when fail, true if successful
         return False
 
+    def probe(self):
+        # Drivers with framed replies can return (command, framer, accept) here. The
+        # autodetection then sends command together with the probes of other drivers at
+        # the same baud rate and uses framer and accept(frame) to spot this driver's reply.
+        # None means test_connection() is run on its own.
+        return None
+
     def get_settings(self):
         # Each driver must override this function to read/set the battery settings
         # It is called once after a successful connection by DbusHelper.setup_vedbus()
@@ -90,10 +232,110 @@ class Battery(object):
         return False
 
     def refresh_data(self):
-        # Each driver must override this function to read battery data and populate this class
+        # Each driver must override this function, or refresh_reads(), to read battery data and populate this class
         # It is called each poll just before the data is published to vedbus
-        # return false when fail, true if successful
-        return False
+        # return false when fail, true if successful, through finish_refresh()
+        return self.finish_refresh(self.refresh_tiers(self.due_tiers()))
+
+    def finish_refresh(self, result):
+        # The end of every refresh_data(), whether the reads succeeded or not: summarise the
+        # cells and freeze the values of the poll in a new snapshot. Returns result.
+        if result:
+            self.connected = True
+        self.update_cell_summary()
+        self.take_snapshot()
+        return result
+
+    def refresh_reads(self):
+        # Drivers can list their reads here as [(tier, read function), ...] instead of
+        # overriding refresh_data(). Each poll then runs the reads of the tiers that are due,
+        # in this order. A read returns False when it fails.
+        return None
+
+    def due_tiers(self):
+        now = utils.monotonic()
+        return tuple(tier for tier in TIERS if now >= self.tier_due[tier])
+
+    def refresh_tiers(self, tiers):
+        # Run the reads of tiers. A tier only counts as read when all reads succeeded,
+        # else it is read again on the next poll.
+        reads = self.refresh_reads()
+        if reads is None:
+            return False
+        self.refreshed_tiers = ()
+        for tier, read in reads:
+            if tier in tiers and read() is False:
+                return False
+        now = utils.monotonic()
+        intervals = {TIER_FAST: 0, TIER_MEDIUM: utils.TIER_MEDIUM_INTERVAL, TIER_SLOW: utils.TIER_SLOW_INTERVAL}
+        for tier in tiers:
+            self.tier_due[tier] = now + intervals[tier]
+        self.refreshed_tiers = tiers
+        return True
+
+    def take_snapshot(self):
+        # Freeze the values of this poll, after the reads and update_cell_summary()
+        cells = self.cells
+        protection = self.protection
+        internal = getattr(self, '_internal', None)
+        self.snapshot = BatterySnapshot(
+            time=utils.monotonic(),
+            refreshed_tiers=self.refreshed_tiers,
+            cell_count=self.cell_count,
+            max_battery_voltage=self.max_battery_voltage,
+            min_battery_voltage=self.min_battery_voltage,
+            max_battery_voltage_warning=self.max_battery_voltage_warning,
+            min_battery_voltage_warning=self.min_battery_voltage_warning,
+            max_battery_current=self.max_battery_current,
+            max_battery_discharge_current=self.max_battery_discharge_current,
+            voltage=self.voltage,
+            current=self.current,
+            soc=self.soc,
+            capacity=self.capacity,
+            capacity_remain=self.capacity_remain,
+            cycles=self.cycles,
+            total_ah_drawn=self.total_ah_drawn,
+            charge_fet=self.charge_fet,
+            discharge_fet=self.discharge_fet,
+            temp=self.get_temp(),
+            min_temp=self.get_min_temp(),
+            max_temp=self.get_max_temp(),
+            temp_internal=self.temp_internal,
+            cell_voltages=tuple(cell.voltage for cell in cells),
+            min_cell_desc=self.get_min_cell_desc(),
+            max_cell_desc=self.get_max_cell_desc(),
+            min_cell_voltage=self.get_min_cell_voltage(),
+            max_cell_voltage=self.get_max_cell_voltage(),
+            balancing=self.get_balancing(),
+            connected=self.get_connected(),
+            modules_online=self.get_modules_online(),
+            modules_offline=self.get_modules_offline(),
+            modules_blocking_charge=self.get_modules_blocking_charge(),
+            modules_blocking_discharge=self.get_modules_blocking_discharge(),
+            protection=Alarms(*[getattr(protection, name) for name in Alarms._fields]),
+            internal=tuple(internal.items()) if internal and TIER_SLOW in self.refreshed_tiers else None,
+            control_voltage=self.control_voltage,
+            control_charge_current=self.control_charge_current,
+            control_discharge_current=self.control_discharge_current,
+            control_allow_charge=self.control_allow_charge,
+            control_allow_discharge=self.control_allow_discharge)
+        return self.snapshot
+
+    def snapshot_control(self):
+        # Add the charge limits manage_charge_current() made from the snapshot to it
+        self.snapshot = self.snapshot._replace(
+            modules_blocking_charge=self.get_modules_blocking_charge(),
+            control_voltage=self.control_voltage,
+            control_charge_current=self.control_charge_current,
+            control_discharge_current=self.control_discharge_current,
+            control_allow_charge=self.control_allow_charge,
+            control_allow_discharge=self.control_allow_discharge)
+        return self.snapshot
+
+    def snapshot_offline(self):
+        # The last values again, as those of a unit that stopped answering
+        self.connected = False
+        return self.take_snapshot()
 
     def to_temp(self, sensor, value):
         # Keep the temp value between -20 and 100 to handle sensor issues or no data.
@@ -111,13 +353,16 @@ class Battery(object):
         return max((1 - (value - threshold)/(max_value - threshold)), 0.0)
 
     def manage_charge_current(self):
-
-        temp = self.get_min_temp()
+        # Works on the values of the last snapshot, which the driver cannot change meanwhile
+        snapshot = self.snapshot
+        temp = snapshot.min_temp
+        soc = snapshot.soc
+        voltage = snapshot.voltage
         # Start with the current values
-        max_cell_voltage = self.get_max_cell_voltage() or None
-        min_cell_voltage = self.get_min_cell_voltage() or None
+        max_cell_voltage = snapshot.max_cell_voltage or None
+        min_cell_voltage = snapshot.min_cell_voltage or None
         if (max_cell_voltage is None or min_cell_voltage is None or
-                self.soc is None or self.voltage is None):
+                soc is None or voltage is None):
             self.control_charge_current = 0
             self.control_discharge_current = 0
             self.control_allow_charge = False
@@ -126,23 +371,23 @@ class Battery(object):
             return
         # our input data
         logger.debug('SoC %d, Cells %.3fV-%.3fV, Pack %.2fV' % (
-            self.soc, min_cell_voltage, max_cell_voltage, self.voltage))
+            soc, min_cell_voltage, max_cell_voltage, voltage))
 
-        cell_limiter = self.max_battery_voltage_warning / self.cell_count
-        cell_limiter_hi = self.max_battery_voltage / self.cell_count
-        cell_limiter_lo_warn = self.min_battery_voltage_warning / self.cell_count
-        cell_limiter_lo = self.min_battery_voltage / self.cell_count
+        cell_limiter = snapshot.max_battery_voltage_warning / snapshot.cell_count
+        cell_limiter_hi = snapshot.max_battery_voltage / snapshot.cell_count
+        cell_limiter_lo_warn = snapshot.min_battery_voltage_warning / snapshot.cell_count
+        cell_limiter_lo = snapshot.min_battery_voltage / snapshot.cell_count
 
         limits = dict(
             cell = self.linear(
                 max_cell_voltage, cell_limiter, cell_limiter_hi),
             pack = self.linear(
-                self.voltage, self.max_battery_voltage_warning,
-                self.max_battery_voltage),
-            soc = self.linear(self.soc, 95.0, 100.0)
+                voltage, snapshot.max_battery_voltage_warning,
+                snapshot.max_battery_voltage),
+            soc = self.linear(soc, 95.0, 100.0)
         )
         for k, v in limits.items():
-            limits[k] = utils.cc_t_curve(v * self.max_battery_current, temp)
+            limits[k] = utils.cc_t_curve(v * snapshot.max_battery_current, temp)
 
         old_charge_current = self.control_charge_current or 0.0
         self.control_charge_current = (min(limits['cell'], max(
@@ -159,13 +404,13 @@ class Battery(object):
                 -1*cell_limiter_lo_warn,
                 -1*cell_limiter_lo),
             pack = self.linear(
-                -1*self.voltage,
-                -1*self.min_battery_voltage_warning,
-                -1*self.min_battery_voltage),
-            soc = self.linear(-1*self.soc, -10.0, -20.0)
+                -1*voltage,
+                -1*snapshot.min_battery_voltage_warning,
+                -1*snapshot.min_battery_voltage),
+            soc = self.linear(-1*soc, -10.0, -20.0)
         )
         for k, v in limits.items():
-            limits[k] = utils.dc_t_curve(v * self.max_battery_discharge_current, temp)
+            limits[k] = utils.dc_t_curve(v * snapshot.max_battery_discharge_current, temp)
 
         old_discharge_current = self.control_discharge_current or 0.0
         self.control_discharge_current = (min(limits['cell'], max(
@@ -181,39 +426,52 @@ class Battery(object):
             self.control_discharge_current))
 
         voltage_cell_headroom = max(0, cell_limiter_hi - max_cell_voltage) * 0.9
-        max_voltage = round(self.voltage + voltage_cell_headroom, 2)
+        max_voltage = round(voltage + voltage_cell_headroom, 2)
         self.control_voltage = max_voltage
         logger.info('Max Voltage: Cell %.3f, Limit %.3f, Pack %.2f -> %.2fV',
                     max_cell_voltage,
                     cell_limiter_hi,
-                    self.voltage,
+                    voltage,
                     max_voltage)
                     
            
 
-    def get_min_cell(self):
-        min_voltage = 9999
-        min_cell = None
-        if len(self.cells) == 0 and hasattr(self, 'cell_min_no'):
-            return self.cell_min_no
+    def update_cell_summary(self):
+        # Scan the cells once per poll, right after refresh_data(). The cell getters,
+        # manage_charge_current() and the dbus publishing all read the result. Cells that
+        # were not read are skipped, drivers without cell voltages (Daly, ANT) report the
+        # min and max cell their BMS sends.
+        summary = CellSummary()
+        cells = self.cells
+        count = min(len(cells), self.cell_count or 0)
+        voltages = cells.voltages if count == len(cells) else cells.voltages[:count]
+        read = [v for v in voltages if v] if 0 in voltages else voltages
+        if read:
+            min_mv = min(read)
+            max_mv = max(read)
+            summary.min_no = voltages.index(min_mv)
+            summary.max_no = voltages.index(max_mv)
+            summary.min_voltage = min_mv / 1000
+            summary.max_voltage = max_mv / 1000
+            summary.delta = (max_mv - min_mv) / 1000
+            summary.total = sum(read) / 1000
+            summary.mean = summary.total / len(read)
+        elif len(cells) == 0:
+            summary.min_no = getattr(self, 'cell_min_no', None)
+            summary.max_no = getattr(self, 'cell_max_no', None)
+            summary.min_voltage = getattr(self, 'cell_min_voltage', None)
+            summary.max_voltage = getattr(self, 'cell_max_voltage', None)
+            if summary.min_voltage is not None and summary.max_voltage is not None:
+                summary.delta = summary.max_voltage - summary.min_voltage
+        summary.balancing = 1 if self.balancing is not None or cells.balance & ((1 << count) - 1) else 0
+        self.cell_summary = summary
+        return summary
 
-        for c in range(min(len(self.cells), self.cell_count)):
-            if self.cells[c].voltage is not None and min_voltage > self.cells[c].voltage:
-                min_voltage = self.cells[c].voltage
-                min_cell = c
-        return min_cell
+    def get_min_cell(self):
+        return self.cell_summary.min_no
 
     def get_max_cell(self):
-        max_voltage = 0
-        max_cell = None
-        if len(self.cells) == 0 and hasattr(self, 'cell_max_no'):
-            return self.cell_max_no
-
-        for c in range(min(len(self.cells), self.cell_count)):
-            if self.cells[c].voltage is not None and max_voltage < self.cells[c].voltage:
-                max_voltage = self.cells[c].voltage
-                max_cell = c
-        return max_cell
+        return self.cell_summary.max_no
 
     def get_min_cell_desc(self):
         cell_no = self.get_min_cell()
@@ -228,32 +486,28 @@ class Battery(object):
         return 'C' + str(cell_no + 1)
 
     def get_min_cell_voltage(self):
-        min_voltage = 9999
-        if len(self.cells) == 0 and hasattr(self, 'cell_min_voltage'):
-            return self.cell_min_voltage
-
-        for c in range(min(len(self.cells), self.cell_count)):
-            if self.cells[c].voltage is not None and min_voltage > self.cells[c].voltage:
-                min_voltage = self.cells[c].voltage
-        return None if min_voltage == 9999 else min_voltage
+        return self.cell_summary.min_voltage
 
     def get_max_cell_voltage(self):
-        max_voltage = 0
-        if len(self.cells) == 0 and hasattr(self, 'cell_max_voltage'):
-            return self.cell_max_voltage
-
-        for c in range(min(len(self.cells), self.cell_count)):
-            if self.cells[c].voltage is not None and max_voltage < self.cells[c].voltage:
-                max_voltage = self.cells[c].voltage
-        return None if max_voltage == 0 else max_voltage
+        return self.cell_summary.max_voltage
 
     def get_balancing(self):
-        if self.balancing is not None:
-            return 1
-        for c in range(min(len(self.cells), self.cell_count)):
-            if self.cells[c].balance is not None and self.cells[c].balance:
-                return 1
-        return 0
+        return self.cell_summary.balancing
+
+    def get_connected(self):
+        return 1 if self.connected else 0
+
+    def get_modules_online(self):
+        return 1 if self.connected else 0
+
+    def get_modules_offline(self):
+        return 0 if self.connected else 1
+
+    def get_modules_blocking_charge(self):
+        return 0 if self.charge_fet is None or (self.charge_fet and self.control_allow_charge) else 1
+
+    def get_modules_blocking_discharge(self):
+        return 0 if self.discharge_fet is None or self.discharge_fet else 1
 
     def get_temp(self):
         if self.temp1 is not None and self.temp2 is not None:
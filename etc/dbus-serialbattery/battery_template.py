@@ -29,15 +29,18 @@ class BatteryTemplate(Battery):
         self.max_battery_discharge_current = MAX_BATTERY_DISCHARGE_CURRENT
         self.max_battery_voltage = MAX_CELL_VOLTAGE * self.cell_count
         self.min_battery_voltage = MIN_CELL_VOLTAGE * self.cell_count
+        self.max_battery_voltage_warning = MAX_CELL_VOLTAGE_WARNING * self.cell_count
+        self.min_battery_voltage_warning = MIN_CELL_VOLTAGE_WARNING * self.cell_count
         return True
 
     def refresh_data(self):
         # call all functions that will refresh the battery data.
         # This will be called for every iteration (1 second)
-        # Return True if success, False for failure
+        # Return True if success, False for failure, through finish_refresh() which
+        # takes the snapshot of the poll
         result = self.read_soc_data()
 
-        return result
+        return self.finish_refresh(result)
 
     def read_status_data(self):
         status_data = self.read_serial_data_template(self.command_status)
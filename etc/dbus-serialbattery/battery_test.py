@@ -0,0 +1,229 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+try:
+    import tracemalloc
+except ImportError:
+    # New in Python 3.4, the allocation tests are skipped without it
+    tracemalloc = None
+import unittest
+from array import array
+import utils
+from battery import Battery, Cell, CellStore, TIER_FAST, TIER_MEDIUM, TIER_SLOW
+
+
+class TieredBattery(Battery):
+
+    def __init__(self):
+        super(TieredBattery, self).__init__('/dev/null', 9600)
+        self.reads = []
+        self.fail = set()
+
+    def refresh_reads(self):
+        return [(tier, lambda tier=tier: self.read(tier)) for tier in (TIER_FAST, TIER_MEDIUM, TIER_SLOW)]
+
+    def read(self, tier):
+        self.reads.append(tier)
+        return tier not in self.fail
+
+
+class TestTieredPolling(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.monotonic = utils.monotonic
+        utils.monotonic = lambda: self.now
+        self.battery = TieredBattery()
+
+    def tearDown(self):
+        utils.monotonic = self.monotonic
+
+    def poll(self, seconds):
+        self.battery.reads = []
+        self.now += seconds
+        return self.battery.refresh_data()
+
+    def test_tiers_at_their_own_cadence(self):
+        self.assertTrue(self.poll(0))
+        self.assertEqual(self.battery.reads, [TIER_FAST, TIER_MEDIUM, TIER_SLOW])
+        self.poll(1)
+        self.assertEqual(self.battery.reads, [TIER_FAST])
+        self.assertEqual(self.battery.refreshed_tiers, (TIER_FAST,))
+        self.poll(utils.TIER_MEDIUM_INTERVAL)
+        self.assertEqual(self.battery.reads, [TIER_FAST, TIER_MEDIUM])
+        self.poll(utils.TIER_SLOW_INTERVAL)
+        self.assertEqual(self.battery.reads, [TIER_FAST, TIER_MEDIUM, TIER_SLOW])
+
+    def test_failed_tier_is_read_again(self):
+        self.battery.fail.add(TIER_SLOW)
+        self.assertFalse(self.poll(0))
+        self.battery.fail.clear()
+        self.assertTrue(self.poll(1))
+        self.assertEqual(self.battery.reads, [TIER_FAST, TIER_MEDIUM, TIER_SLOW])
+
+    def test_ends_with_a_snapshot(self):
+        self.battery.voltage = 13.2
+        self.poll(0)
+        self.assertEqual(self.battery.snapshot.voltage, 13.2)
+        self.assertEqual(self.battery.snapshot.refreshed_tiers, (TIER_FAST, TIER_MEDIUM, TIER_SLOW))
+        # Also when a read failed, with the values there are
+        self.battery.voltage = 13.3
+        self.battery.fail.add(TIER_FAST)
+        self.assertFalse(self.poll(1))
+        self.assertEqual(self.battery.snapshot.voltage, 13.3)
+
+
+class TestCellStore(unittest.TestCase):
+
+    def test_voltage_and_balance(self):
+        cells = CellStore(3)
+        self.assertIsNone(cells[0].voltage)
+        cells[1].voltage = 3.301
+        cells[2].balance = True
+        self.assertEqual(list(cells.voltages), [0, 3301, 0])
+        self.assertEqual(cells[1].voltage, 3.301)
+        self.assertEqual([cell.balance for cell in cells], [False, False, True])
+        cells[1].voltage = False
+        self.assertIsNone(cells[-2].voltage)
+        with self.assertRaises(IndexError):
+            cells[3]
+
+    def test_resize(self):
+        cells = CellStore()
+        cell = Cell(True)
+        cell.voltage = 3.2
+        cells.append(cell)
+        cells.resize(4)
+        cells[3].balance = True
+        cells.resize(2)
+        self.assertEqual(cells.balance, 1)
+        cells.resize(4)
+        self.assertEqual(list(cells.voltages), [3200, 0, 0, 0])
+        self.assertFalse(cells[3].balance)
+
+    def test_views_are_reused(self):
+        cells = CellStore(16)
+        views = list(cells)
+        cells.resize(8)
+        cells.resize(16)
+        self.assertTrue(all(a is b for a, b in zip(views, cells)))
+
+    @unittest.skipIf(tracemalloc is None, 'needs tracemalloc')
+    def test_no_allocation_per_poll(self):
+        battery = Battery('/dev/null', 9600)
+        battery.cell_count = 16
+        battery.cells.resize(16)
+
+        def poll(n):
+            for c, cell in enumerate(battery.cells):
+                cell.voltage = 3.2 + (n + c) % 100 / 1000
+                cell.balance = (n + c) % 2
+            return battery.update_cell_summary()
+
+        tracemalloc.start()
+        try:
+            poll(0)
+            before = tracemalloc.get_traced_memory()[0]
+            for n in range(1000):
+                poll(n)
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(after - before, 1024)
+
+
+class TestCellSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.battery = Battery('/dev/null', 9600)
+        self.battery.cell_count = 4
+        self.battery.cells.resize(4)
+
+    def test_summary(self):
+        self.battery.cells.voltages[:] = array('H', [3301, 3290, 3312, 3290])
+        self.battery.cells[2].balance = True
+        summary = self.battery.update_cell_summary()
+        self.assertEqual((summary.min_no, summary.max_no), (1, 2))
+        self.assertEqual((summary.min_voltage, summary.max_voltage), (3.29, 3.312))
+        self.assertAlmostEqual(summary.delta, 0.022)
+        self.assertAlmostEqual(summary.total, 13.193)
+        self.assertAlmostEqual(summary.mean, 13.193 / 4)
+        self.assertEqual(self.battery.get_min_cell_desc(), 'C2')
+        self.assertEqual(self.battery.get_max_cell_voltage(), 3.312)
+        self.assertEqual(self.battery.get_balancing(), 1)
+
+    def test_cells_not_read(self):
+        self.battery.cells[1].voltage = 3.3
+        self.battery.cells[3].voltage = 3.2
+        summary = self.battery.update_cell_summary()
+        self.assertEqual((summary.min_no, summary.max_no), (3, 1))
+        self.assertAlmostEqual(summary.mean, 3.25)
+        self.assertEqual(summary.balancing, 0)
+
+    def test_cells_above_cell_count(self):
+        self.battery.cells.voltages[:] = array('H', [3300, 3300, 3300, 2000])
+        self.battery.cells[3].balance = True
+        self.battery.cell_count = 3
+        summary = self.battery.update_cell_summary()
+        self.assertEqual(summary.min_voltage, 3.3)
+        self.assertEqual(summary.balancing, 0)
+
+    def test_min_and_max_from_the_bms(self):
+        battery = Battery('/dev/null', 9600)
+        battery.cell_count = 4
+        battery.cell_min_no, battery.cell_min_voltage = 2, 3.28
+        battery.cell_max_no, battery.cell_max_voltage = 0, 3.31
+        summary = battery.update_cell_summary()
+        self.assertEqual(battery.get_min_cell_desc(), 'C3')
+        self.assertAlmostEqual(summary.delta, 0.03)
+        self.assertIsNone(summary.mean)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.battery = Battery('/dev/null', 9600)
+        self.battery.cell_count = 4
+        self.battery.cells.resize(4)
+        for cell in self.battery.cells:
+            cell.voltage = 3.3
+        self.battery.voltage = 13.2
+        self.battery.current = 10.0
+        self.battery.soc = 50
+        self.battery.temp1 = 20
+        self.battery.max_battery_current = self.battery.max_battery_discharge_current = 100.0
+        self.battery.max_battery_voltage = self.battery.max_battery_voltage_warning = 14.2
+        self.battery.min_battery_voltage = self.battery.min_battery_voltage_warning = 12.2
+        self.battery.update_cell_summary()
+
+    def test_values_of_one_poll(self):
+        snapshot = self.battery.take_snapshot()
+        self.battery.voltage = 13.6
+        self.battery.cells[0].voltage = 3.4
+        self.battery.protection.soc_low = 2
+        self.assertEqual(snapshot.voltage, 13.2)
+        self.assertEqual(snapshot.cell_voltages, (3.3, 3.3, 3.3, 3.3))
+        self.assertIsNone(snapshot.protection.soc_low)
+        self.assertIs(self.battery.snapshot, snapshot)
+        with self.assertRaises(AttributeError):
+            snapshot.voltage = 13.6
+
+    def test_charge_control_from_snapshot(self):
+        self.battery.take_snapshot()
+        # Changed by the driver after the snapshot was taken
+        self.battery.soc = None
+        self.battery.cell_count = 3
+        self.battery.max_battery_current = self.battery.max_battery_voltage = None
+        self.battery.manage_charge_current()
+        snapshot = self.battery.snapshot_control()
+        self.assertTrue(snapshot.control_allow_charge)
+        self.assertAlmostEqual(snapshot.control_charge_current, 10.0)
+        self.assertEqual(snapshot.voltage, 13.2)
+
+    def test_settings_only_when_read(self):
+        self.battery._internal = {'balancing': True}
+        self.assertEqual(self.battery.take_snapshot().internal, (('balancing', True),))
+        self.battery.refreshed_tiers = (TIER_FAST,)
+        self.assertIsNone(self.battery.take_snapshot().internal)
+
+
+if __name__ == '__main__':
+    unittest.main()
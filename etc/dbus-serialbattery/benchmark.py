@@ -0,0 +1,360 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Development benchmarks, run on a build box: python benchmark.py <name> [options]
+# Not part of the installed driver.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import importlib
+import logging
+import subprocess
+import sys
+import time
+import tracemalloc
+from struct import unpack_from
+
+import serial
+import utils
+from serialport import serial_ports
+from framer import Framer
+from capture import READ, read_capture
+from emulator import EMULATORS, LltJbdEmulator, JkbmsEmulator
+
+
+LLT_REQUEST = b"\xDD\xA5\x03\x00\xFF\xFD\x77"
+
+# Driver module, class and constructor arguments per emulator name, as dbus-serialbattery.py creates them
+DRIVERS = {
+    'lltjbd': ('lltjbd', 'LltJbd', {'baud': 9600}),
+    'daly': ('daly', 'Daly', {'baud': 9600, 'address': b"\x40"}),
+    'jkbms': ('jkbms', 'Jkbms', {'baud': 115200}),
+    'sinowealth': ('sinowealth', 'Sinowealth', {'baud': 9600}),
+}
+
+
+class SilentEmulator(LltJbdEmulator):
+    # A BMS that never answers
+
+    def reply(self, request):
+        return None
+
+
+def legacy_read_serial_data(command, port, baud, length_pos, length_check, length_fixed=None, length_size=None):
+    # read_serial_data as it was before the select() based receive path, kept for comparison
+    try:
+        with serial.Serial(port, baudrate=baud, timeout=0.1) as ser:
+            ser.flushOutput()
+            ser.flushInput()
+            ser.write(command)
+
+            count = 0
+            toread = ser.inWaiting()
+            while toread < (length_pos+1):
+                time.sleep(0.005)
+                toread = ser.inWaiting()
+                count += 1
+                if count > 50:
+                    return False
+            res = ser.read(toread)
+            if len(res) < length_pos and length_fixed is None:
+                return False
+            length_size = length_size if length_size is not None else 'B'
+            length = length_fixed if length_fixed is not None else unpack_from(length_size, res, length_pos)[0]
+
+            count = 0
+            data = bytearray(res)
+            while len(data) <= length + length_check:
+                res = ser.read(length + length_check)
+                data.extend(res)
+                time.sleep(0.005)
+                count += 1
+                if count > 150:
+                    return False
+            return data
+    except serial.SerialException:
+        return False
+
+
+def legacy_jkbms_parse(status_data):
+    # Jkbms parsing as it was before the register index: search each register id from the
+    # start of the reply and cut it out with its value, kept for comparison
+    from jkbms import Jkbms
+
+    def get_data(idcode, length):
+        start = status_data.find(idcode)
+        if start < 0: return False
+        ret = status_data[start+1:start+length+1]
+        del status_data[start:start+length+1]
+        return ret
+
+    cellbyte_count = unpack_from('>B', get_data(b'\x79', 1))[0]
+    cells = []
+    for _ in range(cellbyte_count // 3):
+        cells.append(unpack_from('>xH', status_data)[0])
+        del status_data[:3]
+    values = {}
+    for register in sorted(Jkbms.REGISTERS):
+        if register <= 0xB9:
+            decoder = Jkbms.REGISTERS[register]
+            values[register] = decoder.unpack(get_data(bytearray([register]), decoder.size))[0]
+    return cells, values
+
+
+def jkbms_parse(status_data):
+    # The same values through Jkbms.index_registers()
+    from jkbms import Jkbms
+    index = Jkbms.index_registers(status_data)
+    offset = index[Jkbms.CELL_VOLTAGES]
+    cells = [Jkbms.CELL.unpack_from(status_data, offset + 1 + 3 * c)[0] for c in range(status_data[offset] // 3)]
+    values = {}
+    for register in sorted(Jkbms.REGISTERS):
+        if register <= 0xB9:
+            values[register] = Jkbms.REGISTERS[register].unpack_from(status_data, index[register])[0]
+    return cells, values
+
+
+def run_timed(func, count):
+    wall, cpu = [], []
+    for _ in range(count):
+        w, c = time.time(), time.thread_time()
+        func()
+        wall.append(time.time() - w)
+        cpu.append(time.thread_time() - c)
+    return wall, cpu
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def report(name, wall, cpu):
+    print('%-24s n=%-5d wall p50 %7.2fms p95 %7.2fms p99 %7.2fms   cpu mean %6.3fms' % (
+        name, len(wall), percentile(wall, 50) * 1000, percentile(wall, 95) * 1000,
+        percentile(wall, 99) * 1000, sum(cpu) / len(cpu) * 1000))
+
+
+def reset_peak():
+    # Start a new tracemalloc peak, returns the memory traced now. tracemalloc.reset_peak()
+    # is new in Python 3.9. Before it the trace is restarted instead, which also forgets what
+    # was allocated earlier: memory freed by a later stage is then still counted as retained.
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def report_allocations(name, peak, retained):
+    print('%-24s n=%-5d alloc peak mean %8.1fKiB max %8.1fKiB   retained mean %+8.3fKiB' % (
+        name, len(peak), sum(peak) / len(peak) / 1024.0, max(peak) / 1024.0, sum(retained) / len(retained) / 1024.0))
+
+
+def bench_rx(args):
+    # Compare the polling receive loop with the select() based one on a pty,
+    # once with a BMS that answers and once with one that stays silent.
+    for label, emulator_class in (('reply', LltJbdEmulator), ('no reply', SilentEmulator)):
+        emulator = emulator_class(cells=args.cells, latency=args.latency / 1000.0, paced=bool(args.baud))
+        emulator.BAUD = args.baud
+        port = emulator.start()
+
+        count = args.count if label == 'reply' else max(1, args.count // 20)
+        for name, read in (('legacy', legacy_read_serial_data), ('select', utils.read_serial_data)):
+            wall, cpu = run_timed(lambda: read(LLT_REQUEST, port, 9600, 3, 6), count)
+            report('%s (%s)' % (name, label), wall, cpu)
+        serial_ports.close_all()
+        emulator.stop()
+
+
+def bench_poll(args):
+    # Time the stages of DbusHelper.publish_battery for a driver against its emulator, or against
+    # a capture file with --replay. Needs dbus-python and velib_python: run it on the GX, or under
+    # dbus-run-session on a build box. A bus connection exports the object paths of only one
+    # service, so without --bms every driver is run in a process of its own.
+    if args.bms is None:
+        if args.replay:
+            print('--replay needs --bms')
+            return 1
+        for name in sorted(DRIVERS):
+            subprocess.call([sys.executable, __file__] + sys.argv[1:] + ['--bms', name])
+        return 0
+
+    from dbushelper import DbusHelper
+
+    class BenchmarkHelper(DbusHelper):
+        # Leaves the device instance in localsettings alone, there may be no localsettings
+        def setup_instance(self):
+            self.battery.role, self.battery.instance = 'battery', self.instance
+
+    module, class_name, kwargs = DRIVERS[args.bms]
+    driver_class = getattr(importlib.import_module(module), class_name)
+    emulator = None
+    if args.replay:
+        # Replies arrive as late as they did when the capture was recorded
+        serial_ports.replay_realtime = True
+        port = 'replay:' + args.replay
+    else:
+        emulator = EMULATORS[args.bms](cells=args.cells, latency=args.latency / 1000.0, paced=bool(args.baud))
+        port = emulator.start()
+
+    battery = driver_class(port=port, **kwargs)
+    if not battery.test_connection():
+        print('%s does not answer on %s' % (class_name, port))
+        return 1
+    # 'test' publishes as com.victronenergy.test_battery.test, which systemcalc ignores
+    helper = BenchmarkHelper(battery, 'test')
+    if not helper.setup_vedbus():
+        print('%s settings could not be read' % class_name)
+        return 1
+
+    # The same order as DbusHelper.publish_battery, refresh_data ends with the cell summary and
+    # the snapshot. One untimed poll first, it adds the cell and setting paths to the service.
+    stages = (
+        ('refresh_data', battery.refresh_data),
+        ('manage_charge_current', battery.manage_charge_current),
+        ('snapshot_control', battery.snapshot_control),
+        ('publish_dbus', helper.publish_dbus),
+    )
+    for _, func in stages:
+        func()
+    names = [name for name, _ in stages] + ['poll']
+
+    print('%s, %d cells, on %s' % (class_name, battery.cell_count, port))
+    timings = dict((name, ([], [])) for name in names)
+    messages, values = helper.dbus_messages, helper.dbus_values
+    for _ in range(args.count):
+        poll_wall = poll_cpu = 0
+        for name, func in stages:
+            w, c = time.time(), time.thread_time()
+            func()
+            wall, cpu = time.time() - w, time.thread_time() - c
+            timings[name][0].append(wall)
+            timings[name][1].append(cpu)
+            poll_wall += wall
+            poll_cpu += cpu
+        timings['poll'][0].append(poll_wall)
+        timings['poll'][1].append(poll_cpu)
+    for name in names:
+        report(name, *timings[name])
+    print('%-24s n=%-5d messages %.1f values %.1f per poll' % (
+        'dbus', args.count, (helper.dbus_messages - messages) / args.count,
+        (helper.dbus_values - values) / args.count))
+
+    # Allocations in a second pass, tracing slows down the timed one: the peak of memory
+    # allocated by a stage and what is still allocated after it
+    allocations = dict((name, ([], [])) for name in names)
+    tracemalloc.start()
+    for _ in range(args.count):
+        poll_peak = poll_retained = 0
+        for name, func in stages:
+            start = reset_peak()
+            func()
+            current, peak = tracemalloc.get_traced_memory()
+            allocations[name][0].append(peak - start)
+            allocations[name][1].append(current - start)
+            poll_peak = max(poll_peak, poll_retained + peak - start)
+            poll_retained += current - start
+        allocations['poll'][0].append(poll_peak)
+        allocations['poll'][1].append(poll_retained)
+    tracemalloc.stop()
+    for name in names:
+        report_allocations(name, *allocations[name])
+
+    serial_ports.close_all()
+    if emulator is not None:
+        emulator.stop()
+    return 0
+
+
+def bench_jkparse(args):
+    # Compare the Jkbms register index with the find and cut parsing it replaced, on the
+    # emulator's status reply or on the status replies of a capture file with --replay
+    if args.replay:
+        framer = Framer(b"\x4E\x57", 2, 1, '>H')
+        for timestamp, kind, port, data in read_capture(args.replay):
+            if kind == READ:
+                framer.feed(data)
+        replies = [frame[11:-9] for frame in framer.frames() if frame[8] == 0x06]
+        if not replies:
+            print('No JKBMS status replies in %s' % args.replay)
+            return 1
+    else:
+        emulator = JkbmsEmulator(cells=args.cells)
+        replies = [emulator.frame(b''.join(bytearray([register]) + value
+                                           for register, value in emulator.registers()))[11:-9]]
+
+    for reply in replies:
+        if legacy_jkbms_parse(bytearray(reply)) != jkbms_parse(bytearray(reply)):
+            print('Parsers disagree on %r' % reply)
+    print('%d status replies of %d bytes' % (len(replies), len(replies[0])))
+    for name, parse in (('legacy', legacy_jkbms_parse), ('index', jkbms_parse)):
+        # Both get a fresh copy, the legacy one cuts up its reply
+        copies = [bytearray(reply) for _ in range(args.count) for reply in replies]
+        wall, cpu = run_timed(lambda: parse(copies.pop()), len(copies))
+        report(name, wall, cpu)
+    return 0
+
+
+def bench_jkread(args):
+    # Compare a fast poll of the Jkbms volatile registers, one single register request each,
+    # with the read all it replaces: bytes on the wire and round trip time against the emulator
+    from jkbms import Jkbms
+
+    emulator = JkbmsEmulator(cells=args.cells, latency=args.latency / 1000.0, paced=bool(args.baud))
+    battery = Jkbms(port=emulator.start(), baud=emulator.BAUD)
+    if not battery.test_connection():
+        print('Jkbms does not answer on %s' % battery.port)
+        return 1
+
+    print('Jkbms, %d cells, %d baud' % (args.cells, emulator.BAUD))
+    cases = (
+        ('read all', [battery.command_status], battery.read_status_data),
+        ('selective', [battery._register_commands[register] for register in Jkbms.VOLATILE_REGISTERS],
+         battery.read_volatile_data),
+    )
+    for name, commands, read in cases:
+        sent = sum(len(command) for command in commands)
+        received = sum(len(emulator.reply(command)) for command in commands)
+        # 10 bits per byte, without the BMS turnaround of each request
+        print('%-24s %d requests, %d bytes out, %d bytes in, %.2fms on the wire' % (
+            name, len(commands), sent, received, (sent + received) * 10.0 / emulator.BAUD * 1000))
+    for name, commands, read in cases:
+        wall, cpu = run_timed(read, args.count)
+        report(name, wall, cpu)
+    serial_ports.close_all()
+    emulator.stop()
+    return 0
+
+
+BENCHMARKS = {
+    'rx': bench_rx,
+    'poll': bench_poll,
+    'jkparse': bench_jkparse,
+    'jkread': bench_jkread,
+}
+
+
+def main():
+    # time.thread_time() is new in Python 3.7
+    if sys.version_info < (3, 7):
+        print('benchmark.py needs Python 3.7 or later')
+        return 1
+    parser = argparse.ArgumentParser(description='dbus-serialbattery benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--count', type=int, default=200, help='iterations per case')
+    parser.add_argument('--cells', type=int, default=16, help='number of cells of the emulated BMS')
+    parser.add_argument('--latency', type=float, default=5.0, help='emulated BMS reply latency in ms')
+    parser.add_argument('--baud', type=int, default=9600,
+                        help='emulated wire speed of rx, 0 to send replies at once (poll: at the BMS baud rate or at once)')
+    parser.add_argument('--bms', choices=sorted(DRIVERS), help='poll: driver to run, default all of them')
+    parser.add_argument('--replay', help='poll: answer from this capture file instead of an emulator, '
+                                         'jkparse: parse its replies')
+    args = parser.parse_args()
+    # The no reply cases would otherwise log an error per command
+    logging.disable(logging.CRITICAL)
+    return BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
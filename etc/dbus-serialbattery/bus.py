@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+from serialport import serial_ports
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class BusScheduler(object):
+    # Polls several addressed BMS sharing one RS485 line, one after the other in a round
+    # robin cycle, so there is only ever one request on the wire. Every unit's refresh has
+    # its own reply timeouts. A unit that did not answer is asked again after 1, 2, 4 ...
+    # up to max_backoff cycles, so a dead unit does not cost the others a timeout per cycle.
+    #
+    # publish(unit) polls and publishes one unit and returns whether it answered.
+    # offline(unit), if given, is called when a unit stops answering, so it can be shown
+    # offline while it is left out. Its next publish() that answers shows it online again.
+
+    def __init__(self, port, units, publish, max_backoff=16, offline=None):
+        self.port = port
+        self.units = units
+        self.publish = publish
+        self.offline = offline
+        self.max_backoff = max_backoff
+        self.failures = dict((unit, 0) for unit in units)
+        self.skip = dict((unit, 0) for unit in units)
+
+    def poll(self):
+        for unit in self.units:
+            if self.skip[unit]:
+                self.skip[unit] -= 1
+                continue
+            if self.publish(unit):
+                if self.failures[unit]:
+                    logger.info('Unit %d on %s answers again' % (self.units.index(unit), self.port))
+                self.failures[unit] = 0
+                continue
+
+            self.failures[unit] += 1
+            self.skip[unit] = min(2 ** (self.failures[unit] - 1), self.max_backoff) - 1
+            if self.failures[unit] == 1 and self.offline is not None:
+                self.offline(unit)
+            # A late reply must not be taken for the next unit's
+            serial_ports.flush_input(self.port)
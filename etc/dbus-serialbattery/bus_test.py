@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import unittest
+from bus import BusScheduler
+
+
+class TestBusScheduler(unittest.TestCase):
+
+    def test_dead_unit_backs_off(self):
+        polled = []
+        answering = {'a': True, 'b': False, 'c': True}
+
+        def publish(unit):
+            polled.append(unit)
+            return answering[unit]
+
+        bus = BusScheduler('/dev/null', ['a', 'b', 'c'], publish, max_backoff=4)
+        for _ in range(12):
+            bus.poll()
+        self.assertEqual(polled.count('a'), 12)
+        self.assertEqual(polled.count('c'), 12)
+        # Asked after 1, 2, 4, 4 ... cycles
+        self.assertEqual(polled.count('b'), 5)
+
+        answering['b'] = True
+        for _ in range(8):
+            bus.poll()
+        self.assertEqual(bus.failures['b'], 0)
+        self.assertEqual(bus.skip['b'], 0)
+
+    def test_offline_once_per_outage(self):
+        offline = []
+        answering = {'a': True, 'b': False}
+        bus = BusScheduler('/dev/null', ['a', 'b'], lambda unit: answering[unit], max_backoff=4,
+                           offline=offline.append)
+        for _ in range(6):
+            bus.poll()
+        self.assertEqual(offline, ['b'])
+
+        answering['b'] = True
+        for _ in range(4):
+            bus.poll()
+        answering['b'] = False
+        for _ in range(2):
+            bus.poll()
+        self.assertEqual(offline, ['b', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import threading
+from struct import Struct
+from time import sleep
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Capture file layout: FILE_MAGIC, then one RECORD header plus payload per event.
+# A PORT record (payload: port name) assigns the port number used by the records after it,
+# WRITE and READ records hold the bytes written to and read from that port.
+FILE_MAGIC = b'SBCAP\x01'
+RECORD = Struct('<dBBH')  # monotonic time, kind, port number, payload length
+PORT = 0
+WRITE = 1
+READ = 2
+
+
+class CaptureWriter(object):
+    # Appends serial traffic of any number of ports to one capture file
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(FILE_MAGIC)
+        self._ports = {}
+        self._lock = threading.Lock()
+
+    def record(self, port, kind, data):
+        if not data:
+            return
+        with self._lock:
+            if port not in self._ports:
+                self._ports[port] = len(self._ports)
+                self._write(PORT, self._ports[port], port.encode('utf-8'))
+            self._write(kind, self._ports[port], data)
+
+    def _write(self, kind, number, data):
+        self._file.write(RECORD.pack(monotonic(), kind, number, len(data)))
+        self._file.write(bytes(data))
+        self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class RecordingSerial(object):
+    # Wraps an open serial.Serial and records everything written to and read from it
+
+    # read_exactly() reads the file descriptor of a port itself, this one goes through read()
+    fileno = None
+
+    def __init__(self, ser, port, writer):
+        self._ser = ser
+        self._port = port
+        self._writer = writer
+
+    def write(self, data):
+        self._writer.record(self._port, WRITE, data)
+        return self._ser.write(data)
+
+    def read(self, size=1):
+        data = self._ser.read(size)
+        self._writer.record(self._port, READ, data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._ser, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._ser, name, value)
+
+
+def read_capture(path):
+    # Yields (time, kind, port name, data) for every WRITE and READ record in the file
+    ports = {}
+    with open(path, 'rb') as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, kind, number, length = RECORD.unpack(header)
+            data = f.read(length)
+            if kind == PORT:
+                ports[number] = data.decode('utf-8')
+            else:
+                yield timestamp, kind, ports.get(number), data
+
+
+class ReplaySerial(object):
+    # Stands in for serial.Serial and answers from a capture file. A write() is matched
+    # against the next recorded write with the same bytes, then the reads recorded after it
+    # become available to read(). The capture wraps around, so replay can run forever.
+    # With realtime set, read() waits for the reply as long as it originally took.
+
+    def __init__(self, path, port=None, realtime=False):
+        self.path = path
+        self.realtime = realtime
+        self.baudrate = None
+        self.timeout = None
+        self.is_open = True
+        records = list(read_capture(path))
+        if port is None and records:
+            port = records[0][2]
+        self.port = port
+        # [(request, [(delay after request, reply chunk), ...], request time), ...]
+        self._exchanges = []
+        for timestamp, kind, name, data in records:
+            if name != port:
+                continue
+            if kind == WRITE:
+                self._exchanges.append((bytes(data), [], timestamp))
+            elif self._exchanges:
+                self._exchanges[-1][1].append((timestamp - self._exchanges[-1][2], bytes(data)))
+        self._position = 0
+        self._input = bytearray()
+        self._pending = []
+        self._written = None
+
+    def write(self, data):
+        data = bytes(data)
+        self._apply_pending()
+        count = len(self._exchanges)
+        for i in range(count):
+            request, replies, _ = self._exchanges[(self._position + i) % count]
+            if request == data:
+                self._position = (self._position + i + 1) % count
+                self._pending = list(replies)
+                self._written = monotonic()
+                break
+        else:
+            logger.debug('No recorded reply to %r' % data)
+            self._pending = []
+        return len(data)
+
+    def read(self, size=1):
+        if self.realtime:
+            self._wait_for(size)
+        self._apply_pending(self.realtime)
+        data = bytes(self._input[:size])
+        del self._input[:size]
+        return data
+
+    def inWaiting(self):
+        self._apply_pending(self.realtime)
+        return len(self._input)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def flushInput(self):
+        self._apply_pending()
+        del self._input[:]
+
+    reset_input_buffer = flushInput
+
+    def flushOutput(self):
+        pass
+
+    reset_output_buffer = flushOutput
+
+    def close(self):
+        self.is_open = False
+
+    def _apply_pending(self, due_only=False):
+        # Move recorded reply chunks into the input buffer, optionally only those whose
+        # original delay after the request has passed
+        while self._pending:
+            delay, chunk = self._pending[0]
+            if due_only and monotonic() < self._written + delay:
+                return
+            self._input.extend(chunk)
+            self._pending.pop(0)
+
+    def _wait_for(self, size):
+        deadline = monotonic() + (self.timeout if self.timeout is not None else 1.0)
+        while len(self._input) < size and self._pending:
+            due = self._written + self._pending[0][0]
+            if due > deadline:
+                return
+            delay = due - monotonic()
+            if delay > 0:
+                sleep(delay)
+            self._input.extend(self._pending.pop(0)[1])
@@ -0,0 +1,87 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+from capture import CaptureWriter, RecordingSerial, ReplaySerial, read_capture, READ, WRITE
+
+
+class AnsweringSerial(object):
+    # Answers each write with the reply listed for it
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.input = b''
+        self.timeout = 0.1
+
+    def write(self, data):
+        self.input += self.replies[bytes(data)]
+        return len(data)
+
+    def read(self, size=1):
+        data, self.input = self.input[:size], self.input[size:]
+        return data
+
+
+class TestCapture(unittest.TestCase):
+
+    REPLIES = {b'\x01': b'\xa1\xa2\xa3', b'\x02': b'\xb1', b'\x03': b'\xc1\xc2'}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, exchanges):
+        # exchanges: [(port, request), ...], each reply is read in chunks of 2 bytes
+        writer = CaptureWriter(self.path)
+        ports = {}
+        for port, request in exchanges:
+            if port not in ports:
+                ports[port] = RecordingSerial(AnsweringSerial(self.REPLIES), port, writer)
+            ports[port].write(request)
+            while ports[port].read(2):
+                pass
+        writer.close()
+
+    def exchange(self, ser, request):
+        ser.write(request)
+        return ser.read(16)
+
+    def test_round_trip(self):
+        self.record([('/dev/ttyUSB0', b'\x01'), ('/dev/ttyUSB0', b'\x02')])
+        records = [(kind, port, data) for _, kind, port, data in read_capture(self.path)]
+        self.assertEqual(records, [
+            (WRITE, '/dev/ttyUSB0', b'\x01'), (READ, '/dev/ttyUSB0', b'\xa1\xa2'), (READ, '/dev/ttyUSB0', b'\xa3'),
+            (WRITE, '/dev/ttyUSB0', b'\x02'), (READ, '/dev/ttyUSB0', b'\xb1')])
+        ser = ReplaySerial(self.path)
+        self.assertEqual(ser.port, '/dev/ttyUSB0')
+        self.assertEqual(self.exchange(ser, b'\x01'), b'\xa1\xa2\xa3')
+        self.assertEqual(self.exchange(ser, b'\x02'), b'\xb1')
+
+    def test_loops_and_skips_unknown_requests(self):
+        self.record([('/dev/ttyUSB0', b'\x01'), ('/dev/ttyUSB0', b'\x02')])
+        ser = ReplaySerial(self.path)
+        for _ in range(3):
+            self.assertEqual(self.exchange(ser, b'\x02'), b'\xb1')
+            self.assertEqual(self.exchange(ser, b'\x01'), b'\xa1\xa2\xa3')
+        self.assertEqual(self.exchange(ser, b'\x04'), b'')
+
+    def test_port_filter(self):
+        self.record([('/dev/ttyUSB0', b'\x01'), ('/dev/ttyUSB1', b'\x03'), ('/dev/ttyUSB1', b'\x01')])
+        ser = ReplaySerial(self.path, '/dev/ttyUSB1')
+        self.assertEqual(self.exchange(ser, b'\x03'), b'\xc1\xc2')
+        self.assertEqual(self.exchange(ser, b'\x01'), b'\xa1\xa2\xa3')
+        self.assertEqual(self.exchange(ReplaySerial(self.path, '/dev/ttyUSB0'), b'\x03'), b'')
+
+    def test_not_a_capture_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a capture')
+        with self.assertRaises(ValueError):
+            list(read_capture(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
-from battery import Protection, Battery, Cell
+from battery import Protection, Battery, Cell, TIER_FAST, TIER_MEDIUM, TIER_SLOW
 from utils import *
 from struct import *
 
@@ -17,6 +17,9 @@ class Daly(Battery):
         self.cell_max_no = None
         self.poll_interval = 2000
         self.type = self.BATTERYTYPE
+        self._framer = Framer(self.FRAME_START, self.LENGTH_POS, self.LENGTH_CHECK, checksum=self.checksum_ok)
+        # Command bytes per command code, built once
+        self._commands = {}
     # command bytes [StartFlag=A5][Address=40][Command=94][DataLength=8][8x zero bytes][checksum]
     command_base = b"\xA5\x40\x94\x08\x00\x00\x00\x00\x00\x00\x00\x00\x81"
     command_soc = b"\x90"
@@ -31,24 +34,32 @@ class Daly(Battery):
     BATTERYTYPE = "Daly"
     LENGTH_CHECK = 4
     LENGTH_POS = 3
+    FRAME_START = b"\xA5"
     CURRENT_ZERO_CONSTANT = 30000
     TEMP_ZERO_CONSTANT = 40
 
     def test_connection(self):
         return self.read_status_data()
 
+    def probe(self):
+        # The reply only carries the board number, so the 0x40 and 0x80 candidates both match it
+        address = self.reply_address()
+        return self.generate_command(self.command_status), self._framer, \
+            lambda frame: frame[1] == address and frame[2] == 0x94
+
     def get_settings(self):
         self.max_battery_current = MAX_BATTERY_CURRENT
         self.max_battery_discharge_current = MAX_BATTERY_DISCHARGE_CURRENT
         return True
 
-    def refresh_data(self):
-        result = self.read_soc_data()
-        result = result and self.read_cell_voltage_range_data()
-        result = result and self.read_temperature_range_data()
-        result = result and self.read_fed_data()
-
-        return result
+    def refresh_reads(self):
+        return [
+            (TIER_FAST, self.read_soc_data),
+            (TIER_FAST, self.read_cell_voltage_range_data),
+            (TIER_FAST, self.read_fed_data),
+            (TIER_MEDIUM, self.read_temperature_range_data),
+            (TIER_SLOW, self.read_status_data),
+        ]
 
     def read_status_data(self):
         status_data = self.read_serial_data_daly(self.command_status)
@@ -61,6 +72,8 @@ class Daly(Battery):
 
         self.max_battery_voltage = MAX_CELL_VOLTAGE * self.cell_count
         self.min_battery_voltage = MIN_CELL_VOLTAGE * self.cell_count
+        self.max_battery_voltage_warning = MAX_CELL_VOLTAGE_WARNING * self.cell_count
+        self.min_battery_voltage_warning = MIN_CELL_VOLTAGE_WARNING * self.cell_count
 
         self.hardware_version = "DalyBMS " + str(self.cell_count) + " cells"
         logger.info(self.hardware_version)
@@ -115,14 +128,29 @@ class Daly(Battery):
         return True
 
     def generate_command(self, command):
-        buffer = bytearray(self.command_base)
-        buffer[1] = self.command_address   # Always serial 40 or 80
-        buffer[2] = command
-        buffer[12] = sum(buffer[:12]) & 0xFF   #checksum calc
+        buffer = self._commands.get(command)
+        if buffer is None:
+            buffer = self._commands[command] = bytearray(self.command_base)
+            buffer[1] = bytearray(self.command_address)[0]   # Always serial 40 or 80
+            buffer[2] = bytearray(command)[0]
+            buffer[12] = sum(buffer[:12]) & 0xFF   #checksum calc
         return buffer
 
+    @staticmethod
+    def checksum_ok(frame):
+        return sum(frame[:-1]) & 0xFF == frame[-1]
+
+    def reply_address(self):
+        # Replies carry the board number instead of the address asked: 1 for the first board,
+        # asked as 0x40 (UART) or 0x80 (RS485), 2 for the board at 0x41 and so on
+        return (bytearray(self.command_address)[0] & 0x3F) + 1
+
     def read_serial_data_daly(self, command):
-        data = read_serial_data(self.generate_command(command), self.port, self.baud_rate, self.LENGTH_POS, self.LENGTH_CHECK)
+        command_code = bytearray(command)[0]
+        # A late reply of another unit on the bus must not be taken for this one's
+        address = self.reply_address()
+        data = read_serial_data(self.generate_command(command), self.port, self.baud_rate, self.LENGTH_POS, self.LENGTH_CHECK,
+                                framer=self._framer, accept=lambda frame: frame[1] == address and frame[2] == command_code)
         if data is False:
             return False
 
@@ -11,10 +11,15 @@ try:
 except ImportError:
   from gi.repository import GLib as gobject
 import logging
+import serial
 import sys
 
 from dbushelper import DbusHelper
-from utils import DRIVER_VERSION, DRIVER_SUBVERSION
+from utils import DRIVER_VERSION, DRIVER_SUBVERSION, AUTODETECT_TIMEOUT, SERIAL_REPLY_TIMEOUT, SERIAL_CAPTURE, \
+    POLL_OVERRUN, AGGREGATE_BATTERY, DALY_ADDRESSES, port_identity, read_battery_type_cache, update_battery_type_cache
+from serialport import serial_ports, read_exactly, monotonic
+from poller import PollWorker
+from bus import BusScheduler
 import battery
 from lltjbd import LltJbd
 from daly import Daly
@@ -22,6 +27,7 @@ from ant import Ant
 from jkbms_mqtt import JkbmsMqtt
 from jkbms import Jkbms
 from sinowealth import Sinowealth
+from aggregate import AggregateBattery
 #from mnb import MNB
 
 # Logging
@@ -38,13 +44,65 @@ logging.info('Starting dbus-serialbattery')
 
 def main():
 
-    def poll_battery(loop):
-        # Run in separate thread. Pass in the mainloop so the thread can kill us if there is an exception.
-        poller = Thread(target=lambda: helper.publish_battery(loop))
-        # Thread will die with us if deamon
-        poller.daemon = True
-        poller.start()
-        return True
+    def battery_type_key(battery):
+        # What identifies a detected battery in the cache: driver, baud rate and address
+        address = getattr(battery, 'command_address', None)
+        return {'type': battery.__class__.__name__, 'baud': battery.baud_rate,
+                'address': None if address is None else bytearray(address)[0]}
+
+    def get_cached_battery(_port, battery_types):
+        cached = read_battery_type_cache().get(port_identity(_port))
+        for test in battery_types:
+            if battery_type_key(test) == cached:
+                return test
+        return None
+
+    def cache_battery_type(_port, battery):
+        update_battery_type_cache(port_identity(_port), battery_type_key(battery))
+
+    def group_by_baud(battery_types):
+        # [(baud, [battery, ...]), ...] in the order the baud rates first appear
+        groups = []
+        for test in battery_types:
+            for baud, candidates in groups:
+                if baud == test.baud_rate:
+                    candidates.append(test)
+                    break
+            else:
+                groups.append((test.baud_rate, [test]))
+        return groups
+
+    def probe_baud_group(_port, baud, candidates, deadline):
+        # Send the probes of all candidates sharing this baud rate back to back in one port
+        # open and tell the replies apart by their framing. Returns the candidates worth a
+        # full test_connection(): those whose reply showed up, then those without a probe.
+        probes = [(test, test.probe()) for test in candidates]
+        framed = [(test, probe) for test, probe in probes if probe is not None]
+        answered = []
+        if framed:
+            with serial_ports.lock(_port):
+                try:
+                    ser = serial_ports.open(_port, baud)
+                    ser.flushInput()
+                    for test, (command, framer, accept) in framed:
+                        framer.reset()
+                        ser.write(command)
+                    window = min(deadline, monotonic() + SERIAL_REPLY_TIMEOUT)
+                    while not answered:
+                        data = read_exactly(ser, max(1, ser.inWaiting()), window)
+                        if not data:
+                            break
+                        for test, (command, framer, accept) in framed:
+                            framer.feed(data)
+                            if any(accept(frame) for frame in framer.frames()):
+                                answered.append(test)
+                except serial.SerialException as e:
+                    logger.error(e)
+                    serial_ports.close(_port)
+            for test, (command, framer, accept) in framed:
+                framer.reset()
+        return [test for test, probe in framed if test in answered] + \
+            [test for test, probe in probes if probe is None]
 
     def get_battery_type(_port):
         # all the different batteries the driver support and need to test for
@@ -58,8 +116,8 @@ def main():
             # MNB(port=_port, baud=9600),
         ]
 
-        if port.startswith('jkbms'):
-            return JkbmsMqtt(port=port, baud=9600)
+        if _port.startswith('jkbms'):
+            return JkbmsMqtt(port=_port, baud=9600)
 
 
         if len(sys.argv) > 2:
@@ -74,38 +132,78 @@ def main():
                 count -= 1
             return None
 
-        # try to establish communications with the battery 3 times, else exit
-        count = 3
-        while count > 0:
-            # create a new battery object that can read the battery and run connection test
-            for test in battery_types:
-                logger.info('Testing ' + test.__class__.__name__)
-                if test.test_connection() is True:
-                    logger.info('Connection established to ' + test.__class__.__name__)
-                    return test
+        # the battery found on this port last time is most likely still there
+        cached = get_cached_battery(_port, battery_types)
+        if cached is not None:
+            logger.info('Testing cached ' + cached.__class__.__name__)
+            if cached.test_connection() is True:
+                logger.info('Connection established to ' + cached.__class__.__name__)
+                return cached
 
-            count -= 1
-            sleep(0.5)
+        # probe the port one baud rate at a time until the time budget is used up
+        deadline = monotonic() + AUTODETECT_TIMEOUT
+        while monotonic() < deadline:
+            for baud, candidates in group_by_baud(battery_types):
+                logger.info('Probing %s at %d baud' % (', '.join(test.__class__.__name__ for test in candidates), baud))
+                for test in probe_baud_group(_port, baud, candidates, deadline):
+                    logger.info('Testing ' + test.__class__.__name__)
+                    if test.test_connection() is True:
+                        logger.info('Connection established to ' + test.__class__.__name__)
+                        cache_battery_type(_port, test)
+                        return test
+                    if monotonic() >= deadline:
+                        return None
+
+            sleep(max(0, min(0.5, deadline - monotonic())))
 
         return None
 
-    def get_port():
-        # Get the port we need to use from the argument
+    def get_ports():
+        # Get the ports we need to use from the argument, several ones separated by commas
         if len(sys.argv) > 1:
-            return sys.argv[1]
+            return sys.argv[1].split(',')
         else:
             # just for MNB-SPI
             logger.info('No Port needed')
-            return '/dev/tty/USB9'
+            return ['/dev/tty/USB9']
+
+    def get_bus_units(_port):
+        # The Daly units of DALY_ADDRESSES that answer on this port
+        units = [Daly(port=_port, baud=9600, address=address) for address in DALY_ADDRESSES]
+        return [unit for unit in units if unit.test_connection()]
+
+    def get_batteries(_port):
+        if DALY_ADDRESSES:
+            return get_bus_units(_port)
+        battery = get_battery_type(_port)
+        return [] if battery is None else [battery]
+
+    def get_battery_types(_ports):
+        # Detect the batteries of all ports at the same time, each port in a thread of its own.
+        # Returns the list of batteries found on each port.
+        batteries = {}
+        detectors = [Thread(target=lambda p=p: batteries.update({p: get_batteries(p)})) for p in _ports]
+        for detector in detectors:
+            detector.start()
+        for detector in detectors:
+            detector.join()
+        return [batteries.get(p, []) for p in _ports]
+
+    def tty_name(_port):
+        return _port[_port.rfind('/') + 1:]
 
     logger.info('dbus-serialbattery v' + str(DRIVER_VERSION) + DRIVER_SUBVERSION)
 
-    port = get_port()
-    battery = get_battery_type(port)
+    ports = get_ports()
+    if SERIAL_CAPTURE:
+        serial_ports.record(SERIAL_CAPTURE.replace('%s', '_'.join(tty_name(p) for p in ports)))
+    batteries = get_battery_types(ports)
 
     # exit if no battery could be found
-    if battery is None:
-        logger.error("ERROR >>> No battery connection at " + port)
+    for port, units in zip(ports, batteries):
+        if not units:
+            logger.error("ERROR >>> No battery connection at " + port)
+    if not any(batteries):
         return
 
     # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
@@ -113,23 +211,75 @@ def main():
     gobject.threads_init()
     mainloop = gobject.MainLoop()
 
-    # Get the initial values for the battery used by setup_vedbus
-    port = None
-    if len(sys.argv) > 3:
-        port = sys.argv[3]
-    helper = DbusHelper(battery, port=port)
-    if not helper.setup_vedbus():
-        logger.error("ERROR >>> Problem with battery set up at " + port)
-        return
-    logger.info('Battery connected to dbus from ' + port)
+    # One dbus service and device instance per battery. With several ports or units each
+    # one keeps its device instance under a settings path of its own.
+    helpers = []
+    names = []
+    for port, units in zip(ports, batteries):
+        helpers.append([])
+        for battery in units:
+            name = tty_name(port)
+            if len(units) > 1:
+                name += '_%02x' % bytearray(battery.command_address)[0]
+            service_port = sys.argv[3] if len(sys.argv) > 3 and len(ports) == 1 and len(units) == 1 else name
+            settings_path = DbusHelper.SETTINGS_PATH + '_' + name if len(ports) > 1 or len(units) > 1 else None
+            # Get the initial values for the battery used by setup_vedbus
+            helper = DbusHelper(battery, port=service_port, settings_path=settings_path, idle_add=gobject.idle_add)
+            if not helper.setup_vedbus():
+                logger.error("ERROR >>> Problem with battery set up at " + name)
+                return
+            logger.info('Battery connected to dbus from ' + name)
+            helpers[-1].append(helper)
+            names.append(name)
+    packs = [helper for units in helpers for helper in units]
 
+    # Packs in parallel can also be published as one battery, updated after every pack poll
+    aggregate = None
+    if AGGREGATE_BATTERY and len(packs) > 1:
+        aggregate = DbusHelper(AggregateBattery([helper.battery for helper in packs], names),
+                               settings_path=DbusHelper.SETTINGS_PATH + '_aggregate', idle_add=gobject.idle_add)
+        if not aggregate.setup_vedbus():
+            logger.error("ERROR >>> Problem with the aggregate battery set up")
+            return
+        logger.info('Aggregate of %d batteries connected to dbus' % len(packs))
 
-    # Poll the battery at INTERVAL and run the main loop
-    gobject.timeout_add(battery.poll_interval, lambda: poll_battery(mainloop))
+    def poll(helper):
+        # Pass in the mainloop so a poll can kill us if there is an exception
+        online = helper.publish_battery(mainloop)
+        if aggregate is not None:
+            with aggregate.battery.lock:
+                aggregate.battery.update_pack(helper.battery, online)
+                aggregate.publish_battery(mainloop)
+        return online
+
+    # Poll each port at its INTERVAL on a thread of its own, so the ports are read concurrently.
+    # Several units on one port are polled in turn by a BusScheduler.
+    pollers = []
+    for port, units in zip(ports, helpers):
+        if len(units) == 1:
+            helper = units[0]
+            pollers.append(PollWorker(lambda helper=helper: poll(helper), helper.battery.poll_interval,
+                                      POLL_OVERRUN, name='poll ' + tty_name(port)))
+        elif units:
+            bus = BusScheduler(port, units, poll, offline=lambda helper: helper.publish_offline(mainloop))
+            pollers.append(PollWorker(bus.poll, max(helper.battery.poll_interval for helper in units),
+                                      POLL_OVERRUN, name='poll ' + tty_name(port)))
+    for poller in pollers:
+        poller.start()
+    started = monotonic()
     try:
         mainloop.run()
     except KeyboardInterrupt:
         pass
+    for poller in pollers:
+        poller.stop()
+        logger.info('%s: %d polls, %d overran, %d ticks missed' % (
+            poller.name, poller.polls, poller.overruns, poller.missed))
+    seconds = max(monotonic() - started, 1)
+    for helper in packs + ([aggregate] if aggregate is not None else []):
+        logger.info('%s: %.1f dbus messages/s with %.1f values/s, %.1fms (max %.1fms) from poll to dbus' % (
+            helper.battery.port, helper.dbus_messages / seconds, helper.dbus_values / seconds,
+            helper.publish_latency / max(helper.published, 1) * 1000, helper.publish_latency_max * 1000))
 
 
 if __name__ == "__main__":
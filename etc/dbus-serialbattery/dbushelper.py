@@ -9,32 +9,60 @@ import traceback
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
 from vedbus import VeDbusService
 from settingsdevice import SettingsDevice
+from poller import IdleHandoff
 import battery
 from utils import *
 
-def get_bus():
-    return dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
+def get_bus(private=False):
+    # A private connection per service lets one process export several services
+    return dbus.SessionBus(private=private) if 'DBUS_SESSION_BUS_ADDRESS' in os.environ \
+        else dbus.SystemBus(private=private)
 
 class DbusHelper:
 
-    def __init__(self, battery, port=None):
+    # Where the device instance is kept in localsettings. A process serving
+    # several ports keeps one per port by passing settings_path.
+    SETTINGS_PATH = '/Settings/Devices/serialbattery'
+
+    def __init__(self, battery, port=None, settings_path=None, idle_add=None):
         self.battery = battery
+        # With the GLib idle_add of the main loop polls only read the battery and the main
+        # loop thread does all dbus writes, without it polls publish on their own thread.
+        self._handoff = IdleHandoff(idle_add, self.publish_pending) if idle_add else None
         self.instance = 1
         self.settings = None
+        self.settings_path = settings_path or self.SETTINGS_PATH
         port = port or self.battery.port[self.battery.port.rfind('/') + 1:]
         if port == 'test':
             self._path = "com.victronenergy.test_battery." + port
         else:
             self._path = "com.victronenergy.battery." + port
-        self._dbusservice = VeDbusService(self._path, get_bus())
+        self._dbusservice = VeDbusService(self._path, get_bus(private=True))
+        # Leaves out values that did not change enough since they were last published
+        self._changes = ChangeFilter(DBUS_DEADBANDS, DBUS_REFRESH_INTERVAL)
+        # velib since 2022 collects the changes made in a `with service` block and sends them
+        # as one ItemsChanged signal on /, older ones only send PropertiesChanged per path
+        self._batched = DBUS_BATCH_CHANGES and hasattr(self._dbusservice, '__enter__')
+        # dbus signals sent and values in them, for the statistics
+        self.dbus_messages = 0
+        self.dbus_values = 0
+        # Seconds from taking a snapshot to publishing it: total, highest, snapshots published
+        self.publish_latency = 0.0
+        self.publish_latency_max = 0.0
+        self.published = 0
+        # The paths of the cells by cell number - 1 and of the settings by setting name, made
+        # when a cell or setting is first published
+        self._cell_paths = []
+        self._setting_paths = {}
 
     def setup_instance(self):
-        path = '/Settings/Devices/serialbattery'
+        path = self.settings_path
         default_instance = 'battery:1'
         settings = {'instance': [path + '/ClassAndVrmInstance', default_instance, 0, 0], }
 
         self.settings = SettingsDevice(get_bus(), settings, self.handle_changed_setting)
-        self.battery.role, self.battery.instance = self.get_role_instance()
+        self.battery.role, self.instance = self.get_role_instance()
+        self.battery.instance = self.instance
 
     def get_role_instance(self):
         val = self.settings['instance'].split(':')
@@ -43,6 +71,7 @@ class DbusHelper:
     def handle_changed_setting(self, setting, oldvalue, newvalue):
         if setting == 'instance':
             self.battery.role, self.instance = self.get_role_instance()
+            self.battery.instance = self.instance
             self._dbusservice['/DeviceInstance'] = self.instance
             logger.debug("DeviceInstance = %d", self.instance)
             return
@@ -136,99 +165,168 @@ class DbusHelper:
         return True
 
     def publish_battery(self, loop):
+        # Returns the result of refresh_data(), whether the battery answered this poll
         try:
-            self.battery.refresh_data()
+            # Ends with the snapshot of the poll, the rest reads only from that
+            result = self.battery.refresh_data()
             self.battery.manage_charge_current()
+            self.battery.snapshot_control()
             # self.battery.manage_control_charging(max_voltage, min_voltage, total_voltage, balance)
-            self.publish_dbus()
+            if self._handoff is None:
+                self.publish_dbus()
+            else:
+                self.schedule_publish(loop)
+            return result
         except:
             traceback.print_exc()
             loop.quit()
+            return False
+
+    def publish_offline(self, loop):
+        # For a unit the BusScheduler leaves out: /Connected is 0 and it counts as offline
+        # until it answers again
+        try:
+            self.battery.snapshot_offline()
+            if self._handoff is None:
+                self.publish_dbus()
+            else:
+                self.schedule_publish(loop)
+        except:
+            traceback.print_exc()
+            loop.quit()
+
+    def schedule_publish(self, loop):
+        # Hand the snapshot of this poll to the main loop. When the main loop has not yet
+        # published the previous one, only the newer one is published.
+        self._handoff.put(self.battery.snapshot, loop)
+
+    def publish_pending(self, snapshot, loop):
+        # On the main loop thread, from schedule_publish()
+        try:
+            self.publish_dbus(snapshot)
+        except:
+            traceback.print_exc()
+            loop.quit()
+
+    def publish_dbus(self, snapshot=None):
+        # Publish a snapshot, the last one of the battery by default. All values are of the
+        # same poll. With a velib that supports it all changes go out in one ItemsChanged signal.
+        snapshot = snapshot or self.battery.snapshot
+        self._changes.start(monotonic())
+        values = self.dbus_values
+        if self._batched:
+            with self._dbusservice as service:
+                self.publish_snapshot(service, snapshot)
+            self.dbus_messages += 1 if self.dbus_values > values else 0
+        else:
+            self.publish_snapshot(self._dbusservice, snapshot)
+            self.dbus_messages += self.dbus_values - values
+        latency = monotonic() - snapshot.time
+        self.publish_latency += latency
+        self.publish_latency_max = max(self.publish_latency_max, latency)
+        self.published += 1
+
+    def add_path(self, path, value):
+        # Add a path found while publishing, with value as published
+        self._dbusservice.add_path(path, value)
+        self._changes.changed(path, value)
+        return path
+
+    def publish_snapshot(self, service, s):
+        # Send the values of snapshot s that changed to service
+
+        def put(path, v):
+            # velib sends nothing for a value it already has, e.g. on a refresh cycle of
+            # the filter, so only a real change counts
+            if self._changes.changed(path, v) and service[path] != v:
+                service[path] = v
+                self.dbus_values += 1
 
-    def publish_dbus(self):
         # Update SOC, DC and System items
         def pub(path, v, rounding=False):
             if v is not None:
                 if rounding:
                     v = round(v, 2)
-                self._dbusservice[path] = v
-
-        pub('/System/NrOfCellsPerBattery', self.battery.cell_count)
-        pub('/Soc', self.battery.soc, 2)
-        pub('/Dc/0/Voltage', self.battery.voltage, 2)
-        pub('/Dc/0/Current', self.battery.current, 2)
-        if self.battery.current is not None and self.battery.voltage is not None and self.battery.soc is not None:
-            pub('/Dc/0/Power', self.battery.voltage * self.battery.current, 2)
-            logging.debug("logged to dbus ", round(self.battery.voltage / 100, 2),
-                      round(self.battery.current / 100, 2),
-                      round(self.battery.soc, 2))
-
-        pub('/Dc/0/Temperature', self.battery.get_temp())
-        pub('/Capacity', self.battery.capacity_remain)
+                put(path, v)
+
+        pub('/System/NrOfCellsPerBattery', s.cell_count)
+        pub('/Soc', s.soc, 2)
+        pub('/Dc/0/Voltage', s.voltage, 2)
+        pub('/Dc/0/Current', s.current, 2)
+        if s.current is not None and s.voltage is not None and s.soc is not None:
+            pub('/Dc/0/Power', s.voltage * s.current, 2)
+            logging.debug("logged to dbus ", round(s.voltage / 100, 2),
+                      round(s.current / 100, 2),
+                      round(s.soc, 2))
+
+        pub('/Dc/0/Temperature', s.temp)
+        pub('/Capacity', s.capacity_remain)
         pub('/ConsumedAmphours', 
-            0 if self.battery.capacity is None or self.battery.capacity_remain is None
-            else self.battery.capacity - self.battery.capacity_remain
+            0 if s.capacity is None or s.capacity_remain is None
+            else s.capacity - s.capacity_remain
         )
 
         # Update battery extras
-        self._dbusservice['/History/ChargeCycles'] = self.battery.cycles
-        self._dbusservice['/History/TotalAhDrawn'] = self.battery.total_ah_drawn
-        self._dbusservice['/Io/AllowToCharge'] = 1 if self.battery.charge_fet \
-                                and self.battery.control_allow_charge else 0
-        self._dbusservice['/Io/AllowToDischarge'] = 1 if self.battery.discharge_fet and self.battery.control_allow_discharge else 0
-        self._dbusservice['/System/NrOfModulesBlockingCharge'] = 0 if self.battery.charge_fet is None or \
-                                (self.battery.charge_fet and self.battery.control_allow_charge) else 1
-        self._dbusservice['/System/NrOfModulesBlockingDischarge'] = 0 if self.battery.discharge_fet is None \
-                                or self.battery.discharge_fet else 1
-        self._dbusservice['/System/MinCellTemperature'] = self.battery.get_min_temp()
-        self._dbusservice['/System/MaxCellTemperature'] = self.battery.get_max_temp()
+        put('/History/ChargeCycles', s.cycles)
+        put('/History/TotalAhDrawn', s.total_ah_drawn)
+        put('/Io/AllowToCharge', 1 if s.charge_fet and s.control_allow_charge else 0)
+        put('/Io/AllowToDischarge', 1 if s.discharge_fet and s.control_allow_discharge else 0)
+        put('/Connected', s.connected)
+        put('/System/NrOfModulesOnline', s.modules_online)
+        put('/System/NrOfModulesOffline', s.modules_offline)
+        put('/System/NrOfModulesBlockingCharge', s.modules_blocking_charge)
+        put('/System/NrOfModulesBlockingDischarge', s.modules_blocking_discharge)
+        put('/System/MinCellTemperature', s.min_temp)
+        put('/System/MaxCellTemperature', s.max_temp)
 
         # Charge control
-        if self.battery.control_voltage is not None:
-            pub('/Info/MaxChargeVoltage', round(self.battery.control_voltage, 2))
-        pub('/Info/MaxChargeCurrent', round(self.battery.control_charge_current, 1))
-        pub('/Info/MaxDischargeCurrent', round(self.battery.control_discharge_current, 1))
+        if s.control_voltage is not None:
+            pub('/Info/MaxChargeVoltage', round(s.control_voltage, 2))
+        pub('/Info/MaxChargeCurrent', round(s.control_charge_current, 1))
+        pub('/Info/MaxDischargeCurrent', round(s.control_discharge_current, 1))
 
         # Updates from cells
-        pub('/System/MinVoltageCellId', self.battery.get_min_cell_desc())
-        pub('/System/MaxVoltageCellId', self.battery.get_max_cell_desc())
-        pub('/System/MinCellVoltage', self.battery.get_min_cell_voltage())
-        pub('/System/MaxCellVoltage', self.battery.get_max_cell_voltage())
-        pub('/Balancing', self.battery.get_balancing())
+        pub('/System/MinVoltageCellId', s.min_cell_desc)
+        pub('/System/MaxVoltageCellId', s.max_cell_desc)
+        pub('/System/MinCellVoltage', s.min_cell_voltage)
+        pub('/System/MaxCellVoltage', s.max_cell_voltage)
+        pub('/Balancing', s.balancing)
 
         # Update the alarms
-        pub('/Alarms/LowVoltage', self.battery.protection.voltage_low)
-        pub('/Alarms/LowCellVoltage', self.battery.protection.voltage_cell_low)
+        pub('/Alarms/LowVoltage', s.protection.voltage_low)
+        pub('/Alarms/LowCellVoltage', s.protection.voltage_cell_low)
 	# jdi: Disabled for now, providing errant alarms
-        # pub('/Alarms/HighVoltage', self.battery.protection.voltage_high)
-        pub('/Alarms/LowSoc', self.battery.protection.soc_low)
-        pub('/Alarms/HighChargeCurrent', self.battery.protection.current_over)
-        pub('/Alarms/HighDischargeCurrent', self.battery.protection.current_under)
-        pub('/Alarms/CellImbalance', self.battery.protection.cell_imbalance)
-        pub('/Alarms/InternalFailure', self.battery.protection.internal_failure)
-        pub('/Alarms/HighChargeTemperature', self.battery.protection.temp_high_charge)
-        pub('/Alarms/LowChargeTemperature', self.battery.protection.temp_low_charge)
-        pub('/Alarms/HighTemperature', self.battery.protection.temp_high_discharge)
-        pub('/Alarms/LowTemperature', self.battery.protection.temp_low_discharge)
+        # pub('/Alarms/HighVoltage', s.protection.voltage_high)
+        pub('/Alarms/LowSoc', s.protection.soc_low)
+        pub('/Alarms/HighChargeCurrent', s.protection.current_over)
+        pub('/Alarms/HighDischargeCurrent', s.protection.current_under)
+        pub('/Alarms/CellImbalance', s.protection.cell_imbalance)
+        pub('/Alarms/InternalFailure', s.protection.internal_failure)
+        pub('/Alarms/HighChargeTemperature', s.protection.temp_high_charge)
+        pub('/Alarms/LowChargeTemperature', s.protection.temp_low_charge)
+        pub('/Alarms/HighTemperature', s.protection.temp_high_discharge)
+        pub('/Alarms/LowTemperature', s.protection.temp_low_discharge)
         
-        for i, c in enumerate(self.battery.cells):
-            path = '/Internal/Cell/%d/Voltage' % (i+1)
-            v = self.battery.cells[i].voltage
-            if path not in self._dbusservice:
-                self._dbusservice.add_path(path, v)
+        cell_paths = self._cell_paths
+        for i, v in enumerate(s.cell_voltages):
+            if i < len(cell_paths):
+                pub(cell_paths[i], v)
             else:
-                pub(path, v)
+                cell_paths.append(self.add_path('/Internal/Cell/%d/Voltage' % (i+1), v))
 
-        pub('/Internal/Temperature', self.battery.temp_internal)
+        pub('/Internal/Temperature', s.temp_internal)
 
-        internal = getattr(self.battery, '_internal', {})
-        for k, v in internal.items():
-            cc = ''.join([w.title() for w in k.split('_')])
-            path = '/Internal/Settings/' + cc
+        # Settings are only in the snapshot of a poll that read them again
+        if s.internal is None:
+            return
+        setting_paths = self._setting_paths
+        for k, v in s.internal:
+            path = setting_paths.get(k)
             try:
-              if path not in self._dbusservice:
-                self._dbusservice.add_path(path, v)
+              if path is not None:
+                pub(path, v)
               else:
-                pub('/Internal/Settings/' + cc, v)
+                path = '/Internal/Settings/' + ''.join([w.title() for w in k.split('_')])
+                setting_paths[k] = self.add_path(path, v)
             except UnicodeDecodeError:
-                logger.error('Cannot decode: %r' % cc)
+                logger.error('Cannot decode: %r' % path)
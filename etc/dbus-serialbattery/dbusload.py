@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Development tool, run on the GX while the service runs: python dbusload.py [options]
+# Not part of the installed driver.
+#
+# Samples the CPU time of the system dbus-daemon and of the dbus-serialbattery processes
+# from /proc/<pid>/stat. Run it once with DBUS_BATCH_CHANGES = True and once with False,
+# with the same batteries connected, to see what batching the changes saves dbus-daemon.
+# Other services on the bus load dbus-daemon too, so compare runs of the same length.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import os
+import sys
+import time
+
+
+def find_processes(match):
+    # Pids whose command line contains match, except this one
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % name, 'rb') as f:
+                cmdline = f.read().replace(b'\0', b' ')
+        except IOError:
+            continue
+        if match in cmdline:
+            pids.append(int(name))
+    return pids
+
+
+def cpu_ticks(pid):
+    # utime + stime of pid in clock ticks. The command name in brackets may hold spaces,
+    # so the fields are counted from the state after it: utime and stime are the 12th and 13th.
+    with open('/proc/%d/stat' % pid, 'rb') as f:
+        stat = f.read()
+    fields = stat[stat.rfind(b')') + 2:].split()
+    return int(fields[11]) + int(fields[12])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU load of dbus-daemon and dbus-serialbattery')
+    parser.add_argument('--seconds', type=float, default=300, help='how long to sample')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between samples')
+    parser.add_argument('--pid', type=int, help='dbus-daemon pid, default the one of the system bus')
+    args = parser.parse_args()
+
+    daemons = [args.pid] if args.pid else find_processes(b'dbus-daemon --system')
+    if not daemons:
+        print('No system dbus-daemon found, pass --pid')
+        return 1
+    processes = [('dbus-daemon %d' % pid, pid) for pid in daemons] + \
+                [('serialbattery %d' % pid, pid) for pid in find_processes(b'dbus-serialbattery.py')]
+    tick = float(os.sysconf(str('SC_CLK_TCK')))
+
+    first = last = dict((pid, cpu_ticks(pid)) for name, pid in processes)
+    started = previous = time.time()
+    print('  '.join('%18s' % name for name, pid in processes))
+    while time.time() - started < args.seconds:
+        time.sleep(args.interval)
+        now = time.time()
+        ticks = dict((pid, cpu_ticks(pid)) for name, pid in processes)
+        # CPU time in % of one core over the interval
+        print('  '.join('%17.2f%%' % ((ticks[pid] - last[pid]) / tick / (now - previous) * 100)
+                        for name, pid in processes))
+        last, previous = ticks, now
+
+    print('Mean over %.0fs:' % (previous - started))
+    for name, pid in processes:
+        print('%18s  %.2f%% CPU' % (name, (last[pid] - first[pid]) / tick / (previous - started) * 100))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# BMS protocol emulators on a pseudo-terminal, for load and latency tests without hardware.
+# Not part of the installed driver.
+#
+#   python emulator.py lltjbd --cells 16 --latency 20 --jitter 5 --crc-errors 0.01
+#   python dbus-serialbattery.py /dev/pts/N
+#
+# The emulated BMS answers on the pty printed at start until interrupted.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import os
+import random
+import select
+import sys
+import threading
+import time
+import tty
+from struct import pack
+
+
+def write_paced(fd, data, baud):
+    # Write at roughly wire speed (10 bits per byte) so the reader sees partial frames
+    # the way it would on a real UART instead of the whole reply at once.
+    if not baud:
+        os.write(fd, data)
+        return
+    for i in range(len(data)):
+        os.write(fd, data[i:i + 1])
+        time.sleep(10.0 / baud)
+
+
+class Emulator(object):
+    # Base class: reads requests from the master side of a pty and answers them.
+    # Each subclass implements:
+    #   take_request(buffer): remove and return the next complete request from the bytearray
+    #                         buffer, None if there is none yet
+    #   reply(request): the reply bytes for a request, None to stay silent
+    BAUD = 9600
+    # Offset of the byte that is flipped to inject a checksum error
+    CHECKSUM_OFFSET = -1
+
+    def __init__(self, cells=16, latency=0.01, jitter=0.0, crc_errors=0.0, truncate=0.0, paced=False, seed=None):
+        self.cells = cells
+        self.latency = latency
+        self.jitter = jitter
+        self.crc_errors = crc_errors
+        self.truncate = truncate
+        self.paced = paced
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.injected = 0
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def run(self):
+        buffer = bytearray()
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if not ready:
+                continue
+            buffer.extend(os.read(self._master, 1024))
+            request = self.take_request(buffer)
+            while request is not None:
+                self.requests += 1
+                reply = self.reply(request)
+                if reply:
+                    self.answer(bytearray(reply))
+                request = self.take_request(buffer)
+
+    def answer(self, reply):
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.random.random() < self.crc_errors:
+            reply[self.CHECKSUM_OFFSET] ^= 0x5A
+            self.injected += 1
+        elif self.random.random() < self.truncate:
+            del reply[self.random.randint(1, len(reply) - 1):]
+            self.injected += 1
+        write_paced(self._master, bytes(reply), self.BAUD if self.paced else None)
+
+    def cell_voltage(self, cell):
+        # Volts, slightly different per cell and per poll
+        return 3.300 + 0.002 * (cell % 5) + self.random.uniform(-0.001, 0.001)
+
+    def take_fixed(self, buffer, start, length):
+        # Helper for protocols with fixed length requests
+        pos = buffer.find(start)
+        if pos < 0:
+            del buffer[:max(0, len(buffer) - len(start) + 1)]
+            return None
+        del buffer[:pos]
+        if len(buffer) < length:
+            return None
+        request = bytes(buffer[:length])
+        del buffer[:length]
+        return request
+
+
+class LltJbdEmulator(Emulator):
+    # LLT/JBD 0xDD protocol, commands 03 (general), 04 (cells) and 05 (hardware)
+    CHECKSUM_OFFSET = -2
+
+    def take_request(self, buffer):
+        return self.take_fixed(buffer, b"\xDD\xA5", 7)
+
+    def reply(self, request):
+        command = bytearray(request)[2]
+        if command == 0x03:
+            voltage = int(sum(self.cell_voltage(c) for c in range(self.cells)) * 100)
+            data = pack('>HhHHHHHHHBBBBBHH', voltage, -520, 16000, 28000, 12, 0x2A61, 0, 0, 0,
+                        0x10, 57, 3, self.cells, 2, 2981, 2985)
+        elif command == 0x04:
+            data = b''.join(pack('>H', int(self.cell_voltage(c) * 1000)) for c in range(self.cells))
+        elif command == 0x05:
+            data = b'JBD-SP04S034-L%dS' % self.cells
+        else:
+            return None
+        return self.frame(command, data)
+
+    @staticmethod
+    def frame(command, data):
+        body = bytearray([0, len(data)]) + bytearray(data)
+        return bytearray([0xDD, command]) + body + pack('>HB', (0x10000 - sum(body)) & 0xFFFF, 0x77)
+
+
+class DalyEmulator(Emulator):
+    # Daly 0xA5 protocol, commands 0x90 to 0x98, 13 byte requests and replies
+    TEMP_SENSORS = 2
+
+    def __init__(self, addresses=None, **kwargs):
+        super(DalyEmulator, self).__init__(**kwargs)
+        # Only answer requests to these addresses, like units sharing an RS485 bus. None answers all.
+        self.addresses = addresses
+
+    def take_request(self, buffer):
+        return self.take_fixed(buffer, b"\xA5", 13)
+
+    def reply(self, request):
+        if self.addresses is not None and bytearray(request)[1] not in self.addresses:
+            return None
+        command = bytearray(request)[2]
+        voltages = [int(self.cell_voltage(c) * 1000) for c in range(self.cells)]
+        if command == 0x90:
+            frames = [pack('>HHHH', sum(voltages) // 100, 0, 30000 + 52, 573)]
+        elif command == 0x91:
+            frames = [pack('>HBHBxx', max(voltages), voltages.index(max(voltages)) + 1,
+                           min(voltages), voltages.index(min(voltages)) + 1)]
+        elif command == 0x92:
+            frames = [pack('>BBBBxxxx', 40 + 26, 1, 40 + 25, 2)]
+        elif command == 0x93:
+            frames = [pack('>B??BL', 0, True, True, 12, 160000)]
+        elif command == 0x94:
+            frames = [pack('>BB??BHx', self.cells, self.TEMP_SENSORS, False, True, 0, 12)]
+        elif command == 0x95:
+            # Three cells per frame, prefixed with the frame number
+            frames = [pack('>B', n // 3 + 1) + b''.join(pack('>H', v) for v in voltages[n:n + 3]).ljust(6, b'\0') + b'\0'
+                      for n in range(0, self.cells, 3)]
+        elif command == 0x96:
+            frames = [pack('>B7B', 1, *([40 + 25] * self.TEMP_SENSORS + [0] * (7 - self.TEMP_SENSORS)))]
+        elif command in (0x97, 0x98):
+            frames = [b'\0' * 8]
+        else:
+            return None
+        # Replies carry the board number, 1 for 0x40 or 0x80, 2 for 0x41 ...
+        board = (bytearray(request)[1] & 0x3F) + 1
+        return bytearray().join(self.frame(command, data, board) for data in frames)
+
+    @staticmethod
+    def frame(command, data, board=1):
+        reply = bytearray([0xA5, board, command, 0x08]) + bytearray(data)
+        return reply + bytearray([sum(reply) & 0xFF])
+
+
+class JkbmsEmulator(Emulator):
+    # JKBMS 0x4E57 protocol, answers the read all (0x06) and read register (0x03) requests
+    BAUD = 115200
+
+    def take_request(self, buffer):
+        pos = buffer.find(b"\x4E\x57")
+        if pos < 0 or len(buffer) < pos + 4:
+            return None
+        length = (buffer[pos + 2] << 8) + buffer[pos + 3] + 2
+        if len(buffer) < pos + length:
+            return None
+        request = bytes(buffer[pos:pos + length])
+        del buffer[:pos + length]
+        return request
+
+    def registers(self):
+        cells = b''.join(pack('>BH', c + 1, int(self.cell_voltage(c) * 1000)) for c in range(self.cells))
+        voltage = int(sum(self.cell_voltage(c) for c in range(self.cells)) * 100)
+        return [
+            (0x79, pack('>B', len(cells)) + cells),
+            (0x80, pack('>H', 27)), (0x81, pack('>H', 25)), (0x82, pack('>H', 24)),
+            (0x83, pack('>H', voltage)), (0x84, pack('>H', 0x8000 + 520)), (0x85, pack('>B', 57)),
+            (0x86, pack('>B', 2)), (0x87, pack('>H', 12)), (0x89, pack('>L', 160)),
+            (0x8A, pack('>H', self.cells)), (0x8B, pack('>H', 0)), (0x8C, pack('>H', 3)),
+            (0x8E, pack('>H', 5800)), (0x8F, pack('>H', 4200)), (0x90, pack('>H', 3650)),
+            (0x91, pack('>H', 3400)), (0x92, pack('>H', 5)), (0x93, pack('>H', 2700)),
+            (0x94, pack('>H', 2900)), (0x95, pack('>H', 5)), (0x96, pack('>H', 300)),
+            (0x97, pack('>H', 150)), (0x98, pack('>H', 300)), (0x99, pack('>H', 100)),
+            (0x9A, pack('>H', 30)), (0x9B, pack('>H', 3400)), (0x9C, pack('>H', 10)),
+            (0x9D, pack('>B', 1)), (0x9E, pack('>H', 80)), (0x9F, pack('>H', 70)),
+            (0xA0, pack('>H', 60)), (0xA1, pack('>H', 50)), (0xA2, pack('>H', 20)),
+            (0xA3, pack('>H', 55)), (0xA4, pack('>H', 60)), (0xA5, pack('>H', 2)),
+            (0xA6, pack('>H', 5)), (0xA7, pack('>H', 0xFFEC)), (0xA8, pack('>H', 0xFFF6)),
+            (0xA9, pack('>B', self.cells)), (0xAA, pack('>L', 280)), (0xAB, pack('>B', 1)),
+            (0xAC, pack('>B', 1)), (0xAD, pack('>H', 1000)), (0xAE, pack('>B', 0)),
+            (0xAF, pack('>B', 1)), (0xB0, pack('>H', 10)), (0xB1, pack('>B', 20)),
+            (0xB2, b'123456'.ljust(10, b'\0')), (0xB3, pack('>B', 0)), (0xB4, b'EMULATED'),
+            (0xB5, b'2210'), (0xB6, pack('>L', 3600)), (0xB7, b'11.XW_S11.26___'),
+            (0xB8, pack('>B', 0)), (0xB9, pack('>L', 280)),
+        ]
+
+    def reply(self, request):
+        request = bytearray(request)
+        if request[8] == 0x03:
+            for register, value in self.registers():
+                if register == request[11]:
+                    return self.frame(pack('>B', register) + value, 0x03)
+            return None
+        if request[8] != 0x06:
+            return None
+        return self.frame(b''.join(pack('>B', register) + value for register, value in self.registers()))
+
+    @staticmethod
+    def frame(data, command=0x06):
+        body = pack('>LBBB', 0, command, 0x00, 0x01) + data + pack('>LB', 0, 0x68)
+        frame = bytearray(pack('>HH', 0x4E57, len(body) + 6)) + bytearray(body)
+        return frame + bytearray(pack('>L', sum(frame)))
+
+
+class SinowealthEmulator(Emulator):
+    # Sinowealth register reads: 0x0A <register> 0x04, replies are 4 data bytes plus a checksum
+
+    def take_request(self, buffer):
+        return self.take_fixed(buffer, b"\x0A", 3)
+
+    def reply(self, request):
+        register = bytearray(request)[1]
+        # The pack configuration register only encodes 3 to 10 cells
+        cells = min(max(self.cells, 3), 10)
+        if 1 <= register <= cells:
+            data = pack('>HH', int(self.cell_voltage(register - 1) * 1000), 0)
+        elif register == 0x0B:
+            data = pack('>HH', int(sum(self.cell_voltage(c) for c in range(cells)) * 1000), 0)
+        elif 0x0C <= register <= 0x0F:
+            data = pack('>HH', 2981, 0)
+        elif register == 0x10:
+            data = pack('>i', -5200)
+        elif register == 0x11:
+            data = pack('>i', 280000)
+        elif register == 0x12:
+            data = pack('>i', 160000)
+        elif register == 0x13:
+            data = pack('>BBH', 0, 57, 0)
+        elif register == 0x14:
+            data = pack('>HH', 12, 0)
+        elif register == 0x15:
+            data = pack('>BBH', 0x02, 0x03, 0)
+        elif register == 0x16:
+            data = b'\0' * 4
+        elif register == 0x17:
+            data = pack('>BBH', 0, cells - 3, 0)
+        else:
+            return None
+        return bytearray(data) + bytearray([sum(bytearray(data)) & 0xFF])
+
+
+EMULATORS = {
+    'lltjbd': LltJbdEmulator,
+    'daly': DalyEmulator,
+    'jkbms': JkbmsEmulator,
+    'sinowealth': SinowealthEmulator,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate a BMS on a pseudo-terminal')
+    parser.add_argument('bms', choices=sorted(EMULATORS))
+    parser.add_argument('--cells', type=int, default=16, help='number of cells, 4 to 32')
+    parser.add_argument('--latency', type=float, default=10.0, help='reply latency in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency jitter in ms, +/-')
+    parser.add_argument('--crc-errors', type=float, default=0.0, help='fraction of replies with a bad checksum')
+    parser.add_argument('--truncate', type=float, default=0.0, help='fraction of replies cut short')
+    parser.add_argument('--paced', action='store_true', help='send replies at the BMS baud rate')
+    parser.add_argument('--link', help='also make the pty available under this path')
+    parser.add_argument('--addresses', help='daly: only answer these addresses, in hex, e.g. 40,41 for two units on a bus')
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.addresses:
+        kwargs['addresses'] = [int(a, 16) for a in args.addresses.split(',')]
+    emulator = EMULATORS[args.bms](cells=args.cells, latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                                   crc_errors=args.crc_errors, truncate=args.truncate, paced=args.paced, **kwargs)
+    port = emulator.start()
+    if args.link:
+        if os.path.lexists(args.link):
+            os.remove(args.link)
+        os.symlink(port, args.link)
+    print('%s emulator with %d cells on %s' % (args.bms, args.cells, args.link or port))
+    try:
+        while True:
+            time.sleep(10)
+            print('%d requests, %d errors injected' % (emulator.requests, emulator.injected))
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import sys
+from struct import calcsize, unpack_from
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Frames are handed out as views into the receive buffer. Items of a memoryview are str
+# on Python 2, there frames are copied out as bytearray instead.
+if sys.version_info[0] < 3:
+    def buffer_view(buffer):
+        return buffer
+else:
+    buffer_view = memoryview
+
+
+class Framer(object):
+    # Incremental frame splitter for a serial byte stream.
+    #
+    # A frame starts with the start marker and is length + length_check + 1 bytes long,
+    # the same convention as read_serial_data: length is length_fixed or decoded with
+    # length_size at length_pos. end is an optional trailer and checksum an optional
+    # callable(frame) -> bool. Bytes that do not form a valid frame are skipped up to
+    # the next start marker, and bytes of an incomplete frame are kept for the next feed().
+    #
+    # Received bytes go into one buffer of twice max_length that is allocated once and
+    # reused, a frame is a view into it. It is valid until the next feed() or reset().
+
+    def __init__(self, start, length_pos, length_check, length_size=None, length_fixed=None,
+                 end=None, checksum=None, max_length=512):
+        self.start = bytes(start)
+        self.length_pos = length_pos
+        self.length_check = length_check
+        self.length_size = length_size if length_size is not None else 'B'
+        self.length_fixed = length_fixed
+        self.end = bytes(end) if end is not None else None
+        self.checksum = checksum
+        self.max_length = max_length
+        self.header_length = max(len(self.start), length_pos + calcsize(self.length_size))
+        self.skipped = 0
+        self._buffer = bytearray(2 * max_length)
+        self._view = buffer_view(self._buffer)
+        # The buffered bytes are _buffer[_start:_end]
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def feed(self, data):
+        size = len(data)
+        if self._end + size > len(self._buffer):
+            # Move the buffered bytes to the front, the frames handed out so far become invalid
+            buffered = self._end - self._start
+            if buffered + size > len(self._buffer):
+                # More than any frame can be long, only the newest bytes are worth keeping
+                self._skip(min(buffered, buffered + size - len(self._buffer)))
+                buffered = self._end - self._start
+                if size > len(self._buffer):
+                    self.skipped += size - len(self._buffer)
+                    data = buffer_view(data)[size - len(self._buffer):]
+                    size = len(self._buffer)
+            self._view[:buffered] = self._view[self._start:self._end]
+            self._start, self._end = 0, buffered
+        self._view[self._end:self._end + size] = data
+        self._end += size
+
+    def reset(self):
+        self._start = self._end = 0
+
+    def frame_length(self):
+        # Total length of the frame at the start of the buffer, None if the header is incomplete
+        if self.length_fixed is not None:
+            return self.length_fixed + self.length_check + 1
+        if len(self) < self.header_length:
+            return None
+        return unpack_from(self.length_size, self._buffer, self._start + self.length_pos)[0] + self.length_check + 1
+
+    def bytes_needed(self):
+        # How many more bytes complete the frame in the buffer, at least 1
+        length = self.frame_length()
+        if length is None:
+            return max(1, self.header_length - len(self))
+        return max(1, length - len(self))
+
+    def next_frame(self):
+        # Return the next valid frame as a view into the buffer, or None if more data is needed
+        while True:
+            if not self._resync():
+                return None
+            length = self.frame_length()
+            if length is None:
+                return None
+            if length < self.header_length or length > self.max_length:
+                self._skip(1)
+                continue
+            if len(self) < length:
+                return None
+            frame = self._view[self._start:self._start + length]
+            if (self.end is not None and frame[length - len(self.end):] != self.end) or \
+                    (self.checksum is not None and not self.checksum(frame)):
+                # Could be a start marker inside a damaged frame, resume right after it
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Dropping invalid frame %r' % bytearray(frame))
+                self._skip(1)
+                continue
+            self._start += length
+            return frame
+
+    def frames(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def _resync(self):
+        # Drop bytes in front of the next start marker. Returns False if no full marker is buffered.
+        pos = self._buffer.find(self.start, self._start, self._end)
+        if pos < 0:
+            # Keep a partial marker at the end of the buffer
+            self._skip(max(0, len(self) - len(self.start) + 1))
+            return False
+        self._skip(pos - self._start)
+        return True
+
+    def _skip(self, count):
+        if count:
+            self.skipped += count
+            self._start += count
@@ -0,0 +1,123 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+try:
+    import tracemalloc
+except ImportError:
+    # New in Python 3.4, the allocation tests are skipped without it
+    tracemalloc = None
+import unittest
+from struct import unpack_from
+from framer import Framer
+from serialport import read_framed, monotonic
+from lltjbd import LltJbd
+from daly import Daly
+
+
+def llt_frame(command, data):
+    body = bytearray([0, len(data)]) + bytearray(data)
+    checksum = (0x10000 - sum(body)) & 0xFFFF
+    return bytearray([0xDD, command]) + body + bytearray([checksum >> 8, checksum & 0xFF, 0x77])
+
+
+def llt_framer():
+    return Framer(LltJbd.FRAME_START, LltJbd.LENGTH_POS, LltJbd.LENGTH_CHECK,
+                  end=LltJbd.FRAME_END, checksum=LltJbd.checksum_ok)
+
+
+class TestFramer(unittest.TestCase):
+
+    def test_two_frames_in_one_read(self):
+        framer = llt_framer()
+        framer.feed(llt_frame(0x03, b'\x01\x02') + llt_frame(0x04, b'\x0c\xe4'))
+        self.assertEqual(list(framer.frames()), [llt_frame(0x03, b'\x01\x02'), llt_frame(0x04, b'\x0c\xe4')])
+
+    def test_partial_frame_is_kept(self):
+        framer = llt_framer()
+        frame = llt_frame(0x03, b'\x01\x02\x03')
+        framer.feed(frame[:5])
+        self.assertIsNone(framer.next_frame())
+        self.assertEqual(framer.bytes_needed(), len(frame) - 5)
+        framer.feed(frame[5:])
+        self.assertEqual(framer.next_frame(), frame)
+
+    def test_resync_after_garbage_and_bad_checksum(self):
+        framer = llt_framer()
+        bad = llt_frame(0x03, b'\x01\x02')
+        bad[4] ^= 0xFF
+        framer.feed(b'\x00\xDD\x77' + bad + llt_frame(0x04, b'\x0c\xe4'))
+        self.assertEqual(framer.next_frame(), llt_frame(0x04, b'\x0c\xe4'))
+        self.assertIsNone(framer.next_frame())
+
+    def test_fixed_length_frames(self):
+        framer = Framer(Daly.FRAME_START, Daly.LENGTH_POS, Daly.LENGTH_CHECK, checksum=Daly.checksum_ok)
+        reply = bytearray(b'\xA5\x01\x90\x08\x01\x02\x03\x04\x05\x06\x07\x08')
+        reply.append(sum(reply) & 0xFF)
+        framer.feed(b'\xA5\x01' + reply[:7])
+        self.assertIsNone(framer.next_frame())
+        framer.feed(reply[7:])
+        self.assertEqual(framer.next_frame(), reply)
+
+    def test_daly_reply_of_other_board(self):
+        # The first board is asked as 0x40 or 0x80 and answers as 1, the board at 0x41 as 2
+        reply = bytearray(b'\xA5\x02\x94\x08\x10\x01\x00\x00\x00\x00\x00\x00')
+        reply.append(sum(reply) & 0xFF)
+        for address, accepted in ((b'\x40', False), (b'\x80', False), (b'\x41', True)):
+            command, framer, accept = Daly('/dev/null', 9600, address).probe()
+            self.assertEqual(accept(reply), accepted)
+
+
+class ChunkSerial(object):
+    # Hands out a list of byte strings, one per read(), as a port would
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.timeout = None
+
+    def read(self, size):
+        return self.chunks.pop()
+
+
+class TestReceiveBuffer(unittest.TestCase):
+
+    def receive_peak(self, data):
+        # Peak of memory allocated while receiving and decoding one frame with data, the
+        # lowest of several frames so a one-off allocation elsewhere does not count
+        frame = bytes(llt_frame(0x03, data))
+        framer = llt_framer()
+        # Header first, then the rest, as read_framed() asks for them
+        ser = ChunkSerial([frame[4:], frame[:4]] * 21)
+        deadline = monotonic() + 10
+        read_framed(ser, framer, deadline)
+        peaks = []
+        for _ in range(20):
+            # Traced anew for every frame, tracemalloc.reset_peak() needs Python 3.9
+            tracemalloc.start()
+            try:
+                start = tracemalloc.get_traced_memory()[0]
+                received = read_framed(ser, framer, deadline)
+                self.assertEqual(unpack_from('>H', received, len(received) - 5)[0], unpack_from('>H', data, len(data) - 2)[0])
+                del received
+                peaks.append(tracemalloc.get_traced_memory()[1] - start)
+            finally:
+                tracemalloc.stop()
+        return min(peaks)
+
+    @unittest.skipIf(tracemalloc is None, 'needs tracemalloc')
+    def test_frames_are_not_copied(self):
+        # A copy of the frame anywhere on the way would grow with the frame, by 242 bytes here.
+        # Buffer positions past 256 are int objects of their own, a few dozen bytes.
+        small = self.receive_peak(bytearray(range(8)))
+        large = self.receive_peak(bytearray(range(250)))
+        self.assertLess(large - small, 128)
+
+    def test_buffer_is_reused(self):
+        framer = llt_framer()
+        frame = llt_frame(0x03, bytearray(range(200)))
+        for _ in range(20):
+            framer.feed(frame)
+            self.assertEqual(framer.next_frame(), frame)
+        self.assertEqual(len(framer), 0)
+        self.assertEqual(framer.skipped, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
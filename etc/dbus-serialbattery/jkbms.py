@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
-from battery import Protection, Battery, Cell
+from battery import Protection, Battery, Cell, TIER_FAST, TIER_MEDIUM, TIER_SLOW
 from utils import *
 from struct import *
 import serial
@@ -10,20 +10,129 @@ class Jkbms(Battery):
     def __init__(self, port,baud):
         super(Jkbms, self).__init__(port,baud)
         self.type = self.BATTERYTYPE
-        self._serial = None
+        # The last status reply and its index, parsed by read_settings_data(). It is a view
+        # into the receive buffer and dropped by the next read.
+        self._settings_data = None
+        # Poll only the volatile registers, the rest on the medium tier. Turned off when
+        # the BMS never answers single register reads.
+        self.selective_read = JKBMS_SELECTIVE_READ
+        self._registers_answered = False
+        self._register_commands = dict((register, self.command(0x03, register))
+                                       for register in self.VOLATILE_REGISTERS)
+        # The single register replies are collected here
+        self._registers_buffer = bytearray(256)
+        self._framer = Framer(self.FRAME_START, self.LENGTH_POS, self.LENGTH_CHECK, self.LENGTH_SIZE,
+                              checksum=self.checksum_ok)
 
     BATTERYTYPE = "Jkbms"
     LENGTH_CHECK = 1
     LENGTH_POS = 2
     LENGTH_SIZE = '>H'
+    FRAME_START = b"\x4E\x57"
     CURRENT_ZERO_CONSTANT = 32768
     command_status = b"\x4E\x57\x00\x13\x00\x00\x00\x00\x06\x03\x00\x00\x00\x00\x00\x00\x68\x00\x00\x01\x29"
+    # Register id: decoder of its value. The read all reply is a sequence of register id and
+    # value, the cell voltages (0x79) are a length byte and 3 bytes (cell number, mV) per cell.
+    CELL_VOLTAGES = 0x79
+    CELL = Struct('>xH')
+    REGISTERS = dict((register, Struct(fmt)) for register, fmt in (
+        (0x80, '>H'), (0x81, '>H'), (0x82, '>H'), (0x83, '>H'), (0x84, '>H'), (0x85, '>B'),
+        (0x86, '>B'), (0x87, '>H'), (0x89, '>L'), (0x8A, '>H'), (0x8B, '>H'), (0x8C, '>H'),
+        (0x8E, '>H'), (0x8F, '>H'), (0x90, '>H'), (0x91, '>H'), (0x92, '>H'), (0x93, '>H'),
+        (0x94, '>H'), (0x95, '>H'), (0x96, '>H'), (0x97, '>H'), (0x98, '>H'), (0x99, '>H'),
+        (0x9A, '>H'), (0x9B, '>H'), (0x9C, '>H'), (0x9D, '>B'), (0x9E, '>H'), (0x9F, '>H'),
+        (0xA0, '>H'), (0xA1, '>H'), (0xA2, '>H'), (0xA3, '>H'), (0xA4, '>H'), (0xA5, '>H'),
+        (0xA6, '>H'), (0xA7, '>H'), (0xA8, '>H'), (0xA9, '>B'), (0xAA, '>L'), (0xAB, '>B'),
+        (0xAC, '>B'), (0xAD, '>H'), (0xAE, '>B'), (0xAF, '>B'), (0xB0, '>H'), (0xB1, '>B'),
+        (0xB2, '>10s'), (0xB3, '>B'), (0xB4, '>8s'), (0xB5, '>4s'), (0xB6, '>L'), (0xB7, '>15s'),
+        (0xB8, '>B'), (0xB9, '>L'), (0xBA, '>24s'), (0xBB, '>B'), (0xBC, '>B'), (0xBD, '>B'),
+        (0xBE, '>H'), (0xBF, '>H'), (0xC0, '>B'),
+    ))
+    # Alarm register 0x8B
+    PROTECTION_BITS = BitLayout((
+        ('soc_low', ((1 << 0, 2),), 0),
+        # BMS (MOS) over temperature
+        ('internal_failure', ((1 << 1, 2),), 0),
+        ('voltage_high', ((1 << 2, 2),), 0),
+        ('voltage_low', ((1 << 3, 2),), 0),
+        ('current_over', ((1 << 5, 1),), 0),
+        ('current_under', ((1 << 6, 1),), 0),
+        ('cell_imbalance', ((1 << 7, 2), (1 << 10, 1)), 0),
+        ('voltage_cell_low', ((1 << 11, 2),), 0),
+        # there is just a BMS and Battery temp alarm (not high/low)
+        ('temp_high_charge', ((1 << 4 | 1 << 8, 1),), 0),
+        ('temp_low_charge', ((1 << 4 | 1 << 8, 1),), 0),
+        ('temp_high_discharge', ((1 << 4 | 1 << 8, 1),), 0),
+        ('temp_low_discharge', ((1 << 4 | 1 << 8, 1),), 0),
+    ))
+    # Status register 0x8C
+    FET_BITS = BitLayout((
+        ('charge_fet', ((1 << 0, True),), False),
+        ('discharge_fet', ((1 << 1, True),), False),
+    ))
+    # Registers that change from poll to poll: cells, temperatures, voltage, current, SoC,
+    # alarms and FET state
+    VOLATILE_REGISTERS = (CELL_VOLTAGES, 0x80, 0x81, 0x82, 0x83, 0x84, 0x85, 0x8B, 0x8C)
+    # Registers read_status_data() needs
+    STATUS_REGISTERS = (CELL_VOLTAGES, 0x80, 0x81, 0x82, 0x83, 0x84, 0x85, 0x87, 0x89, 0x8A, 0x8B, 0x8C)
+    # Settings published under /Internal/Settings: name, register, divisor. Strings lose their
+    # trailing zeros. 0xBA-0xC0 (manufacturer id, restart, restore, start upgrade, GPS low
+    # voltage and recovery, data format version) do not exist in all replies and are left out.
+    SETTINGS = (
+        ('battery_over_voltage', 0x8E, 100.0),
+        ('battery_under_voltage', 0x8F, 100.0),
+        ('cell_over_voltage', 0x90, 1000.0),
+        ('cell_over_voltage_recovery', 0x91, 1000.0),
+        ('cell_over_voltage_delay', 0x92, None),
+        ('cell_under_voltage', 0x93, 1000.0),
+        ('cell_under_voltage_recovery', 0x94, 1000.0),
+        ('cell_under_voltage_delay', 0x95, None),
+        ('cell_diff_voltage_max', 0x96, 1000.0),
+        ('discharge_over_current', 0x97, None),
+        ('discharge_over_current_delay', 0x98, None),
+        ('charge_over_current', 0x99, None),
+        ('charge_over_current_delay', 0x9A, None),
+        ('balancer_start_voltage', 0x9B, 1000.0),
+        ('balancer_min_diff_voltage', 0x9C, 1000.0),
+        ('balancing', 0x9D, None),
+        ('mos_over_temperature', 0x9E, None),
+        ('mos_over_temperature_recovery', 0x9F, None),
+        ('cell_over_temperature', 0xA0, None),
+        ('cell_over_temperature_recovery', 0xA1, None),
+        ('cell_diff_protection', 0xA2, None),
+        ('cell_charge_high_temperature', 0xA3, None),
+        ('cell_discharge_high_temperature', 0xA4, None),
+        ('charge_low_temperature', 0xA5, None),
+        ('charge_low_temperature_recovery', 0xA6, None),
+        ('discharge_low_temperature', 0xA7, None),
+        ('discharge_low_temperature_recovery', 0xA8, None),
+        ('cell_count_setting', 0xA9, None),
+        ('capacity', 0xAA, None),
+        ('charge_switch', 0xAB, None),
+        ('discharge_switch', 0xAC, None),
+        ('current_calibration', 0xAD, None),
+        ('guard_plate_address', 0xAE, None),
+        ('battery_type', 0xAF, None),
+        ('sleep_time', 0xB0, None),
+        ('soc_low', 0xB1, None),
+        ('password', 0xB2, None),
+        ('special_charger_switch', 0xB3, None),
+        ('production', 0xB4, None),
+        ('manufactured', 0xB5, None),
+        ('system_working_time', 0xB6, None),
+        ('version', 0xB7, None),
+        ('calibration_start', 0xB8, None),
+        ('battery_capacity_estimated', 0xB9, None),
+    )
 
     def test_connection(self):
         # call a function that will connect to the battery, send a command and retrieve the result.
         # The result or call should be unique to this BMS. Battery name or version, etc.
         # Return True if success, False for failure
-        return self.read_status_data()
+        return self.read_status_data() and self.read_settings_data()
+
+    def probe(self):
+        return self.command_status, self._framer, lambda frame: frame[8] == 0x06
 
     def get_settings(self):
         # After successful  connection get_settings will be call to set up the battery.
@@ -37,54 +146,126 @@ class Jkbms(Battery):
         self.min_battery_voltage_warning = MIN_CELL_VOLTAGE_WARNING * self.cell_count
 
         # init the cell array
-        while len(self.cells) < self.cell_count:
-          self.cells.append(Cell(False))
+        self.cells.resize(max(len(self.cells), self.cell_count))
 
         self.hardware_version = "JKBMS " + str(self.cell_count) + " cells"
         return True
 
-    def refresh_data(self):
-        # call all functions that will refresh the battery data.
-        # This will be called for every iteration (1 second)
-        # Return True if success, False for failure
-        result = self.read_status_data()
+    def refresh_reads(self):
+        # The read all reply holds all values. With selective reads only the volatile
+        # registers are asked for on every poll and the full dump on the medium tier,
+        # else the temperatures and SoC come with the fast values at no extra cost and
+        # only parsing the settings block is worth skipping.
+        if self.selective_read:
+            return [
+                (TIER_FAST, self.read_volatile_data),
+                (TIER_MEDIUM, self.read_status_data),
+                (TIER_SLOW, self.read_settings_data),
+            ]
+        return [
+            (TIER_FAST, self.read_status_data),
+            (TIER_SLOW, self.read_settings_data),
+        ]
 
-        return result
+    @classmethod
+    def command(cls, cmd, data):
+        # A request frame: terminal id, command, source (0x03 = PC), transmission type,
+        # one data byte, record number, end and the 32 bit sum of all preceding bytes
+        frame = bytearray(cls.FRAME_START) + bytearray(pack('>HLBBBBLB', 0x13, 0, cmd, 0x03, 0x00, data, 0, 0x68))
+        return bytes(frame + bytearray(pack('>L', sum(frame))))
 
-    def get_data(self, bytes, idcode, length):
-        start = bytes.find(idcode)
-        if start < 0: return False
-        ret = bytes[start+1:start+length+1]
-        del bytes[start:start+length+1]
-        return ret
+    @classmethod
+    def index_registers(cls, data):
+        # One pass over the reply: register id -> offset of its value in data. Every value
+        # is skipped by its known width, so a value byte is never taken for a register id.
+        index = {}
+        pos = 0
+        while pos + 1 < len(data):
+            register = data[pos]
+            if register == cls.CELL_VOLTAGES:
+                size = 1 + data[pos + 1]
+            elif register in cls.REGISTERS:
+                size = cls.REGISTERS[register].size
+            else:
+                # Without its width nothing after it can be found
+                logger.debug('Unknown register 0x%02x at %d' % (register, pos))
+                break
+            if pos + 1 + size > len(data):
+                logger.debug('Register 0x%02x cut short at %d' % (register, pos))
+                break
+            index[register] = pos + 1
+            pos += 1 + size
+        return index
+
+    def value(self, data, index, register):
+        return self.REGISTERS[register].unpack_from(data, index[register])[0]
 
     def read_status_data(self):
         status_data = self.read_serial_data_jkbms(self.command_status)
         # check if connection success
         if status_data is False:
             return False
-        del status_data[0]
+        index = self.index_registers(status_data)
+        missing = [register for register in self.STATUS_REGISTERS if register not in index]
+        if missing:
+            logger.error('Registers missing from the reply: %s' % ', '.join('0x%02x' % r for r in missing))
+            return False
+
+        protection = self.parse_volatile(status_data, index)
+
+        # 0x86 is the temperature sensor count
+        self.cycles = self.value(status_data, index, 0x87)
+        # 0x88 does not exist
+        if self.capacity is None:
+            self.capacity_remain = self.value(status_data, index, 0x89)
+
+        self.cell_count = self.value(status_data, index, 0x8A)
+        if self.cell_count != len(self.cells):
+            logger.error('Misconfigured number of cells, got %d' % self.cell_count)
+            return False
+
+        self._settings_data = status_data, index
+
+        # The summary of the poll is only made after refresh_data(), this is for the log
+        voltages = self.cells.voltages
+        max_cell_voltage = max(voltages) / 1000 if voltages else 0.0
+        min_cell_voltage = min(voltages) / 1000 if voltages else 0.0
+        logger.info('%.2fV (%.3f-%.3f), %.1fA, %.1f%%, P%04x, T(I:%d 1:%d 2:%d)' % (
+            self.voltage, min_cell_voltage, max_cell_voltage, self.current,
+            self.soc, protection, self.temp_internal, self.temp1, self.temp2,
+            ))
+        return True
+
+    def parse_volatile(self, data, index):
         # cell voltages
-        cellbyte_count = unpack_from('>B', self.get_data(status_data, b'\x79', 1))[0]
-        while len(self.cells) < (cellbyte_count/3):
-            self.cells.append(Cell(False))
-        for c in self.cells:
-            c.voltage = unpack_from('>xH', status_data)[0]/1000
-            del status_data[:3]
-        temp0 =  unpack_from('>H', self.get_data(status_data, b'\x80', 2))[0] 
-        temp1 =  unpack_from('>H', self.get_data(status_data, b'\x81', 2))[0] 
-        temp2 =  unpack_from('>H', self.get_data(status_data, b'\x82', 2))[0] 
+        offset = index[self.CELL_VOLTAGES]
+        cellbyte_count = data[offset]
+        if len(self.cells) < cellbyte_count // 3:
+            self.cells.resize(cellbyte_count // 3)
+        voltages = self.cells.voltages
+        for c in range(cellbyte_count // 3):
+            voltages[c] = self.CELL.unpack_from(data, offset + 1 + 3 * c)[0]
+
+        temp0 = self.value(data, index, 0x80)
+        temp1 = self.value(data, index, 0x81)
+        temp2 = self.value(data, index, 0x82)
         logger.info('Raw Temp T%d %d %d' % (temp0, temp1, temp2))
         self.to_temp(0, temp0 if temp0 < 100 else 100 - temp0)
         self.to_temp(1, temp1 if temp1 < 100 else 100 - temp1)
         self.to_temp(2, temp2 if temp2 < 100 else 100 - temp2)
-        
-        voltage = unpack_from('>H', self.get_data(status_data, b'\x83', 2))[0]
+
+        voltage = self.value(data, index, 0x83)
         self.voltage = voltage / 100
 
-        current = unpack_from('>H', self.get_data(status_data, b'\x84', 2))[0]
+        current = self.value(data, index, 0x84)
         self.current = current / -100 if current < self.CURRENT_ZERO_CONSTANT else (current - self.CURRENT_ZERO_CONSTANT) / 100
 
+        self.soc = self.value(data, index, 0x85)
+        if self.soc > 100:
+            logger.error('Invalid soc: %r' % bytearray(data))
+        if self.capacity is not None:
+            self.capacity_remain = round(self.capacity * self.soc / 100, 1)
+
         # Correct for slightly different voltage of Cell 9 (zero indexed)
         # due to different connection style
         # Charging 0.015V at 35A
@@ -94,150 +275,123 @@ class Jkbms(Battery):
         # if len(self.cells)>8 and self.cells[8].voltage:
         #     self.cells[8].voltage -= self.current * 0.015 / 35.0
 
-        self.soc =  unpack_from('>B', self.get_data(status_data, b'\x85', 1))[0] 
-        if self.soc > 100:
-            logger.error('Invalid soc: %r' % [status_data])
-
-        temperature_sensor_count =  unpack_from('>B', self.get_data(status_data, b'\x86', 1))[0] 
-        self.cycles =  unpack_from('>H', self.get_data(status_data, b'\x87', 2))[0] 
-        # 0x88 does not exist
-        self.capacity_remain = unpack_from('>L', self.get_data(status_data, b'\x89', 4))[0]
+        protection = self.to_protection_bits(self.value(data, index, 0x8B))
+        self.to_fet_bits(self.value(data, index, 0x8C))
+        return protection
 
-        self.cell_count = unpack_from('>H', self.get_data(status_data, b'\x8A', 2))[0]
-        if self.cell_count != len(self.cells):
-            logger.error('Misconfigured number of cells, got %d' % self.cell_count)
+    def read_volatile_data(self):
+        data = self.read_registers(self.VOLATILE_REGISTERS)
+        if data is False:
+            if self._registers_answered or not self.read_status_data():
+                return False
+            # Answers read all but not single registers
+            logger.error('No reply to single register reads, reading all registers on every poll')
+            self.selective_read = False
+            return True
+        self._registers_answered = True
+        index = self.index_registers(data)
+        missing = [register for register in self.VOLATILE_REGISTERS if register not in index]
+        if missing:
+            logger.error('Registers missing from the reply: %s' % ', '.join('0x%02x' % r for r in missing))
             return False
+        if data[index[self.CELL_VOLTAGES]] // 3 != self.cell_count:
+            logger.error('Misconfigured number of cells, got %d' % (data[index[self.CELL_VOLTAGES]] // 3))
+            return False
+        self.parse_volatile(data, index)
+        return True
 
-        protection = self.to_protection_bits(unpack_from('>H', self.get_data(status_data, b'\x8B', 2))[0] )
-        self.to_fet_bits(unpack_from('>H', self.get_data(status_data, b'\x8C', 2))[0] )
+    def read_settings_data(self):
+        # Parses the settings from the last status reply, read now if there is none
+        if self._settings_data is None and not self.read_status_data():
+            return False
+        status_data, index = self._settings_data
+        self._settings_data = None
+        missing = [register for name, register, divisor in self.SETTINGS if register not in index]
+        if missing:
+            logger.error('Settings missing from the reply: %s' % ', '.join('0x%02x' % r for r in missing))
+            return False
         # 8D does not exist
-        self._internal = dict(
-            battery_over_voltage =  unpack_from('>H', self.get_data(status_data, b'\x8E', 2))[0] / 100.0,
-            battery_under_voltage =  unpack_from('>H', self.get_data(status_data, b'\x8F', 2))[0] / 100.0,
-            cell_over_voltage =  unpack_from('>H', self.get_data(status_data, b'\x90', 2))[0] / 1000.0,
-            cell_over_voltage_recovery =  unpack_from('>H', self.get_data(status_data, b'\x91', 2))[0] / 1000.0,
-            cell_over_voltage_delay =  unpack_from('>H', self.get_data(status_data, b'\x92', 2))[0],
-            cell_under_voltage =  unpack_from('>H', self.get_data(status_data, b'\x93', 2))[0] / 1000.0,
-            cell_under_voltage_recovery =  unpack_from('>H', self.get_data(status_data, b'\x94', 2))[0] / 1000.0,
-            cell_under_voltage_delay =  unpack_from('>H', self.get_data(status_data, b'\x95', 2))[0],
-            cell_diff_voltage_max =  unpack_from('>H', self.get_data(status_data, b'\x96', 2))[0]/1000.0,
-            discharge_over_current =  unpack_from('>H', self.get_data(status_data, b'\x97', 2))[0],
-            discharge_over_current_delay =  unpack_from('>H', self.get_data(status_data, b'\x98', 2))[0],
-            charge_over_current =  unpack_from('>H', self.get_data(status_data, b'\x99', 2))[0],
-            charge_over_current_delay =  unpack_from('>H', self.get_data(status_data, b'\x9a', 2))[0],
-            balancer_start_voltage =  unpack_from('>H', self.get_data(status_data, b'\x9b', 2))[0] / 1000.0,
-            balancer_min_diff_voltage =  unpack_from('>H', self.get_data(status_data, b'\x9c', 2))[0] / 1000.0,
-            balancing =  unpack_from('>B', self.get_data(status_data, b'\x9d', 1))[0] == 1,
-            mos_over_temperature =  unpack_from('>H', self.get_data(status_data, b'\x9e', 2))[0],
-            mos_over_temperature_recovery =  unpack_from('>H', self.get_data(status_data, b'\x9f', 2))[0],
-            cell_over_temperature =  unpack_from('>H', self.get_data(status_data, b'\xa0', 2))[0],
-            cell_over_temperature_recovery =  unpack_from('>H', self.get_data(status_data, b'\xa1', 2))[0],
-            cell_diff_protection =  unpack_from('>H', self.get_data(status_data, b'\xa2', 2))[0],
-            cell_charge_high_temperature =  unpack_from('>H', self.get_data(status_data, b'\xa3', 2))[0],
-            cell_discharge_high_temperature =  unpack_from('>H', self.get_data(status_data, b'\xa4', 2))[0],
-            charge_low_temperature =  unpack_from('>H', self.get_data(status_data, b'\xa5', 2))[0],
-            charge_low_temperature_recovery =  unpack_from('>H', self.get_data(status_data, b'\xa6', 2))[0],
-            discharge_low_temperature =  unpack_from('>H', self.get_data(status_data, b'\xa7', 2))[0],
-            discharge_low_temperature_recovery =  unpack_from('>H', self.get_data(status_data, b'\xa8', 2))[0],
-            cell_count_setting = unpack_from('>B', self.get_data(status_data, b'\xA9', 1))[0],
-            capacity = unpack_from('>L', self.get_data(status_data, b'\xAA', 4))[0],
-            charge_switch =  unpack_from('>B', self.get_data(status_data, b'\xAB', 1))[0],
-            discharge_switch =  unpack_from('>B', self.get_data(status_data, b'\xAC', 1))[0],
-            current_calibration =  unpack_from('>H', self.get_data(status_data, b'\xAD', 2))[0],
-            guard_plate_address =  unpack_from('>B', self.get_data(status_data, b'\xAE', 1))[0],
-            battery_type =  unpack_from('>B', self.get_data(status_data, b'\xAF', 1))[0],
-            sleep_time =  unpack_from('>H', self.get_data(status_data, b'\xB0', 2))[0],
-            soc_low =  unpack_from('>B', self.get_data(status_data, b'\xb1', 1))[0],
-            password =  unpack_from('>10s', self.get_data(status_data, b'\xb2', 10))[0].rstrip(b'\0'),
-            special_charger_switch =  unpack_from('>B', self.get_data(status_data, b'\xb3', 1))[0],
-            production = unpack_from('>8s', self.get_data(status_data, b'\xB4', 8))[0].rstrip(b'\0'),
-            manufactured = unpack_from('>4s', self.get_data(status_data, b'\xB5', 4))[0].rstrip(b'\0'),
-            system_working_time = unpack_from('>L', self.get_data(status_data, b'\xB6', 4))[0],
-            version = unpack_from('>15s', self.get_data(status_data, b'\xB7', 15))[0].rstrip(b'\0'),
-            calibration_start =  unpack_from('>B', self.get_data(status_data, b'\xb8', 1))[0],
-            battery_capacity_estimated = unpack_from('>L', self.get_data(status_data, b'\xB9', 4))[0],
-            # This does not exist in all replies
-            # manufacturer_id = unpack_from('>24s', self.get_data(status_data, b'\xBA', 24))[0].rstrip(b'\0'),
-            # _restart =  unpack_from('>B', self.get_data(status_data, b'\xbb', 1))[0],
-            # _restore =  unpack_from('>B', self.get_data(status_data, b'\xbc', 1))[0],
-            # _start_upgrade =  unpack_from('>B', self.get_data(status_data, b'\xbd', 1))[0],
-            # gps_low_voltage =  unpack_from('>H', self.get_data(status_data, b'\xbe', 2))[0] / 1000.0,
-            # gps_low_voltage_recovery =  unpack_from('>H', self.get_data(status_data, b'\xbf', 2))[0] / 1000.0,
-            # data_format_version =  unpack_from('>H', self.get_data(status_data, b'\xc0', 1))[0],
-        )
+        internal = {}
+        for name, register, divisor in self.SETTINGS:
+            value = self.value(status_data, index, register)
+            if divisor is not None:
+                value /= divisor
+            elif isinstance(value, bytes):
+                value = value.rstrip(b'\0')
+            internal[name] = value
+        internal['balancing'] = internal['balancing'] == 1
+        self._internal = internal
         self.balancing = self._internal['balancing']
         self.capacity = self._internal['capacity']
         self.capacity_remain = round(self.capacity * self.soc / 100, 1)
         self.production = self._internal['production']
         self.version = self._internal['version']
-
-        max_cell_voltage = self.get_max_cell_voltage() or 0.0
-        min_cell_voltage = self.get_min_cell_voltage() or 0.0
-        logger.info('%.2fV (%.3f-%.3f), %.1fA, %.1f%%, P%s, T(I:%d 1:%d 2:%d)' % (
-            self.voltage, min_cell_voltage, max_cell_voltage, self.current,
-            self.soc, protection, self.temp_internal, self.temp1, self.temp2,
-            ))
         return True
        
     def to_fet_bits(self, byte_data):
-        tmp = bin(byte_data)[2:].rjust(2, zero_char)
-        self.charge_fet = is_bit_set(tmp[1])
-        self.discharge_fet = is_bit_set(tmp[0])
+        self.FET_BITS.decode(byte_data, self)
 
     def to_protection_bits(self, byte_data):
-        pos=13
-        tmp = bin(byte_data)[15-pos:].rjust(pos + 1, zero_char)
-        self.protection.soc_low = 2 if is_bit_set(tmp[pos-0]) else 0
-        self.protection.set_IC_inspection = 2 if is_bit_set(tmp[pos-1]) else 0 # BMS over temp
-        self.protection.voltage_high = 2 if is_bit_set(tmp[pos-2]) else 0
-        self.protection.voltage_low = 2 if is_bit_set(tmp[pos-3]) else 0
-        self.protection.current_over = 1 if is_bit_set(tmp[pos-5]) else 0
-        self.protection.current_under = 1 if is_bit_set(tmp[pos-6]) else 0
-        self.protection.cell_imbalance = 2 if is_bit_set(tmp[pos-7]) else 1 if is_bit_set(tmp[pos-10]) else 0
-        self.protection.voltage_cell_low = 2 if is_bit_set(tmp[pos-11]) else 0        
-        # there is just a BMS and Battery temp alarm (not high/low)
-        self.protection.temp_high_charge = 1 if is_bit_set(tmp[pos-4]) or is_bit_set(tmp[pos-8]) else 0
-        self.protection.temp_low_charge = 1 if is_bit_set(tmp[pos-4]) or is_bit_set(tmp[pos-8]) else 0
-        self.protection.temp_high_discharge = 1 if is_bit_set(tmp[pos-4]) or is_bit_set(tmp[pos-8]) else 0
-        self.protection.temp_low_discharge = 1 if is_bit_set(tmp[pos-4]) or is_bit_set(tmp[pos-8]) else 0
-        return tmp
+        self.PROTECTION_BITS.decode(byte_data, self.protection)
+        return byte_data
 
         
+    @staticmethod
+    def checksum_ok(frame):
+        # End byte 0x68, a 4 byte record number before it and the 32 bit sum of all
+        # preceding bytes after it
+        return len(frame) > 20 and frame[-5] == 0x68 and \
+            sum(frame[:-4]) == unpack_from('>L', frame, len(frame) - 4)[0]
+
     def read_serial_data_jkbms(self, command):
-        if True:
-            # Keep the port persistently open.
+        self._settings_data = None
+        with serial_ports.lock(self.port):
             try:
-                if not self._serial:
-                    self._serial = serial.Serial(self.port, baudrate=self.baud_rate, timeout=1.0)
-                    self._serial.flushOutput()
-                    self._serial.flushInput()
-                self._serial.write(command)
-                start_data = self._serial.read(11)
-                if len(start_data) < 11:
-                    logger.error('Did not receive enough header data')
-                    self._serial.close()
-                    return False
-                start, length, terminal, cmd, crc, tt = unpack_from('>HHLBBB', start_data)
-                # Do checks
-                serial_data = self._serial.read(length - 9)
-                # self._serial.close()
+                ser = serial_ports.open(self.port, self.baud_rate)
+                ser.write(command)
+                data = read_framed(ser, self._framer, monotonic() + 1.0)
             except serial.SerialException as e:
-                self._serial = None
                 logger.error(e)
+                serial_ports.close(self.port)
                 return False
-            if not serial_data:
-                return False
-            data = bytearray()
-            data.extend(start_data)
-            data.extend(serial_data)
-        else:
-
-            # use the read_serial_data() function to read the data and then do BMS spesific checks (crc, start bytes, etc)
-            data = read_serial_data(command, self.port, self.baud_rate, self.LENGTH_POS,
-                                    self.LENGTH_CHECK, None, self.LENGTH_SIZE)
-            if data is False:
+        if data is None:
+            logger.error('No valid reply')
+            return False
+        return self.reply_data(data, bytearray(command)[8])
+
+    def read_registers(self, registers):
+        # Asks for each register on its own, all requests written back to back so the BMS
+        # answers them in one go. Returns register id and value of all of them joined, laid
+        # out like the read all reply, or False.
+        self._settings_data = None
+        view = buffer_view(self._registers_buffer)
+        size = 0
+        with serial_ports.lock(self.port):
+            try:
+                ser = serial_ports.open(self.port, self.baud_rate)
+                ser.write(b''.join(self._register_commands[register] for register in registers))
+                deadline = monotonic() + 1.0
+                for register in registers:
+                    frame = read_framed(ser, self._framer, deadline,
+                                        lambda frame, register=register: frame[8] == 0x03 and frame[11] == register)
+                    if frame is None:
+                        logger.error('No reply for register 0x%02x' % register)
+                        return False
+                    # Copied out before the next read reuses the receive buffer
+                    reply = self.reply_data(frame, 0x03)
+                    if reply is False or size + len(reply) > len(view):
+                        return False
+                    view[size:size + len(reply)] = reply
+                    size += len(reply)
+            except serial.SerialException as e:
+                logger.error(e)
+                serial_ports.close(self.port)
                 return False
-            start, length, terminal, cmd, crc, tt = unpack_from('>HHLBBB', data)
+        return view[:size]
+
+    def reply_data(self, data, command):
+        # The data of a reply to command, the part after the transmission type, or False
+        start, length, terminal, cmd, crc, tt = unpack_from('>HHLBBB', data)
 
         frame, frame1, end, crc_hi, crc_lo = unpack_from('>HHBHH', data[-9:])
 
@@ -250,7 +404,7 @@ class Jkbms(Battery):
             logger.error('CRC checksum mismatch: Expected 0x%04x, Got 0x%04x' % (crc_lo, crc_calc))
             return False
 
-        if cmd != 6:
+        if cmd != command:
             logger.error('Got wrong command code back: 0x%02x' % cmd)
             return False
 
@@ -259,4 +413,4 @@ class Jkbms(Battery):
             return False
         
 
-        return data[10:-9]
+        return data[11:-9]
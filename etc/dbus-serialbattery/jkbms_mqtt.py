@@ -14,13 +14,15 @@ class JkbmsMqtt(Battery):
     def __init__(self, port, baud):
         super(JkbmsMqtt, self).__init__(port, baud)
         self.type = self.BATTERYTYPE
-        self.cells = [Cell(0) for _ in range(16)]
+        self.cells.resize(16)
         self.voltage_cell = {}
         self._current_charge = 0
         self._current_discharge = 0
         self._mos_temp = 0
         self._last_msg = 0
         self._attr = {}
+        # The latest payload per topic, replaced as a whole by on_message()
+        self._staged = {}
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
@@ -37,6 +39,13 @@ class JkbmsMqtt(Battery):
         if x != 'value':
             return
         self._last_msg = time.time()
+        # On the MQTT thread: the latest value of each topic goes into a new dict that
+        # replaces the staged one in one assignment, refresh_data() takes it from there
+        staged = dict(self._staged)
+        staged[k] = v
+        self._staged = staged
+
+    def apply(self, k, v):
         try:
             self._attr[k] = float(v)
         except ValueError:
@@ -110,6 +119,8 @@ class JkbmsMqtt(Battery):
         self.cell_count = 16
         self.max_battery_voltage = MAX_CELL_VOLTAGE * self.cell_count
         self.min_battery_voltage = MIN_CELL_VOLTAGE * self.cell_count
+        self.max_battery_voltage_warning = MAX_CELL_VOLTAGE_WARNING * self.cell_count
+        self.min_battery_voltage_warning = MIN_CELL_VOLTAGE_WARNING * self.cell_count
 
         self.cell_max_no = None
         self.cell_min_no = None
@@ -146,8 +157,13 @@ class JkbmsMqtt(Battery):
         # call all functions that will refresh the battery data.
         # This will be called for every iteration (1 second)
         # Return True if success, False for failure
+        # One read of the staged values, the MQTT thread only ever replaces them. The
+        # battery and its snapshot are then only written on this thread.
+        staged = self._staged
+        for k, v in staged.items():
+            self.apply(k, v)
         result = self.read_status_data()
-        return result
+        return self.finish_refresh(result)
 
     def read_status_data(self):
    
@@ -158,7 +174,7 @@ class JkbmsMqtt(Battery):
             #self.cell_max_no = [n for n, v in self.voltage_cell.items() if v == self.cell_max_voltage][0]
             #self.cell_min_no = [n for n, v in self.voltage_cell.items() if v == self.cell_min_voltage][0]
 
-            cell_min = min([c.voltage for c in self.cells])
+            cell_min = min(self.cells.voltages) / 1000
             if cell_min > 0.1:
                 self.protection.voltage_cell_low = 2 if cell_min < MIN_CELL_VOLTAGE - 0.1 else 1 if cell_min < MIN_CELL_VOLTAGE else 0
             else:
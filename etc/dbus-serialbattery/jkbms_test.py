@@ -0,0 +1,112 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import unittest
+from struct import pack
+from emulator import JkbmsEmulator
+from jkbms import Jkbms
+
+
+class ReplyJkbms(Jkbms):
+    # Answers from a list of registers instead of the serial port
+
+    def __init__(self, registers):
+        super(ReplyJkbms, self).__init__('/dev/null', 115200)
+        self.registers = registers
+        self.register_reads = True
+        self.reads = []
+
+    def read_serial_data_jkbms(self, command):
+        self.reads.append('all')
+        return bytearray(JkbmsEmulator.frame(b''.join(pack('>B', r) + v for r, v in self.registers))[11:-9])
+
+    def read_registers(self, registers):
+        self.reads.append('registers')
+        if not self.register_reads:
+            return False
+        return bytearray(b''.join(pack('>B', r) + v for r, v in self.registers if r in registers))
+
+
+class TestRegisterIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.registers = JkbmsEmulator(cells=4).registers()
+
+    def replace(self, register, value):
+        self.registers = [(r, value if r == register else v) for r, v in self.registers]
+
+    def test_status_and_settings(self):
+        battery = ReplyJkbms(self.registers)
+        self.assertTrue(battery.test_connection())
+        self.assertEqual(battery.cell_count, 4)
+        self.assertEqual(battery.soc, 57)
+        self.assertEqual(battery.current, 5.2)
+        self.assertEqual(battery.capacity, 280)
+        self.assertEqual(battery._internal['cell_over_voltage'], 3.65)
+        self.assertEqual(battery._internal['version'], b'11.XW_S11.26___')
+        self.assertEqual(battery._internal['password'], b'123456')
+        self.assertTrue(battery._internal['balancing'])
+
+    def test_value_byte_equal_to_register_id(self):
+        # 0x8585 holds the id of the SoC register twice before the SoC itself
+        self.replace(0x83, pack('>H', 0x8585))
+        self.replace(0x85, pack('>B', 42))
+        battery = ReplyJkbms(self.registers)
+        self.assertTrue(battery.read_status_data())
+        self.assertEqual(battery.voltage, 0x8585 / 100)
+        self.assertEqual(battery.soc, 42)
+
+    def test_missing_register(self):
+        self.registers = [(r, v) for r, v in self.registers if r != 0x84]
+        self.assertFalse(ReplyJkbms(self.registers).read_status_data())
+
+    def test_unknown_register_ends_the_index(self):
+        data = bytearray(b'\x85\x39\x01\x02\x87\x00\x0C')
+        self.assertEqual(Jkbms.index_registers(data), {0x85: 1})
+
+    def test_truncated_value(self):
+        data = bytearray(b'\x85\x39\x87\x00')
+        self.assertEqual(Jkbms.index_registers(data), {0x85: 1})
+
+
+class TestSelectiveRead(unittest.TestCase):
+
+    def setUp(self):
+        self.battery = ReplyJkbms(JkbmsEmulator(cells=4).registers())
+        self.battery.selective_read = True
+        self.assertTrue(self.battery.test_connection())
+        self.battery.get_settings()
+        self.battery.refresh_data()
+        self.battery.reads = []
+
+    def test_command(self):
+        self.assertEqual(Jkbms.command(0x06, 0x00), Jkbms.command_status)
+
+    def test_volatile_registers_only(self):
+        changed = {0x80: pack('>H', 31), 0x83: pack('>H', 5000), 0x85: pack('>B', 42)}
+        self.battery.registers = [(r, changed.get(r, v)) for r, v in self.battery.registers]
+        self.assertTrue(self.battery.refresh_data())
+        self.assertEqual(self.battery.refreshed_tiers, ('fast',))
+        self.assertEqual(self.battery.reads, ['registers'])
+        self.assertEqual(self.battery.voltage, 50.0)
+        self.assertEqual(self.battery.soc, 42)
+        self.assertEqual(self.battery.temp_internal, 31)
+
+    def test_falls_back_to_read_all(self):
+        battery = ReplyJkbms(self.battery.registers)
+        battery.selective_read = True
+        battery.register_reads = False
+        self.assertTrue(battery.test_connection())
+        battery.get_settings()
+        self.assertTrue(battery.refresh_data())
+        self.assertFalse(battery.selective_read)
+        battery.reads = []
+        self.assertTrue(battery.refresh_data())
+        self.assertEqual(battery.reads, ['all'])
+
+    def test_no_fallback_once_answered(self):
+        self.battery.register_reads = False
+        self.assertFalse(self.battery.read_volatile_data())
+        self.assertTrue(self.battery.selective_read)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,34 +19,6 @@ class LltJbdProtection(Protection):
         self.IC_inspection = False
         self.software_lock = False
 
-    def set_voltage_high_cell(self, value):
-        self.voltage_high_cell = value
-        self.cell_imbalance = 2 if self.voltage_low_cell \
-                                        or self.voltage_high_cell else 0
-
-    def set_voltage_low_cell(self, value):
-        self.voltage_low_cell = value
-        self.cell_imbalance = 2 if self.voltage_low_cell \
-                                        or self.voltage_high_cell else 0
-
-    def set_short(self, value):
-        self.short = value
-        self.set_cell_imbalance(2 if self.short \
-                                        or self.IC_inspection \
-                                        or self.software_lock else 0)
-
-    def set_ic_inspection(self, value):
-        self.IC_inspection = value
-        self.set_cell_imbalance(2 if self.short \
-                                        or self.IC_inspection \
-                                        or self.software_lock else 0)
-
-    def set_software_lock(self, value):
-        self.software_lock = value
-        self.set_cell_imbalance(2 if self.short \
-                                        or self.IC_inspection \
-                                        or self.software_lock else 0)
-
 
 class LltJbd(Battery):
 
@@ -54,6 +26,8 @@ class LltJbd(Battery):
         super(LltJbd, self).__init__(port,baud)
         self.protection = LltJbdProtection()
         self.type = self.BATTERYTYPE
+        self._framer = Framer(self.FRAME_START, self.LENGTH_POS, self.LENGTH_CHECK,
+                              end=self.FRAME_END, checksum=self.checksum_ok)
 
 # degree_sign = u'\N{DEGREE SIGN}'
     command_general = b"\xDD\xA5\x03\x00\xFF\xFD\x77"
@@ -62,10 +36,37 @@ class LltJbd(Battery):
     BATTERYTYPE = "LLT/JBD"
     LENGTH_CHECK = 6
     LENGTH_POS = 3
+    FRAME_START = b"\xDD"
+    FRAME_END = b"\x77"
+    PROTECTION_BITS = BitLayout((
+        ('voltage_high_cell', ((1 << 0, True),), False),
+        ('voltage_low_cell', ((1 << 1, True),), False),
+        ('voltage_high', ((1 << 2, 2),), 0),
+        ('voltage_low', ((1 << 3, 2),), 0),
+        ('temp_high_charge', ((1 << 4, 1),), 0),
+        ('temp_low_charge', ((1 << 5, 1),), 0),
+        ('temp_high_discharge', ((1 << 6, 1),), 0),
+        ('temp_low_discharge', ((1 << 7, 1),), 0),
+        ('current_over', ((1 << 8, 1),), 0),
+        ('current_under', ((1 << 9, 1),), 0),
+        ('short', ((1 << 10, True),), False),
+        ('IC_inspection', ((1 << 11, True),), False),
+        ('software_lock', ((1 << 12, True),), False),
+        # extra protection flags for LltJbd
+        ('cell_imbalance', ((1 << 0 | 1 << 1, 2),), 0),
+        ('internal_failure', ((1 << 10 | 1 << 11 | 1 << 12, 2),), 0),
+    ))
+    FET_BITS = BitLayout((
+        ('charge_fet', ((1 << 0, True),), False),
+        ('discharge_fet', ((1 << 1, True),), False),
+    ))
 
     def test_connection(self):
         return self.read_hardware_data()
 
+    def probe(self):
+        return self.command_hardware, self._framer, lambda frame: frame[1] == 0x05
+
     def get_settings(self):
         self.read_gen_data()
         self.max_battery_current = MAX_BATTERY_CURRENT
@@ -75,48 +76,22 @@ class LltJbd(Battery):
     def refresh_data(self):
         result = self.read_gen_data()
         result = result and self.read_cell_data()
-        return result
+        return self.finish_refresh(result)
 
     def to_protection_bits(self, byte_data):
-        tmp = bin(byte_data)[2:].rjust(13, zero_char)
-
-        self.protection.voltage_high = 2 if is_bit_set(tmp[10]) else 0
-        self.protection.voltage_low = 2 if is_bit_set(tmp[9]) else 0
-        self.protection.temp_high_charge = 1 if is_bit_set(tmp[8]) else 0
-        self.protection.temp_low_charge = 1 if is_bit_set(tmp[7]) else 0
-        self.protection.temp_high_discharge = 1 if is_bit_set(tmp[6]) else 0
-        self.protection.temp_low_discharge = 1 if is_bit_set(tmp[5]) else 0
-        self.protection.current_over = 1 if is_bit_set(tmp[4]) else 0
-        self.protection.current_under = 1 if is_bit_set(tmp[3]) else 0
+        # Cell over/under voltage count as cell imbalance, short, IC error and software lock as internal failure
+        self.PROTECTION_BITS.decode(byte_data, self.protection)
 
         # Software implementations for low soc
         self.protection.soc_low = 2 if self.soc < 10 else 1 if self.soc < 20 else 0
 
-        # extra protection flags for LltJbd
-        self.protection.set_voltage_low_cell = is_bit_set(tmp[11])
-        self.protection.set_voltage_high_cell = is_bit_set(tmp[12])
-        self.protection.set_software_lock = is_bit_set(tmp[0])
-        self.protection.set_IC_inspection = is_bit_set(tmp[1])
-        self.protection.set_short = is_bit_set(tmp[2])
-
     def to_cell_bits(self, byte_data, byte_data_high):
-        # clear the list
-        for c in self.cells:
-            self.cells.remove(c)
-        # get up to the first 16 cells
-        tmp = bin(byte_data)[2:].rjust(min(self.cell_count, 16), zero_char)
-        for bit in reversed(tmp):
-            self.cells.append(Cell(is_bit_set(bit)))
-        # get any cells above 16
-        if self.cell_count > 16:
-            tmp = bin(byte_data_high)[2:].rjust(self.cell_count-16, zero_char)
-            for bit in reversed(tmp):
-                self.cells.append(Cell(is_bit_set(bit)))
+        # Balancing state of cell 1-16 in bit 0-15 of byte_data, of the cells above 16 in byte_data_high
+        self.cells.resize(self.cell_count)
+        self.cells.balance = ((byte_data & 0xFFFF) | (byte_data_high & 0xFFFF) << 16) & ((1 << self.cell_count) - 1)
 
     def to_fet_bits(self, byte_data):
-        tmp = bin(byte_data)[2:].rjust(2, zero_char)
-        self.charge_fet = is_bit_set(tmp[1])
-        self.discharge_fet = is_bit_set(tmp[0])
+        self.FET_BITS.decode(byte_data, self)
 
     def read_gen_data(self):
         gen_data = self.read_serial_data_llt(self.command_general)
@@ -139,6 +114,8 @@ class LltJbd(Battery):
         self.to_protection_bits(protection)
         self.max_battery_voltage = MAX_CELL_VOLTAGE * self.cell_count
         self.min_battery_voltage = MIN_CELL_VOLTAGE * self.cell_count
+        self.max_battery_voltage_warning = MAX_CELL_VOLTAGE_WARNING * self.cell_count
+        self.min_battery_voltage_warning = MIN_CELL_VOLTAGE_WARNING * self.cell_count
 
         return True
 
@@ -148,13 +125,8 @@ class LltJbd(Battery):
         if cell_data is False or len(cell_data) < self.cell_count*2:
             return False
 
-        for c in range(self.cell_count):
-            try:
-                cell_volts = unpack_from('>H', cell_data, c * 2)
-                if len(cell_volts) != 0:
-                    self.cells[c].voltage = cell_volts[0] / 1000
-            except struct.error:
-                self.cells[c].voltage = 0
+        for c in range(min(self.cell_count, len(self.cells))):
+            self.cells.voltages[c] = unpack_from('>H', cell_data, c * 2)[0]
         return True
 
     def read_hardware_data(self):
@@ -167,8 +139,16 @@ class LltJbd(Battery):
         logger.info(self.hardware_version)
         return True
 
+    @staticmethod
+    def checksum_ok(frame):
+        # 0x10000 minus the sum of status, length and data bytes
+        checksum = unpack_from('>H', frame, len(frame) - 3)[0]
+        return checksum == (0x10000 - sum(frame[2:-3])) & 0xFFFF
+
     def read_serial_data_llt(self, command):
-        data = read_serial_data(command, self.port, self.baud_rate, self.LENGTH_POS, self.LENGTH_CHECK)
+        command_code = bytearray(command)[2]
+        data = read_serial_data(command, self.port, self.baud_rate, self.LENGTH_POS, self.LENGTH_CHECK,
+                                framer=self._framer, accept=lambda frame: frame[1] == command_code)
         if data is False:
             return False
 
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
-from battery import Protection, Battery, Cell
+from battery import Protection, Battery, Cell, CellStore
 from struct import *
 #from test_max17853 import *#{these two lines are mutually}
 from util_max17853 import * #{exclusive. use test for testing}
@@ -78,7 +78,7 @@ class MNB(Battery):
         self.current = None
         self.temp3 = None
         self.temp4 = None
-        self.cells= []
+        self.cells = CellStore()
         
     BATTERYTYPE = "MNB-Li SPI" 
     
@@ -115,7 +115,7 @@ class MNB(Battery):
     def refresh_data(self):
         # Run acquisition cycle.
         result = data_cycle(self)
-        return result
+        return self.finish_refresh(result)
 
     def read_status_data(self):
         # used once in init...
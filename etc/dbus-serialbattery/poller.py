@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import threading
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# What to do when a poll is still running at the time the next one is due:
+# skip the ticks that passed and wait for the next one that is still ahead,
+# or run the next poll at once and go back to the schedule after it
+OVERRUN_SKIP = 'skip'
+OVERRUN_RUN = 'run'
+
+
+class PollWorker(object):
+    # Calls poll() every interval ms on one long-lived thread, so two polls of the same
+    # battery never run at the same time. Ticks are counted from the start, not from the
+    # end of the previous poll, so the schedule does not drift by the poll duration.
+    # overruns counts the polls that ended after the next tick was due, missed the ticks
+    # that were not polled at all.
+
+    def __init__(self, poll, interval, overrun=OVERRUN_SKIP, name=None, clock=monotonic, wait=None):
+        if overrun not in (OVERRUN_SKIP, OVERRUN_RUN):
+            raise ValueError('Unknown overrun policy %r' % overrun)
+        self.poll = poll
+        self.name = name or 'poll'
+        self.interval = interval / 1000.0
+        self.overrun = overrun
+        self.polls = 0
+        self.overruns = 0
+        self.missed = 0
+        self._stop = threading.Event()
+        # The clock and the wait for the next tick, tests pass fake ones. wait(seconds)
+        # returns True once the worker is stopped.
+        self._clock = clock
+        self._wait = wait or self._stop.wait
+        self._thread = threading.Thread(target=self.run, name=self.name)
+        # Thread will die with us if daemon
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def run(self):
+        next_tick = self._clock()
+        while not self._wait(max(0, next_tick - self._clock())):
+            self.poll()
+            self.polls += 1
+            next_tick += self.interval
+            now = self._clock()
+            if now < next_tick:
+                continue
+
+            # ticks that are due by now, the oldest one is next_tick
+            due = int((now - next_tick) // self.interval) + 1
+            self.overruns += 1
+            if self.overrun == OVERRUN_SKIP:
+                self.missed += due
+                next_tick += due * self.interval
+            else:
+                # Poll at once for the latest due tick, the ones before it are lost
+                self.missed += due - 1
+                next_tick += (due - 1) * self.interval
+            logger.debug('Poll overran by %.3fs, %d missed ticks in total' % (
+                now - next_tick + self.interval, self.missed))
+
+
+class IdleHandoff(object):
+    # Hands the latest value of a poll thread to the main loop: put(value, *args) has
+    # idle_add run deliver(value, *args) on the main loop thread. A value put while the
+    # previous one is still waiting replaces it, so the main loop only gets the newest
+    # and there is never more than one callback queued.
+
+    def __init__(self, idle_add, deliver):
+        self._idle_add = idle_add
+        self._deliver = deliver
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def put(self, value, *args):
+        with self._lock:
+            scheduled = self._pending is not None
+            self._pending = value
+        if not scheduled:
+            self._idle_add(self._run, *args)
+
+    def _run(self, *args):
+        with self._lock:
+            value, self._pending = self._pending, None
+        self._deliver(value, *args)
+        # Once, not again when idle
+        return False
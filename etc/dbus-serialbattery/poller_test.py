@@ -0,0 +1,98 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import threading
+import unittest
+from poller import PollWorker, IdleHandoff, OVERRUN_SKIP, OVERRUN_RUN
+
+
+class FakeClock(object):
+    # Time only moves when the worker waits or a poll takes time, until end
+
+    def __init__(self, end):
+        self.now = 0.0
+        self.end = end
+
+    def __call__(self):
+        return self.now
+
+    def wait(self, seconds):
+        self.now += seconds
+        return self.now >= self.end
+
+
+class TestPollWorker(unittest.TestCase):
+
+    def run_worker(self, overrun, durations, duration):
+        # Poll every 50ms for duration seconds, the nth poll takes durations[n] seconds
+        clock = FakeClock(duration)
+        starts = []
+
+        def poll():
+            starts.append(clock.now)
+            if len(starts) <= len(durations):
+                clock.now += durations[len(starts) - 1]
+
+        worker = PollWorker(poll, 50, overrun, clock=clock, wait=clock.wait)
+        worker.run()
+        return worker, starts
+
+    def test_no_drift(self):
+        worker, starts = self.run_worker(OVERRUN_SKIP, [0.02] * 10, 0.52)
+        self.assertEqual(worker.missed, 0)
+        self.assertEqual(worker.overruns, 0)
+        # Ticks stay on the 50ms grid although every poll takes 20ms
+        self.assertAlmostEqual(starts[10] - starts[0], 0.5)
+
+    def test_skip_overrun(self):
+        worker, starts = self.run_worker(OVERRUN_SKIP, [0.13], 0.3)
+        # The first poll ends at 130ms, the ticks at 50 and 100ms are skipped
+        self.assertEqual(worker.overruns, 1)
+        self.assertEqual(worker.missed, 2)
+        self.assertAlmostEqual(starts[1] - starts[0], 0.15)
+
+    def test_run_overrun(self):
+        worker, starts = self.run_worker(OVERRUN_RUN, [0.13], 0.3)
+        # The tick at 100ms is polled right after the first poll, the one at 50ms is lost
+        self.assertEqual(worker.overruns, 1)
+        self.assertEqual(worker.missed, 1)
+        self.assertAlmostEqual(starts[1] - starts[0], 0.13)
+        self.assertAlmostEqual(starts[2] - starts[0], 0.15)
+
+    def test_thread(self):
+        polled = threading.Event()
+        worker = PollWorker(polled.set, 50)
+        worker.start()
+        self.assertTrue(polled.wait(5))
+        worker.stop(5)
+        self.assertGreaterEqual(worker.polls, 1)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, PollWorker, lambda: None, 50, 'later')
+
+
+class TestIdleHandoff(unittest.TestCase):
+
+    def test_newest_value_once(self):
+        # GLib's idle_add, the main loop runs the callbacks when it gets to them
+        callbacks = []
+        delivered = []
+        handoff = IdleHandoff(lambda callback, *args: callbacks.append((callback, args)),
+                              lambda value, loop: delivered.append((value, loop)))
+
+        # Two polls before the main loop gets to it
+        handoff.put('snapshot 1', 'loop')
+        handoff.put('snapshot 2', 'loop')
+        self.assertEqual(len(callbacks), 1)
+        callback, args = callbacks.pop()
+        self.assertFalse(callback(*args))
+        self.assertEqual(delivered, [('snapshot 2', 'loop')])
+
+        # A later poll is scheduled again
+        handoff.put('snapshot 3', 'loop')
+        self.assertEqual(len(callbacks), 1)
+        callback, args = callbacks.pop()
+        callback(*args)
+        self.assertEqual(delivered, [('snapshot 2', 'loop'), ('snapshot 3', 'loop')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+import errno
+import logging
+import os
+import select
+import threading
+import serial
+from struct import calcsize, unpack_from
+from capture import CaptureWriter, RecordingSerial, ReplaySerial
+from framer import buffer_view
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Port names starting with this are served from a capture file instead of a tty:
+# replay:<capture file>[#<recorded port>]
+REPLAY_PREFIX = 'replay:'
+
+
+class SerialPortManager(object):
+    # Keeps one open serial.Serial handle per port so the drivers do not open, flush and
+    # close the tty for every command. A handle that raised a SerialException is dropped
+    # with close() and reopened by the next call to open().
+
+    def __init__(self):
+        self._ports = {}
+        self._locks = {}
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self._capture = None
+        self.replay_realtime = False
+
+    def record(self, path):
+        # Record all traffic of ports opened from now on to a capture file
+        logger.info('Recording serial traffic to %s' % path)
+        self._capture = CaptureWriter(path)
+
+    def lock(self, port):
+        # One lock per port. Hold it for a whole request/reply exchange so two
+        # callers can not interleave their frames on the same line.
+        with self._lock:
+            if port not in self._locks:
+                self._locks[port] = threading.RLock()
+            return self._locks[port]
+
+    def open(self, port, baud, timeout=0.1):
+        # The timeout is only set when the port is opened, read_exactly() waits for the
+        # deadline of each read in select() instead of changing it
+        ser = self._ports.get(port)
+        if ser is not None and ser.is_open:
+            # The autodetection probes several baud rates on the same port
+            if ser.baudrate != baud:
+                ser.baudrate = baud
+            return ser
+
+        logger.debug('Opening serial port %s at %d baud' % (port, baud))
+        if port.startswith(REPLAY_PREFIX):
+            path, _, recorded_port = port[len(REPLAY_PREFIX):].partition('#')
+            ser = ReplaySerial(path, recorded_port or None, self.replay_realtime)
+            ser.baudrate = baud
+            ser.timeout = timeout
+        else:
+            ser = serial.Serial(port, baudrate=baud, timeout=timeout)
+        if self._capture is not None:
+            ser = RecordingSerial(ser, port, self._capture)
+        self._ports[port] = ser
+        return ser
+
+    def buffer(self, port, size=512):
+        # The receive buffer of port for read_frame(), allocated once and reused for every
+        # reply. Only use it while holding lock(port).
+        buffer = self._buffers.get(port)
+        if buffer is None or len(buffer) < size:
+            buffer = self._buffers[port] = bytearray(size)
+        return buffer
+
+    def flush_input(self, port):
+        # Drop whatever was received on an open port
+        ser = self._ports.get(port)
+        if ser is None:
+            return
+        with self.lock(port):
+            try:
+                ser.flushInput()
+            except serial.SerialException as e:
+                logger.error(e)
+                self.close(port)
+
+    def close(self, port):
+        ser = self._ports.pop(port, None)
+        if ser is None:
+            return
+        try:
+            ser.close()
+        except serial.SerialException as e:
+            logger.error(e)
+
+    def close_all(self):
+        for port in list(self._ports):
+            self.close(port)
+
+
+def read_exactly(ser, size, deadline):
+    # Block on the port until size bytes arrived or the deadline passed. This waits in
+    # select() on the file descriptor and reads what has arrived, so it wakes up as soon as
+    # the last byte is in: one select() and one read() per chunk, as pyserial's read() does,
+    # but without setting ser.timeout, which reconfigures the tty on every read. Ports
+    # without a file descriptor, such as a capture replay or recording, are read with their
+    # timeout.
+    if size <= 0:
+        return b''
+    fileno = getattr(ser, 'fileno', None)
+    if fileno is None:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return b''
+        ser.timeout = remaining
+        return ser.read(size)
+
+    fd = fileno()
+    data = b''
+    while len(data) < size:
+        remaining = deadline - monotonic()
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+            break
+        try:
+            chunk = os.read(fd, size - len(data))
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                continue
+            raise serial.SerialException('read failed: %s' % e)
+        if not chunk:
+            raise serial.SerialException('device reports readiness to read but returned no data '
+                                         '(device disconnected or multiple access on port?)')
+        data = data + chunk if data else chunk
+    return data
+
+
+def read_frame(ser, length_pos, length_check, length_fixed=None, length_size=None, timeout=0.3, buffer=None):
+    # Read one reply whose total length is length + length_check + 1, where length is
+    # either fixed or decoded from the header at length_pos. Returns the frame, or the
+    # (possibly empty) partial data if the deadline passed first. The reply is received
+    # into buffer, a new one if None, and returned as a view valid until the buffer is
+    # used again.
+    deadline = monotonic() + timeout
+    length_size = length_size if length_size is not None else 'B'
+    if length_fixed is not None:
+        header_len = min(length_pos + 1, length_fixed + length_check + 1)
+    else:
+        header_len = length_pos + calcsize(length_size)
+    if buffer is None:
+        buffer = bytearray(512)
+    view = buffer_view(buffer)
+
+    received = receive_into(ser, view, 0, header_len, deadline)
+    if received < header_len:
+        return view[:received]
+
+    length = length_fixed if length_fixed is not None else unpack_from(length_size, buffer, length_pos)[0]
+    received += receive_into(ser, view, received, length + length_check + 1 - received, deadline)
+    return view[:received]
+
+
+def receive_into(ser, view, offset, size, deadline):
+    # Copy up to size bytes from the port into view at offset, returns how many arrived
+    size = max(0, min(size, len(view) - offset))
+    data = read_exactly(ser, size, deadline)
+    view[offset:offset + len(data)] = data
+    return len(data)
+
+
+def read_framed(ser, framer, deadline, accept=None):
+    # Feed the port into framer until it yields a frame that accept(frame) takes, or the
+    # deadline passed. Frames that are not accepted, e.g. a late reply to an earlier
+    # command, are dropped. Returns the frame or None.
+    while True:
+        for frame in framer.frames():
+            if accept is None or accept(frame):
+                return frame
+            # frame is a view, copied only when the message is logged at all
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Ignoring unexpected frame %r' % bytearray(frame))
+        data = read_exactly(ser, framer.bytes_needed(), deadline)
+        if not data:
+            return None
+        framer.feed(data)
+
+
+# Shared by all drivers in this process
+serial_ports = SerialPortManager()
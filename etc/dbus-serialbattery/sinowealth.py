@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
-from battery import Protection, Battery, Cell
+from battery import Protection, Battery, Cell, TIER_FAST, TIER_MEDIUM, TIER_SLOW
 from utils import *
 from struct import *
 
@@ -16,7 +16,11 @@ class Sinowealth(Battery):
         self.cell_max_no = None
         self.cell_count = None
         self.cell_voltages = {}
-        self.poll_interval = 2000
+        self.read_internal_temperature = SINOWEALTH_READ_INTERNAL_TEMP
+        self._prefetched = {}
+        self._pipeline_failed = False
+        # Command bytes per register, built once
+        self._commands = {}
         self.type = self.BATTERYTYPE
     # command bytes [StartFlag=0A][Command byte][response dataLength=2 to 20 bytes][checksum]
     command_base = b"\x0A\x00\x04"
@@ -56,26 +60,74 @@ class Sinowealth(Battery):
         
         self.max_battery_voltage = MAX_CELL_VOLTAGE * self.cell_count
         self.min_battery_voltage = MIN_CELL_VOLTAGE * self.cell_count
+        self.max_battery_voltage_warning = MAX_CELL_VOLTAGE_WARNING * self.cell_count
+        self.min_battery_voltage_warning = MIN_CELL_VOLTAGE_WARNING * self.cell_count
         
         self.hardware_version = "Daly/Sinowealth BMS " + str(self.cell_count) + " cells"
         logger.info(self.hardware_version)
         
-        for c in range(self.cell_count):
-          self.cells.append(Cell(False))
+        self.cells.resize(self.cell_count)
         return True
 
-    def refresh_data(self):
-        result = self.read_soc()
-        result = result and self.read_status_data()
-        result = result and self.read_battery_status()
-        result = result and self.read_pack_voltage()
-        result = result and self.read_pack_current()
-        result = result and self.read_cell_data()
-        result = result and self.read_temperature_data()
-        result = result and self.read_remaining_capacity()
-        result = result and self.read_cycle_count()
+    def refresh_reads(self):
+        return [
+            (TIER_FAST, self.read_status_data),
+            (TIER_FAST, self.read_battery_status),
+            (TIER_FAST, self.read_pack_voltage),
+            (TIER_FAST, self.read_pack_current),
+            (TIER_FAST, self.read_cell_data),
+            (TIER_MEDIUM, self.read_soc),
+            (TIER_MEDIUM, self.read_temperature_data),
+            (TIER_MEDIUM, self.read_remaining_capacity),
+            (TIER_SLOW, self.read_cycle_count),
+        ]
+
+    def refresh_tiers(self, tiers):
+        self.prefetch(self.refresh_registers(tiers))
+        result = super(Sinowealth, self).refresh_tiers(tiers)
+        self._prefetched = {}
         return result
 
+    def refresh_registers(self, tiers):
+        # Registers read by refresh_reads() for tiers
+        registers = [self.command_status, self.command_battery_status,
+                     self.command_total_voltage, self.command_current]
+        if self.cell_count is not None:
+            registers += range(1, self.cell_count + 1)
+        if TIER_MEDIUM in tiers:
+            registers += [self.command_soc, self.command_temp_ext1]
+            if self.temp_sensors == 2:
+                registers.append(self.command_temp_ext2)
+            if self.read_internal_temperature:
+                registers += [self.command_temp_int1, self.command_temp_int2]
+            registers.append(self.command_remaining_capacity)
+            if self.capacity is None:
+                registers.append(self.command_capacity)
+        if TIER_SLOW in tiers:
+            registers.append(self.command_cycle_count)
+        return registers
+
+    def prefetch(self, registers):
+        # Pipeline the register reads of one refresh: all commands go out back to back and
+        # the fixed length replies are matched up by order. The read_* methods take their
+        # reply from here and only do a round trip of their own for a missing one.
+        commands = [self.generate_command(r) for r in registers]
+        replies = read_serial_data_pipelined(commands, self.port, self.baud_rate,
+                                             [c[2] + self.LENGTH_CHECK + 1 for c in commands],
+                                             check=self.checksum_valid if SINOWEALTH_PIPELINE_CHECKSUM else None)
+        self._prefetched = dict((self.register(r), d) for r, d in zip(registers, replies) if d is not False)
+        if len(self._prefetched) < len(registers) and not self._pipeline_failed:
+            # Once, a BMS with another checksum would log this on every poll
+            self._pipeline_failed = True
+            logger.warning('Got %d of %d pipelined replies intact, reading the rest one by one. If this '
+                           'happens on every poll, try SINOWEALTH_PIPELINE_CHECKSUM = False'
+                           % (len(self._prefetched), len(registers)))
+
+    @staticmethod
+    def checksum_valid(reply):
+        # The last byte of a reply is the sum of its data bytes, modulo 256
+        return sum(bytearray(reply[:-1])) & 0xFF == reply[-1]
+
     def read_status_data(self):
         status_data = self.read_serial_data_sinowealth(self.command_status)
         # check if connection success
@@ -131,7 +183,7 @@ class Sinowealth(Battery):
         # check if connection success
         if cycle_count is False:
             return False
-        self.cycles = int(unpack_from('>H', cycle_count[:2])[0])
+        self.cycles = int(unpack_from('>H', cycle_count)[0])
         logger.info(">>> INFO: current cycle count: %u", self.cycles)
         return True        
                 
@@ -139,7 +191,7 @@ class Sinowealth(Battery):
         pack_voltage_data = self.read_serial_data_sinowealth(self.command_total_voltage)
         if pack_voltage_data is False:
             return False
-        pack_voltage = unpack_from('>H', pack_voltage_data[:-1])
+        pack_voltage = unpack_from('>H', pack_voltage_data)
         logger.info(">>> INFO: current pack voltage: %f", pack_voltage[0]/1000)
         self.voltage = pack_voltage[0]/1000
         return True
@@ -148,7 +200,7 @@ class Sinowealth(Battery):
         current_data = self.read_serial_data_sinowealth(self.command_current)
         if current_data is False:
             return False
-        current = unpack_from('>i', current_data[:-1])
+        current = unpack_from('>i', current_data)
         logger.info(">>> INFO: current pack current: %f", current[0]/1000)
         self.current = current[0]/1000
         return True
@@ -157,7 +209,7 @@ class Sinowealth(Battery):
         remaining_capacity_data = self.read_serial_data_sinowealth(self.command_remaining_capacity)
         if remaining_capacity_data is False:
             return False
-        remaining_capacity = unpack_from('>i', remaining_capacity_data[:-1])
+        remaining_capacity = unpack_from('>i', remaining_capacity_data)
         logger.info(">>> INFO: remaining battery capacity: %f Ah", remaining_capacity[0]/1000)
         self.capacity_remain = remaining_capacity[0]/1000
         if self.capacity is None:
@@ -169,7 +221,7 @@ class Sinowealth(Battery):
         capacity_data = self.read_serial_data_sinowealth(self.command_capacity)
         if capacity_data is False:
             return False
-        capacity = unpack_from('>i', capacity_data[:-1])
+        capacity = unpack_from('>i', capacity_data)
         logger.info(">>> INFO: Battery capacity: %f Ah", capacity[0]/1000)
         self.capacity = capacity[0]/1000
         return True       
@@ -202,10 +254,10 @@ class Sinowealth(Battery):
         return True
         
     def read_cell_voltage(self, cell_index):
-        cell_data = self.read_serial_data_sinowealth(str(chr(cell_index)))
+        cell_data = self.read_serial_data_sinowealth(cell_index)
         if cell_data is False:
             return False
-        cell_voltage = unpack_from('>H', cell_data[:-1])
+        cell_voltage = unpack_from('>H', cell_data)
         logger.info(">>> INFO: Cell %u voltage: %f V", cell_index, cell_voltage[0]/1000 )
         
         return cell_voltage[0]/1000
@@ -217,7 +269,7 @@ class Sinowealth(Battery):
         if temp_ext1_data is False:
             return False
             
-        temp_ext1 = unpack_from('>H', temp_ext1_data[:-1])
+        temp_ext1 = unpack_from('>H', temp_ext1_data)
         self.temp1 = kelvin_to_celsius(temp_ext1[0]/10)
         logger.info(">>> INFO: BMS external temperature 1: %f C", self.temp1 )
 
@@ -226,16 +278,19 @@ class Sinowealth(Battery):
             if temp_ext2_data is False:
                 return False
             
-            temp_ext2 = unpack_from('>H', temp_ext2_data[:-1])
+            temp_ext2 = unpack_from('>H', temp_ext2_data)
             self.temp2 = kelvin_to_celsius(temp_ext2[0]/10)
             logger.info(">>> INFO: BMS external temperature 2: %f C", self.temp2 )
         
+        if not self.read_internal_temperature:
+            return True
+
         # Internal temperature 1 seems to give a logical value 
         temp_int1_data = self.read_serial_data_sinowealth(self.command_temp_int1)
         if temp_int1_data is False:
             return False
             
-        temp_int1 = unpack_from('>H', temp_int1_data[:-1])
+        temp_int1 = unpack_from('>H', temp_int1_data)
         logger.info(">>> INFO: BMS internal temperature 1: %f C", kelvin_to_celsius(temp_int1[0]/10) )
         
         # Internal temperature 2 seems to give a useless value 
@@ -243,18 +298,26 @@ class Sinowealth(Battery):
         if temp_int2_data is False:
             return False
             
-        temp_int2 = unpack_from('>H', temp_int2_data[:-1])
+        temp_int2 = unpack_from('>H', temp_int2_data)
         logger.info(">>> INFO: BMS internal temperature 2: %f C", kelvin_to_celsius(temp_int2[0]/10) )
         return True
 
+    @staticmethod
+    def register(command):
+        # Register address of a command byte, or of a cell number
+        return command if isinstance(command, int) else bytearray(command)[0]
+
     def generate_command(self, command):
-        buffer = bytearray(self.command_base)
-        buffer[1] = command
+        register = self.register(command)
+        buffer = self._commands.get(register)
+        if buffer is None:
+            buffer = self._commands[register] = bytearray(self.command_base)
+            buffer[1] = register
         return buffer
 
     def read_serial_data_sinowealth(self, command):
-        data = read_serial_data(self.generate_command(command), self.port, self.baud_rate, self.LENGTH_POS, self.LENGTH_CHECK, int(self.generate_command(command)[2]))
-        if data is False:
-            return False
-
-        return bytearray(data)
+        data = self._prefetched.pop(self.register(command), None)
+        if data is not None:
+            return data
+        command = self.generate_command(command)
+        return read_serial_data(command, self.port, self.baud_rate, self.LENGTH_POS, self.LENGTH_CHECK, int(command[2]))
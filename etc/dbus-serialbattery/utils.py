@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
+import fcntl
+import fnmatch
+import json
 import logging
+import os
 import serial
-from time import sleep
+import tempfile
+import threading
 from struct import *
+from serialport import serial_ports, read_exactly, read_frame, read_framed, monotonic
+from framer import Framer, buffer_view
 
 # Logging
 logger = logging.getLogger(__name__)
@@ -12,7 +19,6 @@ logger.setLevel(logging.INFO)
 # Constants - Need to dynamically get them in future
 DRIVER_VERSION = 0.7
 DRIVER_SUBVERSION = 'j'
-zero_char = chr(48)
 degree_sign = u'\N{DEGREE SIGN}'
 # Cell min/max voltages - used with the cell count to get the min/max battery voltage
 MIN_CELL_VOLTAGE = 3.05
@@ -24,6 +30,55 @@ MAX_CELL_VOLTAGE = 3.55 # Was 3.51
 # battery current limits
 MAX_BATTERY_CURRENT = 80.0
 MAX_BATTERY_DISCHARGE_CURRENT = 80.0
+# Total time in seconds to wait for a complete reply to one command
+SERIAL_REPLY_TIMEOUT = 0.3
+# Sinowealth internal temperatures are only logged, set to False to skip reading them
+SINOWEALTH_READ_INTERNAL_TEMP = True
+# Check the last byte of each pipelined Sinowealth reply as the sum of its data bytes modulo
+# 256. Set to False when a BMS uses another checksum, its pipelined replies are all dropped
+# and read again one by one otherwise.
+SINOWEALTH_PIPELINE_CHECKSUM = True
+# Total time in seconds the autodetection may spend probing a port
+AUTODETECT_TIMEOUT = 5.0
+# Record all serial traffic to this capture file, %s is replaced by the tty name.
+# e.g. '/data/serialbattery-%s.cap'. Replay it with the port name replay:<file>
+SERIAL_CAPTURE = None
+# Seconds between reads of the medium (temperatures, SoC) and slow (settings, versions,
+# cycle counts) values of the drivers that support tiered polling
+TIER_MEDIUM_INTERVAL = 5.0
+TIER_SLOW_INTERVAL = 60.0
+# A poll that takes longer than the poll interval either skips the ticks it overran ('skip')
+# or has the next poll start right after it ('run')
+POLL_OVERRUN = 'skip'
+# With several ports, also publish all of their batteries as one, for packs connected in parallel
+AGGREGATE_BATTERY = False
+# Addresses of several Daly BMS sharing one RS485 port, polled in turn, e.g. [b"\x40", b"\x41"].
+# None detects one BMS per port
+DALY_ADDRESSES = None
+# Ask a JKBMS for the cell voltages, voltage, current and alarms only on every poll and for
+# the full data dump on the medium tier. Each register takes a request and reply of its own,
+# which is more bytes and round trips than the full dump (see benchmark.py jkread), so only
+# worth it where the BMS is slow to build the full dump.
+JKBMS_SELECTIVE_READ = False
+# Only publish a dbus value when it moved at least this far from the value last published
+# on its path, paths are fnmatch patterns. Other paths are published on every change.
+DBUS_DEADBANDS = {
+    '/Internal/Cell/*/Voltage': 0.005,
+    '/System/M??CellVoltage': 0.005,
+    '/Dc/0/Current': 0.1,
+    '/Dc/0/Power': 1.0,
+    '/Dc/0/Temperature': 0.1,
+    '/System/M??CellTemperature': 0.1,
+    '/Internal/Temperature': 0.1,
+}
+# Seconds between publishing all dbus values regardless of the deadbands
+DBUS_REFRESH_INTERVAL = 60.0
+# Send all dbus values that changed in a poll in one ItemsChanged signal, where velib
+# supports it. False for one PropertiesChanged signal per value, for consumers that only
+# listen to those.
+DBUS_BATCH_CHANGES = True
+# Last detected BMS per port, tried first on the next start
+BATTERY_TYPE_CACHE = '/data/conf/dbus-serialbattery.json'
 
 
 TEMP_WARN = 8
@@ -45,8 +100,65 @@ def dc_t_curve(discharge_current, temp):
     return discharge_current * (temp - TEMP_CUTOFF) / (TEMP_WARN - TEMP_CUTOFF)
 
 
-def is_bit_set(tmp):
-    return False if tmp == zero_char else True
+class BitLayout(object):
+    # The meaning of the bits of a status or alarm register. fields is a sequence of
+    # (attribute, ((mask, value), ...), default): decode() sets each attribute of target
+    # to the value of the first mask that has a bit set in the register, else to default.
+
+    def __init__(self, fields):
+        self.fields = tuple((attribute, tuple(levels), default) for attribute, levels, default in fields)
+
+    def decode(self, register, target):
+        for attribute, levels, default in self.fields:
+            for mask, value in levels:
+                if register & mask:
+                    break
+            else:
+                value = default
+            setattr(target, attribute, value)
+
+
+class ChangeFilter(object):
+    # Decides which values of a publish cycle are worth sending. A value goes out when it
+    # differs from the value last sent on its path by at least the deadband of the path,
+    # deadbands maps fnmatch patterns to deadbands. Every refresh_interval seconds a cycle
+    # sends all values, so what is published never stays off by up to a deadband for long.
+
+    def __init__(self, deadbands, refresh_interval):
+        self.deadbands = deadbands
+        self.refresh_interval = refresh_interval
+        self.published = {}
+        self.refreshing = False
+        self._refresh_due = 0
+        self._path_deadbands = {}
+
+    def start(self, now):
+        # Call at the start of each publish cycle
+        self.refreshing = now >= self._refresh_due
+        if self.refreshing:
+            self._refresh_due = now + self.refresh_interval
+
+    def deadband(self, path):
+        # Looked up once per path
+        try:
+            return self._path_deadbands[path]
+        except KeyError:
+            deadband = max([d for pattern, d in self.deadbands.items() if fnmatch.fnmatchcase(path, pattern)] or [0])
+            self._path_deadbands[path] = deadband
+            return deadband
+
+    def changed(self, path, value):
+        # Whether value is to be sent, it then counts as published
+        if path in self.published and not self.refreshing:
+            last = self.published[path]
+            if value == last:
+                return False
+            if isinstance(value, (int, float)) and isinstance(last, (int, float)) and \
+                    abs(value - last) < self.deadband(path) - 1e-9:
+                return False
+        self.published[path] = value
+        return True
+
 
 def kelvin_to_celsius(kelvin_temp):
     return kelvin_temp - 273.1
@@ -56,47 +168,135 @@ def format_value(value, prefix, suffix):
                                       str(value) + \
                                       ('' if suffix is None else suffix)
 
-def read_serial_data(command, port, baud, length_pos, length_check, length_fixed=None, length_size=None):
+def port_identity(port):
+    # A name for the adapter behind port that survives re-enumeration: the
+    # /dev/serial/by-id link (it contains the USB serial number), else the port itself
+    by_id = '/dev/serial/by-id'
+    try:
+        device = os.path.realpath(port)
+        for name in sorted(os.listdir(by_id)):
+            if os.path.realpath(os.path.join(by_id, name)) == device:
+                return os.path.join(by_id, name)
+    except OSError:
+        pass
+    return port
+
+def read_battery_type_cache():
+    try:
+        with open(BATTERY_TYPE_CACHE) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+# The ports of one process are probed on threads of their own and serial-starter runs a
+# process per tty, all updating the same cache
+_battery_type_cache_lock = threading.Lock()
+
+def update_battery_type_cache(identity, battery_type):
+    # Read, change and replace the cache as one step. The flock is taken on a lock file next
+    # to the cache, the cache itself is a new file after every update. Each update is written
+    # to a temp file of its own, so a reader only ever sees a complete cache.
+    directory = os.path.dirname(BATTERY_TYPE_CACHE)
     try:
-        with serial.Serial(port, baudrate=baud, timeout=0.1) as ser:
-            ser.flushOutput()
+        with _battery_type_cache_lock, open(BATTERY_TYPE_CACHE + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = read_battery_type_cache()
+            if cache.get(identity) == battery_type:
+                return
+            cache[identity] = battery_type
+            fd, path = tempfile.mkstemp(dir=directory, prefix='.dbus-serialbattery.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(cache, f, indent=2, sort_keys=True)
+                # mkstemp() makes it readable by the owner only
+                os.chmod(path, 0o644)
+                os.rename(path, BATTERY_TYPE_CACHE)
+            except:
+                os.unlink(path)
+                raise
+    except (IOError, OSError) as e:
+        logger.error('Cannot write %s: %s' % (BATTERY_TYPE_CACHE, e))
+
+def read_serial_data(command, port, baud, length_pos, length_check, length_fixed=None, length_size=None,
+                     framer=None, accept=None):
+    # The reply is a view into the receive buffer of the framer or of the port, valid until
+    # the next read with the same framer or on the same port. Decode it right away.
+    with serial_ports.lock(port):
+        try:
+            ser = serial_ports.open(port, baud)
+            if framer is not None:
+                # The framer skips stale bytes itself and keeps the start of a following frame
+                ser.write(command)
+                data = read_framed(ser, framer, monotonic() + SERIAL_REPLY_TIMEOUT, accept)
+                if data is None:
+                    logger.error(">>> ERROR: No valid reply - returning")
+                    return False
+                return data
+
+            # Drop anything left over from an earlier reply that timed out
             ser.flushInput()
             ser.write(command)
 
-            count = 0
-            toread = ser.inWaiting()
-
-            while toread < (length_pos+1):
-                sleep(0.005)
-                toread = ser.inWaiting()
-                count += 1
-                if count > 50:
-                    logger.error(">>> ERROR: No reply - returning")
-                    return False 
-                    # raise Exception("No reply from {}".format(port))
-            #logger.info('serial data toread ' + str(toread))
-            res = ser.read(toread)
-            if len(res) < length_pos and length_fixed is None:
-                logger.error(">>> ERROR: Short reply - returning")
+            data = read_frame(ser, length_pos, length_check, length_fixed, length_size, SERIAL_REPLY_TIMEOUT,
+                              serial_ports.buffer(port))
+            if len(data) == 0:
+                logger.error(">>> ERROR: No reply - returning")
                 return False
             length_size = length_size if length_size is not None else 'B'
-            length = length_fixed if length_fixed is not None else unpack_from(length_size, res,length_pos)[0]
-            #logger.info('serial data length ' + str(length))
-
-            count = 0
-            data = bytearray(res)
-            while len(data) <= length + length_check:
-                res = ser.read(length + length_check)
-                data.extend(res)
-                #logger.info('serial data length ' + str(len(data)))
-                sleep(0.005)
-                count += 1
-                if count > 150:
-                    logger.error(">>> ERROR: No reply - returning")
-                    return False
+            if length_fixed is None and len(data) < length_pos + calcsize(length_size):
+                logger.error(">>> ERROR: Short reply - returning")
+                return False
+            length = length_fixed if length_fixed is not None else unpack_from(length_size, data, length_pos)[0]
+            if len(data) < length + length_check + 1:
+                logger.error(">>> ERROR: Short reply - returning")
+                return False
 
             return data
 
-    except serial.SerialException as e:
-        logger.error(e)
-        return False
+        except serial.SerialException as e:
+            logger.error(e)
+            # Reopened on the next command
+            serial_ports.close(port)
+            return False
+
+
+def read_serial_data_pipelined(commands, port, baud, reply_lengths, timeout=None, check=None):
+    # Write all commands back to back and split the replies by order and length. Only for
+    # BMS that answer every command in order with a reply of known length. Returns a list
+    # with the reply or False for each command, the replies are views into one received block.
+    # check(reply), when given, tells whether a reply is intact, see split_replies().
+    if timeout is None:
+        timeout = SERIAL_REPLY_TIMEOUT + 0.02 * len(commands)
+    with serial_ports.lock(port):
+        try:
+            ser = serial_ports.open(port, baud)
+            ser.flushInput()
+            ser.write(b''.join(bytes(c) for c in commands))
+            data = read_exactly(ser, sum(reply_lengths), monotonic() + timeout)
+        except serial.SerialException as e:
+            logger.error(e)
+            serial_ports.close(port)
+            return [False] * len(commands)
+
+    # pyserial reads str on Python 2
+    return split_replies(bytearray(data) if isinstance(data, str) else data, reply_lengths, check)
+
+
+def split_replies(data, reply_lengths, check=None):
+    # Cut data into replies of reply_lengths. A reply that is missing or fails check(reply)
+    # is False, and so are all after it: a byte lost or added there would shift every later
+    # reply onto the wrong command. Those commands are left to a round trip of their own.
+    replies = []
+    offset = 0
+    view = buffer_view(data)
+    for length in reply_lengths:
+        if offset + length > len(data):
+            break
+        reply = view[offset:offset + length]
+        if check is not None and not check(reply):
+            logger.debug('Reply %d of %d is invalid' % (len(replies) + 1, len(reply_lengths)))
+            break
+        replies.append(reply)
+        offset += length
+    # The caller logs, it may do so only once for a BMS that never gets them all right
+    return replies + [False] * (len(reply_lengths) - len(replies))
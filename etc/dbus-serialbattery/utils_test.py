@@ -1,5 +1,14 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 import utils
+from battery import Protection
+from jkbms import Jkbms
+from lltjbd import LltJbd, LltJbdProtection
+from sinowealth import Sinowealth
 
 class TestUtilsModules(unittest.TestCase):
 
@@ -18,6 +27,123 @@ class TestUtilsModules(unittest.TestCase):
         self.assertEqual(utils.dc_t_curve(280, -10), 0)
 
 
+class TestBitLayout(unittest.TestCase):
+
+    def test_first_matching_level(self):
+        layout = utils.BitLayout((('cell_imbalance', ((1 << 7, 2), (1 << 10, 1)), 0),))
+        protection = Protection()
+        for register, level in ((0, 0), (1 << 10, 1), (1 << 7 | 1 << 10, 2), (1 << 7, 2), (1 << 8, 0)):
+            layout.decode(register, protection)
+            self.assertEqual(protection.cell_imbalance, level)
+
+    def test_lltjbd_protection(self):
+        protection = LltJbdProtection()
+        # cell under voltage, IC error and an unused high bit
+        LltJbd.PROTECTION_BITS.decode(1 << 1 | 1 << 11 | 1 << 15, protection)
+        self.assertTrue(protection.voltage_low_cell)
+        self.assertTrue(protection.IC_inspection)
+        self.assertFalse(protection.short)
+        self.assertEqual(protection.cell_imbalance, 2)
+        self.assertEqual(protection.internal_failure, 2)
+        self.assertEqual(protection.voltage_high, 0)
+        self.assertEqual(protection.current_under, 0)
+
+    def test_jkbms_protection(self):
+        protection = Protection()
+        # charge over current and 309_B protection, which has no alarm of its own
+        Jkbms.PROTECTION_BITS.decode(1 << 5 | 1 << 13, protection)
+        self.assertEqual(protection.current_over, 1)
+        self.assertEqual(protection.soc_low, 0)
+        self.assertEqual(protection.cell_imbalance, 0)
+
+    def test_lltjbd_cell_balance(self):
+        battery = LltJbd('/dev/null', 9600)
+        for cell_count in (20, 18):
+            battery.cell_count = cell_count
+            battery.to_cell_bits(0x8001, 0x0002)
+            self.assertEqual(len(battery.cells), cell_count)
+            self.assertEqual([c for c, cell in enumerate(battery.cells) if cell.balance], [0, 15, 17])
+
+
+class TestChangeFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.changes = utils.ChangeFilter({'/Internal/Cell/*/Voltage': 0.005, '/Dc/0/Current': 0.1}, 60.0)
+        self.changes.start(0)
+
+    def sent(self, values, now=1):
+        self.changes.start(now)
+        return [path for path, value in values if self.changes.changed(path, value)]
+
+    def test_deadbands(self):
+        self.assertEqual(self.sent([('/Internal/Cell/1/Voltage', 3.300), ('/Dc/0/Current', 5.0), ('/Soc', 50)], 0),
+                         ['/Internal/Cell/1/Voltage', '/Dc/0/Current', '/Soc'])
+        self.assertEqual(self.sent([('/Internal/Cell/1/Voltage', 3.304), ('/Dc/0/Current', 5.05), ('/Soc', 51)]),
+                         ['/Soc'])
+        # Measured from the value last sent, not from the last one seen
+        self.assertEqual(self.sent([('/Internal/Cell/1/Voltage', 3.305), ('/Dc/0/Current', 4.9)]),
+                         ['/Internal/Cell/1/Voltage', '/Dc/0/Current'])
+        self.assertEqual(self.changes.published['/Internal/Cell/1/Voltage'], 3.305)
+
+    def test_unchanged_and_none(self):
+        self.assertEqual(self.sent([('/History/ChargeCycles', None)], 0), ['/History/ChargeCycles'])
+        self.assertEqual(self.sent([('/History/ChargeCycles', None)]), [])
+        self.assertEqual(self.sent([('/History/ChargeCycles', 3)]), ['/History/ChargeCycles'])
+
+    def test_refresh_sends_all(self):
+        values = [('/Internal/Cell/1/Voltage', 3.300), ('/Soc', 50)]
+        self.sent(values, 0)
+        self.assertEqual(self.sent(values, 59), [])
+        self.assertEqual(self.sent(values, 60), ['/Internal/Cell/1/Voltage', '/Soc'])
+        self.assertEqual(self.sent(values, 61), [])
+
+
+class TestBatteryTypeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = utils.BATTERY_TYPE_CACHE
+        utils.BATTERY_TYPE_CACHE = os.path.join(self.directory, 'dbus-serialbattery.json')
+
+    def tearDown(self):
+        utils.BATTERY_TYPE_CACHE = self.cache
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_updates(self):
+        # One thread per port, as the autodetection probes them
+        threads = [threading.Thread(target=lambda n=n: [utils.update_battery_type_cache('port%d' % n, 'type%d' % i)
+                                                         for i in range(20)])
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(utils.read_battery_type_cache(), dict(('port%d' % n, 'type19') for n in range(8)))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['dbus-serialbattery.json', 'dbus-serialbattery.json.lock'])
+
+
+class TestSplitReplies(unittest.TestCase):
+
+    def replies(self, *values):
+        return bytearray().join(bytearray(v) + bytearray([sum(bytearray(v)) & 0xFF]) for v in values)
+
+    def test_intact(self):
+        data = self.replies(b'\x0c\xe4\x00\x00', b'\xff\xff\xeb\xb0')
+        replies = utils.split_replies(data, [5, 5], Sinowealth.checksum_valid)
+        self.assertEqual([bytes(r) for r in replies], [data[:5], data[5:]])
+
+    def test_rest_dropped_after_invalid_reply(self):
+        # The second reply lost a byte, the third one is shifted
+        data = self.replies(b'\x0c\xe4\x00\x00', b'\xff\xff\xeb\xb0', b'\x00\x02\x71\x00')
+        data = data[:6] + data[7:]
+        replies = utils.split_replies(data, [5, 5, 5], Sinowealth.checksum_valid)
+        self.assertEqual(bytes(replies[0]), data[:5])
+        self.assertEqual(replies[1:], [False, False])
+
+    def test_short_block(self):
+        replies = utils.split_replies(self.replies(b'\x0c\xe4\x00\x00')[:4], [5, 5])
+        self.assertEqual(replies, [False, False])
+
 
 if __name__ == '__main__':
     unittest.main()